@@ -1,3 +1,4 @@
+import codecs  # Import for checking the encoding of files without loading them
 import fnmatch  # Import for Unix filename pattern matching
 import os  # Import for operating system operations
 import subprocess  # Import for running subprocesses
@@ -9,7 +10,7 @@ import toml  # Import for TOML file handling
 
 from espada.core.default.disk_memory import DiskMemory  # Import for disk memory operations
 from espada.core.default.paths import metadata_path  # Import for metadata path handling
-from espada.core.files_dict import FilesDict  # Import for file dictionary handling
+from espada.core.files_dict import FilesDict, LazyFilesDict  # Import for file dictionary handling
 from espada.core.git import filter_by_gitignore, is_git_repo  # Import for git operations
 
 
@@ -52,21 +53,23 @@ class FileSelector:
             else:
                 selected_files = self.editor_file_selector(self.project_path, True)
 
-        content_dict = {}
+        # The files are read when they are needed, only their encoding is checked here
+        readable_files = []
         for file_path in selected_files:
             # selected files contains paths that are relative to the project path
             try:
                 # to open the file we need the path from the cwd
-                with open(
-                    Path(self.project_path) / file_path, "r", encoding="utf-8"
-                ) as content:
-                    content_dict[str(file_path)] = content.read()
+                if is_utf8(Path(self.project_path) / file_path):
+                    readable_files.append(str(file_path))
+                else:
+                    print(f"Warning: File not UTF-8 encoded {file_path}, skipping")
             except FileNotFoundError:
                 print(f"Warning: File not found {file_path}")
-            except UnicodeDecodeError:
-                print(f"Warning: File not UTF-8 encoded {file_path}, skipping")
 
-        return FilesDict(content_dict), self.is_linting
+        return (
+            LazyFilesDict.from_paths(self.project_path, readable_files),
+            self.is_linting,
+        )
 
     def editor_file_selector(
         self, input_path: Union[str, Path], init: bool = True
@@ -359,3 +362,16 @@ class DisplayablePath(object):
             parent = parent.parent
 
         return "".join(reversed(parts))  # Assemble the parts into the final string
+
+
+def is_utf8(path: Path, chunk_size: int = 1 << 16) -> bool:
+    """Checks that a file is valid UTF-8 in chunks, without holding its content."""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    try:
+        with open(path, "rb") as f:
+            while chunk := f.read(chunk_size):
+                decoder.decode(chunk)
+        decoder.decode(b"", final=True)
+    except UnicodeDecodeError:
+        return False
+    return True
@@ -12,16 +12,20 @@ import openai  # Import OpenAI API client
 import typer  # Import CLI framework
 
 from dotenv import load_dotenv  # Import for loading environment variables
-from langchain.globals import set_llm_cache  # Import for LLM caching
-from langchain_community.cache import SQLiteCache  # Import for SQLite cache implementation
 from termcolor import colored  # Import for colored terminal output
 
 from espada.applications.cli.cli_agent import CliAgent  # Import CLI agent
 from espada.applications.cli.collect import collect_and_send_human_review  # Import feedback collection
 from espada.applications.cli.file_selector import FileSelector  # Import file selection
 from espada.core.ai import AI, ClipboardAI  # Import AI implementations
+from espada.core.chat_to_files import (  # Import diff worker and edit format configuration
+    EDIT_FORMATS,
+    set_diff_workers,
+    set_edit_format,
+)
 from espada.core.default.disk_execution_env import DiskExecutionEnv  # Import disk execution environment
 from espada.core.default.disk_memory import DiskMemory  # Import disk memory
+from espada.core.default.edit_policy import RETRY_CONTEXTS, set_retry_context  # Import retry context configuration
 from espada.core.default.file_store import FileStore  # Import file storage
 from espada.core.default.paths import PREPROMPTS_PATH, memory_path  # Import path constants
 from espada.core.default.steps import (  # Import step functions
@@ -31,9 +35,11 @@ from espada.core.default.steps import (  # Import step functions
     improve_fn as improve_fn,
 )
 from espada.core.files_dict import FilesDict  # Import file dictionary
+from espada.core.llm_cache import LLMCache  # Import LLM response cache
 from espada.core.git import stage_uncommitted_to_git  # Import git operations
 from espada.core.preprompts_holder import PrepromptsHolder  # Import preprompts manager
 from espada.core.prompt import Prompt  # Import prompt class
+from espada.core.tokenizer_registry import warm_up  # Import the background loading of tokenizers
 from espada.tools.custom_steps import clarified_gen, lite_gen, self_heal  # Import custom steps
 
 app = typer.Typer(  # Create CLI application
@@ -162,7 +168,7 @@ def compare(f1: FilesDict, f2: FilesDict):  # Compare two file dictionaries
 
         return "\n".join(colored_lines)  # Join lines
 
-    for file in sorted(set(f1) | set(f2)):  # Process each file
+    for file in f1.changed_files(f2):  # Process each changed file, unchanged ones share their content
         diff = colored_diff(f1.get(file, ""), f2.get(file, ""))  # Generate diff
         if diff:  # If there are differences
             print(f"Changes to {file}:")  # Print file name
@@ -316,7 +322,32 @@ def main(  # Main CLI function
     diff_timeout: int = typer.Option(  # Diff timeout option
         3,
         "--diff_timeout",
-        help="Diff regexp timeout. Default: 3. Increase if regexp search timeouts.",
+        help="Deprecated, has no effect. Diffs are parsed in linear time and no longer time out.",
+    ),
+    diff_workers: int = typer.Option(  # Diff workers option
+        0,
+        "--diff_workers",
+        help="Validate and apply the diffs of different files in this many processes. 0 or 1 keeps them in process.",
+    ),
+    edit_format: str = typer.Option(  # Edit format option
+        "",
+        "--edit_format",
+        help="Format of the edits in improve mode: 'diff' for unified diffs (default) or 'search_replace' for SEARCH/REPLACE blocks, which take fewer tokens.",
+    ),
+    retry_context: str = typer.Option(  # Retry context option
+        "",
+        "--retry_context",
+        help="What a retry of failed diffs sends in improve mode: 'full' for the whole conversation (default) or 'delta' for the failed hunks and the code around them only.",
+    ),
+    structured_output: bool = typer.Option(  # Structured output option
+        False,
+        "--structured_output",
+        help="Have the model emit files and diffs as JSON tool calls instead of parsing them from the chat. Requires a model with tool calling; SEARCH/REPLACE edits stay in the chat.",
+    ),
+    usage_log: str = typer.Option(  # Usage log option
+        "",
+        "--usage_log",
+        help="File to write the tokens, cost, time to first token and wall time of every step to, as CSV if it ends with .csv and as JSON lines otherwise.",
     ),
 ):
 
@@ -335,17 +366,29 @@ def main(  # Main CLI function
     if improve_mode and (clarify_mode or lite_mode):  # Check incompatible modes
         typer.echo("Error: Clarify and lite mode are not compatible with improve mode.")  # Print error
         raise typer.Exit(code=1)  # Exit with error
+    if edit_format and edit_format not in EDIT_FORMATS:  # Check the edit format
+        typer.echo(f"Error: The edit format must be one of {', '.join(EDIT_FORMATS)}.")  # Print error
+        raise typer.Exit(code=1)  # Exit with error
+    if retry_context and retry_context not in RETRY_CONTEXTS:  # Check the retry context
+        typer.echo(f"Error: The retry context must be one of {', '.join(RETRY_CONTEXTS)}.")  # Print error
+        raise typer.Exit(code=1)  # Exit with error
 
     # Set up logging
     logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO)  # Configure logging
-    if use_cache:  # If caching is enabled
-        set_llm_cache(SQLiteCache(database_path=".langchain.db"))  # Set up cache
     if improve_mode:  # If in improve mode
         assert not (  # Verify mode compatibility
             clarify_mode or lite_mode
         ), "Clarify and lite mode are not active for improve mode"
 
     load_env_if_needed()  # Load environment variables
+    warm_up([model])  # Load the tokenizer in the background, it is first needed after the first completion
+
+    if diff_workers:  # If parallel diff processing is requested
+        set_diff_workers(diff_workers)  # Override ESPADA_DIFF_WORKERS
+    if edit_format:  # If an edit format is requested
+        set_edit_format(edit_format)  # Override ESPADA_EDIT_FORMAT
+    if retry_context:  # If a retry context is requested
+        set_retry_context(retry_context)  # Override ESPADA_RETRY_CONTEXT
 
     if llm_via_clipboard:  # If using clipboard
         ai = ClipboardAI()  # Create clipboard AI
@@ -354,6 +397,8 @@ def main(  # Main CLI function
             model_name=model,  # Set model name
             temperature=temperature,  # Set temperature
             azure_endpoint=azure_endpoint,  # Set Azure endpoint
+            cache=LLMCache() if use_cache else None,  # Set response cache
+            structured_output=structured_output,  # Emit files and diffs as tool calls
         )
 
     path = Path(project_path)  # Create path object
@@ -441,10 +486,14 @@ def main(  # Main CLI function
 
         files.push(files_dict)  # Push changes to file store
 
-    if ai.token_usage_log.is_openai_model():  # If using OpenAI model
-        print("Total api cost: $ ", ai.token_usage_log.usage_cost())  # Print API cost
-    elif os.getenv("LOCAL_MODEL"):  # If using local model
+    if usage_log:  # If a usage log is requested
+        ai.token_usage_log.export(usage_log)  # Write the usage of every step
+
+    usage_cost = ai.token_usage_log.usage_cost()  # Cost of all steps, None if the model has no known price
+    if os.getenv("LOCAL_MODEL"):  # If using local model
         print("Total api cost: $ 0.0 since we are using local LLM.")  # Print zero cost
+    elif usage_cost is not None:  # If the model has a known price
+        print(f"Total api cost: $ {usage_cost:.4f}")  # Print API cost
     else:  # If using other model
         print("Total tokens used: ", ai.token_usage_log.total_tokens())  # Print token usage
 
@@ -2,17 +2,17 @@ import importlib  # Import the importlib module for dynamic imports
 import os.path  # Import os.path for path manipulations
 import sys  # Import sys to manipulate the Python runtime environment
 
-from typing import Annotated, Optional  # Import typing for type annotations
+from typing import Annotated, List, Optional  # Import typing for type annotations
 
 import typer  # Import typer for building command-line interfaces
 
-from langchain.globals import set_llm_cache  # Import function to set LLM cache
-from langchain_community.cache import SQLiteCache  # Import SQLiteCache for caching
-
 from espada.applications.cli.main import load_env_if_needed  # Import function to load environment variables
 from espada.benchmark.bench_config import BenchConfig  # Import BenchConfig for benchmark configuration
 from espada.benchmark.benchmarks.load import get_benchmark  # Import function to load benchmarks
 from espada.benchmark.run import export_yaml_results, print_results, run  # Import functions for running benchmarks and exporting results
+from espada.core.chat_to_files import get_edit_format, set_edit_format  # Import the edit format configuration
+from espada.core.llm_cache import LLMCache, set_response_cache  # Import the LLM response cache
+from espada.core.tokenizer_registry import warm_up  # Import the background loading of tokenizers
 
 # Create a Typer app for the CLI with custom help option names
 app = typer.Typer(
@@ -59,11 +59,19 @@ def main(
             show_default=False,
         ),
     ] = True,  # Use cache flag
+    edit_format: Annotated[
+        Optional[List[str]],
+        typer.Option(
+            help="Edit format of improve mode, 'diff' or 'search_replace'. Repeat to compare formats on tokens, time and edits applied at the first attempt.",
+            show_default=False,
+        ),
+    ] = None,  # Edit formats to compare
 ):
 
     if use_cache:
-        set_llm_cache(SQLiteCache(database_path=".langchain.db"))  # Set up LLM cache
+        set_response_cache(LLMCache())  # Share the LLM response cache with every agent's AI
     load_env_if_needed()  # Load environment variables if needed
+    warm_up([os.environ.get("MODEL_NAME", "gpt-4o")])  # Load the tokenizer shared by every agent's AI in the background
     config = BenchConfig.from_toml(bench_config)  # Load benchmark configuration from TOML file
     print("using config file: " + bench_config)  # Print the config file being used
     benchmarks = list()  # Initialize list to store active benchmarks
@@ -74,6 +82,7 @@ def main(
             if specific_config.active:  # Check if the benchmark is active
                 benchmarks.append(specific_config_name)  # Add active benchmark to the list
 
+    edit_formats = edit_format or [get_edit_format()]  # Compare the given formats, or use the configured one
     for benchmark_name in benchmarks:  # Iterate over each active benchmark
         benchmark = get_benchmark(benchmark_name, config)  # Load the benchmark
         if len(benchmark.tasks) == 0:  # Check if there are no tasks in the benchmark
@@ -83,17 +92,25 @@ def main(
                 + bench_config
             )
             continue  # Skip to the next benchmark if no tasks are specified
-        agent = get_agent(path_to_agent)  # Get the agent for the benchmark
+        for current_format in edit_formats:  # Run the benchmark once per edit format
+            set_edit_format(current_format)  # Select the edit format of improve mode
+            agent = get_agent(path_to_agent)  # Get the agent for the benchmark
 
-        results = run(agent, benchmark, verbose=verbose)  # Run the benchmark with the agent
-        print(
-            f"\n--- Results for agent {path_to_agent}, benchmark: {benchmark_name} ---"
-        )
-        print_results(results)  # Print the results of the benchmark
-        print()  # Print a newline for spacing
-        benchmark_results[benchmark_name] = {
-            "detailed": [result.to_dict() for result in results]  # Store detailed results
-        }
+            results = run(agent, benchmark, verbose=verbose)  # Run the benchmark with the agent
+            # Results are told apart by edit format when several are compared
+            results_name = (
+                benchmark_name
+                if len(edit_formats) == 1
+                else f"{benchmark_name} ({current_format})"
+            )
+            print(
+                f"\n--- Results for agent {path_to_agent}, benchmark: {results_name} ---"
+            )
+            print_results(results)  # Print the results of the benchmark
+            print()  # Print a newline for spacing
+            benchmark_results[results_name] = {
+                "detailed": [result.to_dict() for result in results]  # Store detailed results
+            }
     if yaml_output is not None:  # Check if YAML output is specified
         export_yaml_results(yaml_output, benchmark_results, config.to_dict())  # Export results to YAML
 
@@ -23,11 +23,33 @@ def run(
     for task in benchmark.tasks:  # Iterate over each task in the benchmark
         print(f"--> Running task: {task.name}\n")  # Print the name of the current task
 
+        # The token log of the agent's AI, if it has one, tells the tokens and edit attempts of the task
+        token_log = getattr(getattr(agent, "ai", None), "token_usage_log", None)
+        tokens_before = token_log.total_tokens() if token_log else 0
+        steps_before = len(token_log.log()) if token_log else 0
+
         t0 = time.time()  # Record the start time
         # Use the agent to improve the initial code using the provided prompt
         files_dict = agent.improve(task.initial_code, task.prompt)
         t1 = time.time()  # Record the end time
 
+        tokens, edit_attempts = None, None
+        cost, llm_time, time_to_first_token = None, None, None
+        if token_log:
+            tokens = token_log.total_tokens() - tokens_before
+            task_log = token_log.log()[steps_before:]
+            edit_attempts = sum(usage.step_name == "_improve_loop" for usage in task_log)
+            if all(usage.in_step_cost is not None for usage in task_log):
+                cost = sum(usage.in_step_cost for usage in task_log)
+            llm_time = sum(usage.wall_time or 0.0 for usage in task_log)
+            first_token_times = [
+                usage.time_to_first_token
+                for usage in task_log
+                if usage.time_to_first_token is not None
+            ]
+            if first_token_times:
+                time_to_first_token = sum(first_token_times) / len(first_token_times)
+
         env = DiskExecutionEnv()  # Create a new disk execution environment
         env.upload(files_dict)  # Upload the improved files to the environment
 
@@ -58,6 +80,11 @@ def run(
                     for assertion_name, assertion in task.assertions.items()
                 },
                 duration=t1 - t0,  # Calculate the duration of the task
+                tokens=tokens,  # Tokens used for the task
+                edit_attempts=edit_attempts,  # Responses needed until the edits applied
+                cost=cost,  # Cost of the task in US dollars
+                llm_time=llm_time,  # Seconds spent waiting for the model
+                time_to_first_token=time_to_first_token,  # Average seconds until the first token
             )
         )
 
@@ -99,8 +126,24 @@ def print_results(results: list[TaskResult]):  # Function to print task results
         task_result for task_result in results if task_result.success_rate == 1
     ]
 
+    # Tasks whose first response applied without errors, among those with a token log
+    measured = [
+        task_result for task_result in results if task_result.edit_attempts is not None
+    ]
+    applied_first = [
+        task_result for task_result in measured if task_result.edit_attempts == 1
+    ]
+
     print("--- Results ---")  # Print results summary
     print(f"Total time: {total_time:.2f}s")  # Print total execution time
+    if measured:  # If the agent's token usage is known
+        total_tokens = sum(task_result.tokens for task_result in measured)  # Calculate total tokens
+        print(f"Total tokens: {total_tokens}")  # Print total tokens
+        print(f"Edits applied at the first attempt: {len(applied_first)}/{len(measured)}")  # Print apply success
+    priced = [task_result for task_result in results if task_result.cost is not None]
+    if priced:  # If the model has a known price
+        total_cost = sum(task_result.cost for task_result in priced)  # Calculate total cost
+        print(f"Total cost: $ {total_cost:.4f}")  # Print total cost
     print(f"Completely correct tasks: {len(correct_tasks)}/{len(results)}")  # Print number of completely correct tasks
     print(f"Total correct assertions: {correct_assertions}/{total_assertions}")  # Print number of correct assertions
     print(f"Average success rate: {avg_success_rate * 100}% on {len(results)} tasks")  # Print average success rate
@@ -118,6 +161,18 @@ def export_yaml_results(yaml_path, complete_results, config):  # Function to exp
         # Calculate the fraction of fully solved tasks
         fraction_correct = len(correct_tasks) / len(results["detailed"])
         results["fully_solved"] = fraction_correct  # Store the fraction in the results
+        # Totals, so that throughput and tasks solved per dollar can be compared
+        results["total_duration"] = sum(
+            task_result["duration"] for task_result in results["detailed"]
+        )
+        costs = [task_result.get("cost") for task_result in results["detailed"]]
+        if all(cost is not None for cost in costs):
+            results["total_cost"] = sum(costs)
+            results["solved_per_dollar"] = (
+                len(correct_tasks) / results["total_cost"]
+                if results["total_cost"]
+                else None
+            )
     complete_results["config"] = config  # Add configuration to the results
     with open(yaml_path, "w") as f:  # Open the YAML file for writing
         yaml.dump(complete_results, f, indent=4)  # Dump the results into the file with indentation
@@ -59,6 +59,15 @@ class TaskResult:
     assertion_results: dict[str, bool]
     # Duration of the task execution
     duration: float
+    # Tokens used by the agent's AI for the task, if it has one
+    tokens: Optional[int] = None
+    # Responses needed until the edits applied, retries included
+    edit_attempts: Optional[int] = None
+    # Cost of the task in US dollars, if the model has a known price
+    cost: Optional[float] = None
+    # Seconds spent waiting for the model, and until its first token on average
+    llm_time: Optional[float] = None
+    time_to_first_token: Optional[float] = None
 
     # Returns success rate from 0.00 up to 1.00
     @property
@@ -1,8 +1,10 @@
 from __future__ import annotations  # Ensures compatibility with future versions of Python
 
+import asyncio  # Importing asyncio for running blocking calls off the event loop
 import json  # Importing json for handling JSON data
 import logging  # Importing logging for logging purposes
 import os  # Importing os for interacting with the operating system
+import time  # Importing time for measuring the latency of completions
 
 from pathlib import Path  # Importing Path from pathlib for file path manipulations
 from typing import Any, List, Optional, Union  # Importing type hints from typing
@@ -11,6 +13,7 @@ import backoff  # Importing backoff for retrying functions with exponential back
 import openai  # Importing openai for interacting with OpenAI's API
 import pyperclip  # Importing pyperclip for clipboard operations
 
+from langchain.callbacks.base import BaseCallbackHandler  # Importing the base class for per-call callback handlers
 from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler  # Importing a callback handler for streaming stdout
 from langchain.chat_models.base import BaseChatModel  # Importing the base class for chat models
 from langchain.schema import (  # Importing schema-related classes and functions
@@ -23,11 +26,16 @@ from langchain.schema import (  # Importing schema-related classes and functions
 from langchain_anthropic import ChatAnthropic  # Importing ChatAnthropic for Anthropic's chat model
 from langchain_openai import AzureChatOpenAI, ChatOpenAI  # Importing Azure and OpenAI chat models
 
+from espada.core.llm_cache import LLMCache, get_response_cache  # Importing the LLM response cache
+from espada.core.rate_limiter import TokenBucketRateLimiter, get_rate_limiter  # Importing the proactive rate limiter
 from espada.core.token_usage import TokenUsageLog  # Importing TokenUsageLog for logging token usage
 
 # Type hint for a chat message
 Message = Union[AIMessage, HumanMessage, SystemMessage]
 
+# Marks a message as part of a stable prompt prefix that providers may cache
+CACHE_PREFIX_KEY = "espada_cache_prefix"
+
 # Set up logging
 logger = logging.getLogger(__name__)
 
@@ -41,29 +49,63 @@ class AI:
         azure_endpoint=None,
         streaming=True,
         vision=False,
+        cache: Optional[LLMCache] = None,
+        rate_limiter: Optional[TokenBucketRateLimiter] = None,
+        structured_output: bool = False,
     ):
 
         self.temperature = temperature
         self.azure_endpoint = azure_endpoint
         self.model_name = model_name
         self.streaming = streaming
+        # the steps ask for files and diffs as tool calls rather than in the chat
+        self.structured_output = structured_output
         self.vision = (
             ("vision-preview" in model_name)
             or ("gpt-4-turbo" in model_name and "preview" not in model_name)
             or ("claude" in model_name)
         )
+        self.cache = cache if cache is not None else get_response_cache()
+        self.rate_limiter = (
+            rate_limiter if rate_limiter is not None else get_rate_limiter(model_name)
+        )
         self.llm = self._create_chat_model()
         self.token_usage_log = TokenUsageLog(model_name)
 
         logger.debug(f"Using model {self.model_name}")
 
-    def start(self, system: str, user: Any, *, step_name: str) -> List[Message]:
+    def start(
+        self,
+        system: str,
+        user: Any,
+        *,
+        step_name: str,
+        tools: Optional[List[dict]] = None,
+    ) -> List[Message]:
 
         messages: List[Message] = [
             SystemMessage(content=system),
             HumanMessage(content=user),
         ]
-        return self.next(messages, step_name=step_name)
+        return self.next(messages, step_name=step_name, tools=tools)
+
+    async def astart(
+        self,
+        system: str,
+        user: Any,
+        *,
+        step_name: str,
+        tools: Optional[List[dict]] = None,
+    ) -> List[Message]:
+        """
+        Asynchronous counterpart of `start`. Several sessions can be awaited
+        concurrently on the same event loop, e.g. with `asyncio.gather`.
+        """
+        messages: List[Message] = [
+            SystemMessage(content=system),
+            HumanMessage(content=user),
+        ]
+        return await self.anext(messages, step_name=step_name, tools=tools)
 
     def _extract_content(self, content):
 
@@ -105,6 +147,84 @@ class AI:
         prompt: Optional[str] = None,
         *,
         step_name: str,
+        callbacks: Optional[List[BaseCallbackHandler]] = None,
+        tools: Optional[List[dict]] = None,
+    ) -> List[Message]:
+        """
+        Asks the model for the next message of the conversation.
+
+        If `tools` are given, the model must call the first one, and the arguments of
+        the call become the content of the response, as JSON.
+        """
+        messages = self._prepare_messages(messages, prompt)
+
+        timer = LatencyTimer()
+        cache_key = self._cache_key(messages, tools)
+        response = self._cache_get(cache_key)
+        usage = {"cached_response": True}
+        if response is None:
+            response = self.backoff_inference(
+                messages, callbacks=[*(callbacks or []), timer], tools=tools
+            )
+            self._cache_put(cache_key, response)
+            # only billed calls are priced and timed
+            usage = {**self._provider_token_usage(response), **timer.timings()}
+
+        self.token_usage_log.update_log(
+            messages=messages,
+            answer=response.content,
+            step_name=step_name,
+            cached_prompt_tokens=self._cached_prompt_tokens(response),
+            **usage,
+        )
+        messages.append(response)
+        logger.debug(f"Chat completion finished: {messages}")
+
+        return messages
+
+    async def anext(
+        self,
+        messages: List[Message],
+        prompt: Optional[str] = None,
+        *,
+        step_name: str,
+        callbacks: Optional[List[BaseCallbackHandler]] = None,
+        tools: Optional[List[dict]] = None,
+    ) -> List[Message]:
+        """
+        Asynchronous counterpart of `next`, using the chat model's async API.
+
+        Produces the same messages and token usage log entries as `next`, but does
+        not block the event loop while the completion is generated.
+        """
+        messages = self._prepare_messages(messages, prompt)
+
+        timer = LatencyTimer()
+        cache_key = self._cache_key(messages, tools)
+        response = await asyncio.to_thread(self._cache_get, cache_key)
+        usage = {"cached_response": True}
+        if response is None:
+            response = await self.abackoff_inference(
+                messages, callbacks=[*(callbacks or []), timer], tools=tools
+            )
+            await asyncio.to_thread(self._cache_put, cache_key, response)
+            # only billed calls are priced and timed
+            usage = {**self._provider_token_usage(response), **timer.timings()}
+
+        await self.token_usage_log.aupdate_log(
+            messages=messages,
+            answer=response.content,
+            step_name=step_name,
+            cached_prompt_tokens=self._cached_prompt_tokens(response),
+            **usage,
+        )
+        messages.append(response)
+        logger.debug(f"Chat completion finished: {messages}")
+
+        return messages
+
+    def _prepare_messages(
+        self, messages: List[Message], prompt: Optional[str]
     ) -> List[Message]:
 
         if prompt:
@@ -117,22 +237,144 @@ class AI:
 
         if not self.vision:
             messages = self._collapse_text_messages(messages)
+        if "claude" in self.model_name:
+            messages = self._add_cache_control(messages)
+        return messages
 
-        response = self.backoff_inference(messages)
+    @staticmethod
+    def _add_cache_control(messages: List[Message]) -> List[Message]:
+        """
+        Turns the messages marked with `mark_cacheable` into Anthropic cache breakpoints.
 
-        self.token_usage_log.update_log(
-            messages=messages, answer=response.content, step_name=step_name
-        )
-        messages.append(response)
-        logger.debug(f"Chat completion finished: {messages}")
+        OpenAI caches the longest previously seen prompt prefix automatically, which
+        only requires the stable messages to come first. Anthropic instead needs an
+        explicit `cache_control` on the last content block of each cacheable prefix.
+        """
+        prepared = []
+        for message in messages:
+            if not message.additional_kwargs.get(CACHE_PREFIX_KEY):
+                prepared.append(message)
+                continue
+            if isinstance(message.content, str):
+                content = [{"type": "text", "text": message.content}]
+            else:
+                content = [dict(block) for block in message.content]
+            text_blocks = [block for block in content if block.get("type") == "text"]
+            if text_blocks:
+                text_blocks[-1]["cache_control"] = {"type": "ephemeral"}
+            prepared.append(
+                message.__class__(
+                    content=content, additional_kwargs=message.additional_kwargs
+                )
+            )
+        return prepared
 
-        return messages
+    @staticmethod
+    def _cached_prompt_tokens(response: AIMessage) -> int:
+        """Returns the number of prompt tokens the provider served from its prompt cache."""
+        usage_metadata = getattr(response, "usage_metadata", None) or {}
+        input_token_details = usage_metadata.get("input_token_details") or {}
+        if input_token_details.get("cache_read"):
+            return input_token_details["cache_read"]
+        response_metadata = response.response_metadata or {}
+        anthropic_usage = response_metadata.get("usage") or {}
+        if anthropic_usage.get("cache_read_input_tokens"):
+            return anthropic_usage["cache_read_input_tokens"]
+        openai_usage = response_metadata.get("token_usage") or {}
+        prompt_tokens_details = openai_usage.get("prompt_tokens_details") or {}
+        return prompt_tokens_details.get("cached_tokens") or 0
+
+    @staticmethod
+    def _provider_token_usage(response: AIMessage) -> dict:
+        """
+        Returns the prompt and completion tokens the provider reported for the response,
+        as keyword arguments of `TokenUsageLog.update_log`, or none if it did not report them.
+        """
+        usage_metadata = getattr(response, "usage_metadata", None) or {}
+        if not usage_metadata.get("total_tokens"):
+            return {}
+        prompt_tokens = usage_metadata.get("input_tokens", 0)
+        # Anthropic counts the prompt tokens read from and written to its cache apart
+        anthropic_usage = (response.response_metadata or {}).get("usage") or {}
+        prompt_tokens += anthropic_usage.get("cache_read_input_tokens") or 0
+        prompt_tokens += anthropic_usage.get("cache_creation_input_tokens") or 0
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": usage_metadata.get("output_tokens", 0),
+        }
+
+    def _cache_key(
+        self, messages: List[Message], tools: Optional[List[dict]] = None
+    ) -> Optional[str]:
+
+        if self.cache is None:
+            return None
+        return self.cache.make_key(self.model_name, self.temperature, messages, tools)
+
+    def _cache_get(self, cache_key: Optional[str]) -> Optional[AIMessage]:
+
+        if cache_key is None:
+            return None
+        content = self.cache.get(cache_key)
+        if content is None:
+            return None
+        logger.debug("Using cached chat completion %s", cache_key)
+        return AIMessage(content=content)
+
+    def _cache_put(self, cache_key: Optional[str], response: AIMessage) -> None:
+
+        if cache_key is not None and isinstance(response.content, str):
+            self.cache.put(cache_key, response.content)
+
+    def _estimate_prompt_tokens(self, messages: List[Message]) -> int:
+
+        return self.token_usage_log.tokenizer.num_tokens_from_messages(messages)
+
+    def _settle_rate_limit(
+        self, response: Optional[AIMessage], streamed: StreamedText
+    ) -> None:
+        # The completion size is only known now, charge it to the token bucket. A call
+        # that failed, e.g. a stream interrupted by a callback, is charged the tokens
+        # streamed before
+        usage_metadata = getattr(response, "usage_metadata", None) or {}
+        completion_tokens = usage_metadata.get("output_tokens")
+        if completion_tokens is None:
+            completion_tokens = self.token_usage_log.tokenizer.num_tokens(
+                streamed.text
+                if response is None
+                else self._extract_content(response.content)
+            )
+        self.rate_limiter.settle(completion_tokens)
+
+    def _bind_tools(self, tools: Optional[List[dict]]):
+        # The model is forced to call the first tool, so that it answers in JSON
+        if not tools:
+            return self.llm
+        return self.llm.bind_tools(tools, tool_choice=tools[0]["name"])
+
+    @staticmethod
+    def _tool_call_to_content(response: AIMessage) -> AIMessage:
+        """
+        Turns a tool call into a response whose content is the JSON arguments of the
+        call, so that it is cached, logged and counted like a chat response.
+        """
+        tool_calls = getattr(response, "tool_calls", None)
+        if not tool_calls:
+            return response
+        return AIMessage(
+            content=json.dumps(tool_calls[0]["args"]),
+            response_metadata=response.response_metadata,
+            usage_metadata=response.usage_metadata,
+        )
 
     @backoff.on_exception(backoff.expo, openai.RateLimitError, max_tries=7, max_time=45)
-    def backoff_inference(self, messages):
+    def backoff_inference(self, messages, callbacks=None, tools=None):
         """
         Perform inference using the language model while implementing an exponential backoff strategy.
 
+        If a rate limiter is configured for the model, every attempt first waits until the
+        estimated prompt tokens fit the shared requests/min and tokens/min quota, so that
+        concurrent workers stay at the quota rather than being rejected by the provider.
         This function will retry the inference in case of a rate limit error from the OpenAI API.
         It uses an exponential backoff strategy, meaning the wait time between retries increases
         exponentially. The function will attempt to retry up to 7 times within a span of 45 seconds.
@@ -142,9 +384,13 @@ class AI:
         messages : List[Message]
             A list of chat messages which will be passed to the language model for processing.
 
-        callbacks : List[Callable]
-            A list of callback functions that are triggered after each inference. These functions
-            can be used for logging, monitoring, or other auxiliary tasks.
+        callbacks : List[BaseCallbackHandler], optional
+            Callback handlers for this call only, in addition to the model's own. They receive
+            the tokens as they are streamed and can be used for logging, monitoring, or
+            processing the response while it is generated.
+
+        tools : List[dict], optional
+            Tools the model is bound to for this call, it must call the first one.
 
         Returns
         -------
@@ -162,7 +408,46 @@ class AI:
         >>> messages = [SystemMessage(content="Hello"), HumanMessage(content="How's the weather?")]
         >>> response = backoff_inference(messages)
         """
-        return self.llm.invoke(messages)  # type: ignore
+        config = {"callbacks": callbacks} if callbacks else None
+        llm = self._bind_tools(tools)
+        if self.rate_limiter is None:
+            return self._tool_call_to_content(llm.invoke(messages, config=config))  # type: ignore
+        self.rate_limiter.acquire(self._estimate_prompt_tokens(messages))
+        streamed = StreamedText()
+        config = {"callbacks": [streamed, *(callbacks or [])]}
+        response = None
+        try:
+            response = self._tool_call_to_content(llm.invoke(messages, config=config))
+        finally:
+            self._settle_rate_limit(response, streamed)
+        return response  # type: ignore
+
+    @backoff.on_exception(backoff.expo, openai.RateLimitError, max_tries=7, max_time=45)
+    async def abackoff_inference(self, messages, callbacks=None, tools=None):
+        """
+        Asynchronous counterpart of `backoff_inference`.
+
+        Awaits the language model's async API with the same exponential backoff on
+        rate limit errors, sleeping with `asyncio.sleep` between retries so other
+        sessions keep running.
+        """
+        config = {"callbacks": callbacks} if callbacks else None
+        llm = self._bind_tools(tools)
+        if self.rate_limiter is None:
+            return self._tool_call_to_content(
+                await llm.ainvoke(messages, config=config)
+            )  # type: ignore
+        await self.rate_limiter.aacquire(self._estimate_prompt_tokens(messages))
+        streamed = StreamedText()
+        config = {"callbacks": [streamed, *(callbacks or [])]}
+        response = None
+        try:
+            response = self._tool_call_to_content(
+                await llm.ainvoke(messages, config=config)
+            )
+        finally:
+            await asyncio.to_thread(self._settle_rate_limit, response, streamed)
+        return response  # type: ignore
 
     @staticmethod
     def serialize_messages(messages: List[Message]) -> str:
@@ -207,6 +492,7 @@ class AI:
                 model=self.model_name,
                 temperature=self.temperature,
                 streaming=self.streaming,
+                stream_usage=not os.getenv("LOCAL_MODEL"),
                 callbacks=[StreamingStdOutCallbackHandler()],
                 max_tokens=4096,  # vision models default to low max token limits
             )
@@ -215,6 +501,8 @@ class AI:
                 model=self.model_name,
                 temperature=self.temperature,
                 streaming=self.streaming,
+                # report usage, including prompt cache hits, while streaming
+                stream_usage=not os.getenv("LOCAL_MODEL"),
                 callbacks=[StreamingStdOutCallbackHandler()],
             )
 
@@ -223,6 +511,61 @@ def serialize_messages(messages: List[Message]) -> str:
     return AI.serialize_messages(messages)
 
 
+class LatencyTimer(BaseCallbackHandler):
+    """
+    Measures the seconds from its creation to the first streamed token, text or tool
+    call, and to the complete response, as keyword arguments of `TokenUsageLog.update_log`.
+    """
+
+    # Runs on the event loop of async calls, so the tokens are timed when they arrive
+    run_inline = True
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.first_token: Optional[float] = None
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        if self.first_token is not None:
+            return
+        chunk_message = getattr(kwargs.get("chunk"), "message", None)
+        if token or getattr(chunk_message, "tool_call_chunks", None):
+            self.first_token = time.perf_counter()
+
+    def timings(self) -> dict:
+        return {
+            "time_to_first_token": (
+                None if self.first_token is None else self.first_token - self.start
+            ),
+            "wall_time": time.perf_counter() - self.start,
+        }
+
+
+class StreamedText(BaseCallbackHandler):
+    """Collects the streamed tokens, what was generated of a response that failed."""
+
+    run_inline = True
+
+    def __init__(self) -> None:
+        self._chunks: List[str] = []
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self._chunks.append(token)
+
+    @property
+    def text(self) -> str:
+        return "".join(self._chunks)
+
+
+def mark_cacheable(message: Message) -> Message:
+    """
+    Marks a message as the end of a stable prompt prefix, e.g. the system prompt or
+    the uploaded files, so the provider can serve it from its prompt cache on
+    subsequent calls.
+    """
+    message.additional_kwargs[CACHE_PREFIX_KEY] = True
+    return message
+
+
 class ClipboardAI(AI):
     # Ignore not init superclass
     def __init__(self, **_):  # type: ignore
@@ -251,9 +594,12 @@ class ClipboardAI(AI):
         prompt: Optional[str] = None,
         *,
         step_name: str,
+        callbacks: Optional[List[BaseCallbackHandler]] = None,
+        tools: Optional[List[dict]] = None,
     ) -> List[Message]:
         """
-        Not yet fully supported
+        Not yet fully supported, callbacks are ignored since nothing is streamed
+        and tools are ignored since the answer is pasted as chat
         """
         if prompt:
             messages.append(HumanMessage(content=prompt))
@@ -275,3 +621,24 @@ class ClipboardAI(AI):
         logger.debug(f"Chat completion finished: {messages}")
 
         return messages
+
+    async def anext(
+        self,
+        messages: List[Message],
+        prompt: Optional[str] = None,
+        *,
+        step_name: str,
+        callbacks: Optional[List[BaseCallbackHandler]] = None,
+        tools: Optional[List[dict]] = None,
+    ) -> List[Message]:
+        """
+        The clipboard is inherently interactive, so this simply runs `next` in a thread
+        """
+        return await asyncio.to_thread(
+            self.next,
+            messages,
+            prompt,
+            step_name=step_name,
+            callbacks=callbacks,
+            tools=tools,
+        )
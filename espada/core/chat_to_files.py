@@ -1,14 +1,25 @@
 import logging  # Importing the logging library for logging purposes
 import re  # Importing the re library for regular expressions
 import difflib  # Importing difflib for comparing sequences
+import io  # Importing io to capture the output of diff validation in worker processes
+import os  # Importing os to read the number of diff workers from the environment
 import sys  # Importing sys for system-specific parameters and functions
 
-from typing import Dict, Tuple  # Importing type hints from typing
-
-from regex import regex  # Importing the regex library for advanced regular expressions
+from concurrent.futures import ProcessPoolExecutor  # Importing ProcessPoolExecutor to process diffs of several files in parallel
+from contextlib import redirect_stdout  # Importing redirect_stdout to capture printed validation problems
+from typing import Callable, Dict, List, Optional, Tuple  # Importing type hints from typing
 
 from espada.core.diff import ADD, REMOVE, RETAIN, Diff, Hunk  # Importing constants and classes from the diff module
 from espada.core.files_dict import FilesDict, file_to_lines_dict  # Importing FilesDict and file_to_lines_dict from the files_dict module
+from espada.core.search_replace import DIVIDER_MARKER, SearchReplace  # Importing the SEARCH/REPLACE edit format
+
+DIFF_WORKERS_ENV_VAR = "ESPADA_DIFF_WORKERS"  # processes validating and applying diffs, 0 or 1 to stay in process
+EDIT_FORMAT_ENV_VAR = "ESPADA_EDIT_FORMAT"  # format of the edits in improve mode, one of EDIT_FORMATS
+
+# Formats the LLM can write its edits to existing code in
+DIFF_FORMAT = "diff"  # unified diffs
+SEARCH_REPLACE_FORMAT = "search_replace"  # SEARCH/REPLACE blocks
+EDIT_FORMATS = (DIFF_FORMAT, SEARCH_REPLACE_FORMAT)
 
 # Initialize a logger for this module
 logger = logging.getLogger(__name__)
@@ -23,24 +34,104 @@ def chat_to_files_dict(chat: str) -> FilesDict:
     files_dict = FilesDict()
     for match in matches:
         # Clean and standardize the file path
-        path = re.sub(r'[\:<>"|?*]', "", match.group(1))
-        path = re.sub(r"^\[(.*)\]$", r"\1", path)
-        path = re.sub(r"^`(.*)`$", r"\1", path)
-        path = re.sub(r"[\]\:]$", "", path)
+        path = clean_path(match.group(1))
 
         # Extract and clean the code content
         content = match.group(2)
 
         # Add the cleaned path and content to the FilesDict
-        files_dict[path.strip()] = content.strip()
+        files_dict[path] = content.strip()
 
     return files_dict
 
 
+def clean_path(path: str) -> str:
+    """Strips the quotes, brackets and punctuation LLMs put around file paths."""
+    path = re.sub(r'[\:<>"|?*]', "", path)
+    path = re.sub(r"^\[(.*)\]$", r"\1", path)
+    path = re.sub(r"^`(.*)`$", r"\1", path)
+    path = re.sub(r"[\]\:]$", "", path)
+    return path.strip()
+
+
+def parse_edits(chat: str) -> Dict[str, List[SearchReplace]]:
+    """
+    Parses the SEARCH/REPLACE blocks of an LLM response, keyed by file name in order of
+    appearance. A block belongs to the file named on the last line before it, outside
+    of any block, which is usually the line before the opening ```. Unterminated blocks
+    are dropped.
+    """
+    edits: Dict[str, List[SearchReplace]] = {}
+    filename = None
+    section = None  # None outside of a block, else the lines of the current section
+    search_lines: List[str] = []
+    replace_lines: List[str] = []
+    for line in chat.split("\n"):
+        stripped = line.strip()
+        if section is None:
+            if stripped.startswith("<<<<<<<") and stripped.endswith("SEARCH"):
+                search_lines, replace_lines = [], []
+                section = search_lines
+            elif stripped and not stripped.startswith("```"):
+                filename = clean_path(stripped)
+        elif section is search_lines and stripped == DIVIDER_MARKER:
+            section = replace_lines
+        elif section is replace_lines and (
+            stripped.startswith(">>>>>>>") and stripped.endswith("REPLACE")
+        ):
+            if filename:
+                edits.setdefault(filename, []).append(
+                    SearchReplace(filename, search_lines, replace_lines)
+                )
+            section = None
+        else:
+            section.append(line)
+    return edits
+
+
+def apply_edits(
+    edits: Dict[str, List[SearchReplace]], files: FilesDict
+) -> Tuple[FilesDict, List[str]]:
+    """
+    Applies SEARCH/REPLACE edits to the files in order and returns the new files with
+    the problems of the edits that could not be applied, which are skipped.
+    """
+    files = files.copy()
+    problems = []
+    for filename, file_edits in edits.items():
+        lines = files[filename].split("\n") if filename in files else None
+        # edits are expected in the order of the file, searched from the last one on
+        position = 0
+        for edit in file_edits:
+            if edit.creates_file():
+                if lines is None or lines == [""]:
+                    lines = list(edit.replace_lines)
+                else:
+                    lines.extend(edit.replace_lines)
+                position = len(lines)
+                continue
+            if lines is None:
+                problems.append(
+                    f"In {edit.to_string()}\n:The file {filename} does not exist, an empty SEARCH section creates it"
+                )
+                continue
+            found = edit.locate(lines, position)
+            if found is None:
+                problems.append(
+                    f"In {edit.to_string()}\n:The SEARCH section was not found in the code"
+                )
+                continue
+            first, end, replacement = found
+            lines[first:end] = replacement
+            position = first + len(replacement)
+        if lines is not None:
+            files[filename] = "\n".join(lines)
+    return files, problems
+
+
 def apply_diffs(diffs: Dict[str, Diff], files: FilesDict) -> FilesDict:
 
-    files = FilesDict(files.copy())
-    REMOVE_FLAG = "<REMOVE_LINE>"  # Placeholder to mark lines for removal
+    files = files.copy()
     for diff in diffs.values():
         if diff.is_new_file():
             # If it's a new file, create it with the content from the diff
@@ -48,65 +139,184 @@ def apply_diffs(diffs: Dict[str, Diff], files: FilesDict) -> FilesDict:
                 line[1] for hunk in diff.hunks for line in hunk.lines
             )
         else:
-            # Convert the file content to a dictionary of lines
-            line_dict = file_to_lines_dict(files[diff.filename_pre])
-            for hunk in diff.hunks:
-                current_line = hunk.start_line_pre_edit
-                for line in hunk.lines:
-                    if line[0] == RETAIN:
-                        current_line += 1
-                    elif line[0] == ADD:
-                        # Handle added lines
-                        current_line -= 1
-                        if (
-                            current_line in line_dict.keys()
-                            and line_dict[current_line] != REMOVE_FLAG
-                        ):
-                            line_dict[current_line] += "\n" + line[1]
-                        else:
-                            line_dict[current_line] = line[1]
-                        current_line += 1
-                    elif line[0] == REMOVE:
-                        # Mark removed lines with REMOVE_FLAG
-                        line_dict[current_line] = REMOVE_FLAG
-                        current_line += 1
-
-            # Remove lines marked for removal
-            line_dict = {
-                key: line_content
-                for key, line_content in line_dict.items()
-                if REMOVE_FLAG not in line_content
-            }
-            # Reassemble the file content
-            files[diff.filename_post] = "\n".join(line_dict.values())
+            files[diff.filename_post] = apply_hunks(
+                files[diff.filename_pre], diff.hunks
+            )
     return files
 
 
-def parse_diffs(diff_string: str, diff_timeout=3) -> dict:
+_diff_workers: Optional[int] = None
 
-    # Regex to match individual diff blocks
-    diff_block_pattern = regex.compile(
-        r"```.*?\n\s*?--- .*?\n\s*?\+\+\+ .*?\n(?:@@ .*? @@\n(?:[-+ ].*?\n)*?)*?```",
-        re.DOTALL,
-    )
 
-    diffs = {}
-    try:
-        for block in diff_block_pattern.finditer(diff_string, timeout=diff_timeout):
-            diff_block = block.group()
+def set_diff_workers(workers: Optional[int]) -> None:
+    """Sets the number of processes used by `validate_and_apply_diffs`, overriding ESPADA_DIFF_WORKERS."""
+    global _diff_workers
+    _diff_workers = workers
 
-            # Parse individual diff blocks and update the diffs dictionary
-            diff = parse_diff_block(diff_block)
-            for filename, diff_obj in diff.items():
-                if filename not in diffs:
-                    diffs[filename] = diff_obj
-                else:
-                    print(
-                        f"\nMultiple diffs found for {filename}. Only the first one is kept.",
-                        file=sys.stderr
+
+def get_diff_workers() -> int:
+    if _diff_workers is not None:
+        return _diff_workers
+    return int(os.getenv(DIFF_WORKERS_ENV_VAR, "") or 0)
+
+
+_edit_format: Optional[str] = None
+
+
+def set_edit_format(edit_format: Optional[str]) -> None:
+    """Sets the format of the edits in improve mode, overriding ESPADA_EDIT_FORMAT."""
+    if edit_format is not None and edit_format not in EDIT_FORMATS:
+        raise ValueError(
+            f"Unknown edit format {edit_format}, expected one of {', '.join(EDIT_FORMATS)}"
+        )
+    global _edit_format
+    _edit_format = edit_format
+
+
+def get_edit_format() -> str:
+    edit_format = _edit_format or os.getenv(EDIT_FORMAT_ENV_VAR, "") or DIFF_FORMAT
+    if edit_format not in EDIT_FORMATS:
+        raise ValueError(
+            f"Unknown edit format {edit_format} in {EDIT_FORMAT_ENV_VAR}, expected one of {', '.join(EDIT_FORMATS)}"
+        )
+    return edit_format
+
+
+def validate_and_apply_diffs(
+    diffs: Dict[str, Diff],
+    files: FilesDict,
+    validate: bool = True,
+    workers: Optional[int] = None,
+) -> Tuple[FilesDict, List[str]]:
+    """
+    Validates and corrects the diffs against the files, unless `validate` is False, and applies them.
+
+    With more than one worker, every edited file is validated and patched in its own task of a
+    process pool. Corrected diffs replace those in `diffs`, and problems and printed output are
+    merged in the order of the diffs, so the result is identical to the sequential path.
+    """
+    workers = get_diff_workers() if workers is None else workers
+    edits = [(key, diff) for key, diff in diffs.items() if not diff.is_new_file()]
+    if workers <= 1 or len(edits) <= 1 or _reads_edited_file(diffs):
+        problems = []
+        if validate:
+            for _, diff in edits:
+                problems.extend(
+                    diff.validate_and_correct(
+                        file_to_lines_dict(files[diff.filename_pre])
                     )
-    except TimeoutError:
-        print("espada timed out while parsing git diff")
+                )
+        return apply_diffs(diffs, files), problems
+
+    with ProcessPoolExecutor(min(workers, len(edits))) as pool:
+        results = list(
+            pool.map(
+                _validate_and_apply_diff,
+                [diff for _, diff in edits],
+                [files[diff.filename_pre] for _, diff in edits],
+                [validate] * len(edits),
+            )
+        )
+
+    problems = []
+    contents = {}
+    for (key, _), (diff, diff_problems, output, content) in zip(edits, results):
+        diffs[key] = diff
+        sys.stdout.write(output)
+        problems.extend(diff_problems)
+        contents[key] = content
+
+    files = files.copy()
+    for key, diff in diffs.items():
+        if diff.is_new_file():
+            files[diff.filename_post] = "\n".join(
+                line[1] for hunk in diff.hunks for line in hunk.lines
+            )
+        else:
+            files[diff.filename_post] = contents[key]
+    return files, problems
+
+
+def _reads_edited_file(diffs: Dict[str, Diff]) -> bool:
+    # such a diff must see the output of an earlier one, which only the sequential path provides
+    written = set()
+    for diff in diffs.values():
+        if not diff.is_new_file() and diff.filename_pre in written:
+            return True
+        written.add(diff.filename_post)
+    return False
+
+
+def _validate_and_apply_diff(
+    diff: Diff, file_content: str, validate: bool
+) -> Tuple[Diff, List[str], str, str]:
+    output = io.StringIO()
+    problems = []
+    if validate:
+        with redirect_stdout(output):
+            problems = diff.validate_and_correct(file_to_lines_dict(file_content))
+    return diff, problems, output.getvalue(), apply_hunks(file_content, diff.hunks)
+
+
+def apply_hunks(file_content: str, hunks: List[Hunk]) -> str:
+    """
+    Applies the hunks of a diff to a file in a single forward pass.
+
+    Lines are numbered from 1 as in `file_to_lines_dict`. An added line is placed after
+    the line preceding the current position, or in its place if that line was removed.
+    Every hunk line and every file line is visited once, so the cost is linear in the
+    size of the file plus the size of the diff.
+    """
+    # slot 0 holds lines added before the first line, None marks a removed line
+    lines: List[Optional[str]] = [None] + file_content.split("\n")
+    added: Dict[int, List[str]] = {}  # lines added after an existing line
+    # lines edited outside of the file, kept in order of appearance after the last line
+    outside: Dict[int, Optional[List[str]]] = {}
+    n_lines = len(lines) - 1
+
+    for hunk in hunks:
+        current_line = hunk.start_line_pre_edit
+        for category, content in hunk.lines:
+            if category == RETAIN:
+                current_line += 1
+            elif category == ADD:
+                target = current_line - 1
+                if not 0 <= target <= n_lines:
+                    if outside.get(target) is None:
+                        outside[target] = [content]
+                    else:
+                        outside[target].append(content)
+                elif lines[target] is None:
+                    lines[target] = content
+                else:
+                    added.setdefault(target, []).append(content)
+            elif category == REMOVE:
+                if 0 <= current_line <= n_lines:
+                    lines[current_line] = None
+                    added.pop(current_line, None)
+                else:
+                    outside[current_line] = None
+                current_line += 1
+
+    patched = []
+    for line_number, line in enumerate(lines):
+        if line is not None:
+            patched.append(line)
+            patched.extend(added.get(line_number, ()))
+    for outside_lines in outside.values():
+        if outside_lines is not None:
+            patched.extend(outside_lines)
+    return "\n".join(patched)
+
+
+def parse_diffs(diff_string: str, diff_timeout=3) -> dict:
+    """
+    Parses all diffs in an LLM response in a single pass over its lines.
+    `diff_timeout` is kept for compatibility only, parsing takes linear time.
+    """
+    parser = DiffStreamParser()
+    parser.feed(diff_string)
+    diffs = parser.close()
 
     if not diffs:
         print(
@@ -116,53 +326,134 @@ def parse_diffs(diff_string: str, diff_timeout=3) -> dict:
     return diffs
 
 
-def parse_diff_block(diff_block: str) -> dict:
-
-    lines = diff_block.strip().split("\n")[1:-1]  # Exclude the opening and closing ```
-    diffs = {}
-    current_diff = None
-    hunk_lines = []
-    filename_pre = None
-    filename_post = None
-    hunk_header = None
-
-    for line in lines:
-        if line.startswith("--- "):
+class DiffStreamParser:
+    """
+    Incremental parser for the diffs in an LLM response.
+
+    Text can be fed in chunks of any size, e.g. the tokens of a streamed completion.
+    Lines are classified as they complete, using the ``` fences, the ---/+++ file
+    headers and the @@ hunk headers, so each hunk can be handed to `on_hunk` as soon
+    as the next line closes it, and each diff to `on_diff` once its block is closed.
+    Every line is looked at once, so parsing takes linear time in the response length.
+    """
+
+    OUTSIDE = "outside"  # prose between code blocks
+    FENCE = "fence"  # right after an opening ```, waiting for a --- header
+    CODE = "code"  # inside a code block that is not a diff
+    HEADER = "header"  # after a --- header, waiting for the +++ header
+    DIFF = "diff"  # inside a diff block
+
+    def __init__(
+        self,
+        on_hunk: Optional[Callable[[Diff, Hunk], None]] = None,
+        on_diff: Optional[Callable[[Diff], None]] = None,
+    ):
+        self.on_hunk = on_hunk
+        self.on_diff = on_diff
+        self.diffs: Dict[str, Diff] = {}
+        self._partial_line = ""
+        self._state = self.OUTSIDE
+        self._block_diffs: Dict[str, Diff] = {}
+        self._current_diff: Optional[Diff] = None
+        self._filename_pre = None
+        self._hunk_header = None
+        self._hunk_lines = []
+
+    def feed(self, text: str) -> None:
+        """Consumes the next chunk of the response."""
+        *lines, self._partial_line = (self._partial_line + text).split("\n")
+        for line in lines:
+            self._process_line(line)
+
+    def close(self) -> Dict[str, Diff]:
+        """Consumes the rest of the response and returns all diffs, keyed by file name."""
+        if self._partial_line:
+            self._process_line(self._partial_line)
+            self._partial_line = ""
+        # a block without closing fence is incomplete and therefore discarded
+        self._state = self.OUTSIDE
+        return self.diffs
+
+    def _process_line(self, line: str) -> None:
+        if self._state == self.OUTSIDE:
+            if line.lstrip().startswith("```"):
+                self._state = self.FENCE
+        elif self._state == self.FENCE:
+            if line.lstrip().startswith("--- "):
+                self._filename_pre = line.lstrip()[4:]
+                self._state = self.HEADER
+            elif line.startswith("```"):
+                self._state = self.OUTSIDE
+            elif line.strip():
+                self._state = self.CODE
+        elif self._state == self.CODE:
+            if line.startswith("```"):
+                self._state = self.OUTSIDE
+        elif self._state == self.HEADER:
+            if line.lstrip().startswith("+++ "):
+                self._start_diff(line.lstrip()[4:])
+                self._state = self.DIFF
+            elif line.startswith("```"):
+                self._state = self.OUTSIDE
+            elif line.strip():
+                self._state = self.CODE
+        elif line.startswith("```"):
+            self._close_block()
+            self._state = self.OUTSIDE
+        elif line.startswith("--- "):
             # Pre-edit filename
-            filename_pre = line[4:]
+            self._filename_pre = line[4:]
         elif line.startswith("+++ "):
             # Post-edit filename and initiation of a new Diff object
-            if (
-                filename_post is not None
-                and current_diff is not None
-                and hunk_header is not None
-            ):
-                current_diff.hunks.append(Hunk(*hunk_header, hunk_lines))
-                hunk_lines = []
-            filename_post = line[4:]
-            current_diff = Diff(filename_pre, filename_post)
-            diffs[filename_post] = current_diff
+            self._finish_hunk()
+            self._start_diff(line[4:])
         elif line.startswith("@@ "):
             # Start of a new hunk in the diff
-            if hunk_lines and current_diff is not None and hunk_header is not None:
-                current_diff.hunks.append(Hunk(*hunk_header, hunk_lines))
-                hunk_lines = []
-            hunk_header = parse_hunk_header(line)
+            self._finish_hunk()
+            self._hunk_header = parse_hunk_header(line)
+        elif self._hunk_header is None:
+            # lines before the first hunk header do not belong to any hunk
+            pass
         elif line.startswith("+"):
-            # Added line
-            hunk_lines.append((ADD, line[1:]))
+            self._hunk_lines.append((ADD, line[1:]))
         elif line.startswith("-"):
-            # Removed line
-            hunk_lines.append((REMOVE, line[1:]))
+            self._hunk_lines.append((REMOVE, line[1:]))
         else:
-            # Retained line
-            hunk_lines.append((RETAIN, line[1:]))
-
-    # Append the last hunk if any
-    if current_diff is not None and hunk_lines and hunk_header is not None:
-        current_diff.hunks.append(Hunk(*hunk_header, hunk_lines))
-
-    return diffs
+            self._hunk_lines.append((RETAIN, line[1:]))
+
+    def _start_diff(self, filename_post: str) -> None:
+        self._current_diff = Diff(self._filename_pre, filename_post)
+        self._block_diffs[filename_post] = self._current_diff
+        self._hunk_header = None
+
+    def _finish_hunk(self) -> None:
+        if not self._hunk_lines or self._hunk_header is None:
+            return
+        hunk = Hunk(*self._hunk_header, self._hunk_lines)
+        self._hunk_lines = []
+        self._current_diff.hunks.append(hunk)
+        # diffs of files that already have a diff are discarded, no need to validate them
+        if self.on_hunk is not None and self._current_diff.filename_post not in self.diffs:
+            self.on_hunk(self._current_diff, hunk)
+
+    def _close_block(self) -> None:
+        # Append the last hunk if any
+        self._finish_hunk()
+        for filename, diff in self._block_diffs.items():
+            if filename not in self.diffs:
+                self.diffs[filename] = diff
+                if self.on_diff is not None:
+                    self.on_diff(diff)
+            else:
+                print(
+                    f"\nMultiple diffs found for {filename}. Only the first one is kept.",
+                    file=sys.stderr,
+                )
+        self._block_diffs = {}
+        self._current_diff = None
+        self._filename_pre = None
+        self._hunk_header = None
+        self._hunk_lines = []
 
 
 def parse_hunk_header(header_line) -> Tuple[int, int, int, int]:
@@ -6,3 +6,15 @@ MAX_EDIT_REFINEMENT_STEPS : int
     The maximum number of refinement steps allowed when generating edit blocks.
 """
 MAX_EDIT_REFINEMENT_STEPS = 2
+
+"""
+WHOLE_FILE_MAX_TOKENS : int
+    Files up to this many tokens are asked for in full instead of as diffs in improve mode, as long as no diffs failed before.
+"""
+WHOLE_FILE_MAX_TOKENS = 400
+
+"""
+RETRY_CONTEXT_LINES : int
+    Lines of code shown before and after each failed hunk when a retry only sends the failing parts of the files.
+"""
+RETRY_CONTEXT_LINES = 10
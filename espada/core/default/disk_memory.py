@@ -7,6 +7,7 @@ from pathlib import Path  # Importing Path for file path manipulations
 from typing import Any, Dict, Iterator, Optional, Union  # Importing typing for type hinting
 
 from espada.core.base_memory import BaseMemory  # Importing BaseMemory as a base class for memory operations
+from espada.core.image_info import register_image  # Importing register_image to cache the size of loaded images
 from espada.tools.supported_languages import SUPPORTED_LANGUAGES  # Importing supported languages for file extension validation
 
 
@@ -32,9 +33,12 @@ class DiskMemory(BaseMemory):
 
         if full_path.suffix in [".png", ".jpeg", ".jpg"]:  # Check if the file is an image
             with full_path.open("rb") as image_file:  # Open the image file in binary mode
-                encoded_string = base64.b64encode(image_file.read()).decode("utf-8")  # Encode the image to base64
-                mime_type = "image/png" if full_path.suffix == ".png" else "image/jpeg"  # Determine the MIME type
-                return f"data:{mime_type};base64,{encoded_string}"  # Return the base64 encoded image
+                image_data = image_file.read()  # Read the raw image
+            encoded_string = base64.b64encode(image_data).decode("utf-8")  # Encode the image to base64
+            mime_type = "image/png" if full_path.suffix == ".png" else "image/jpeg"  # Determine the MIME type
+            data_url = f"data:{mime_type};base64,{encoded_string}"
+            register_image(data_url, image_data)  # Cache the size read from the raw header for token accounting
+            return data_url  # Return the base64 encoded image
         else:
             with full_path.open("r", encoding="utf-8") as f:  # Open the file in text mode
                 return f.read()  # Return the file content
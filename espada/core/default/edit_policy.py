@@ -0,0 +1,106 @@
+"""
+Chooses per file whether improve mode asks for a diff or for the whole new file.
+
+Rewriting a small file costs few completion tokens and cannot fail to apply, while
+a diff of it costs nearly as much once its headers and context lines are counted,
+and another round trip whenever it does not apply. Large files are still edited
+with diffs. The more often diffs needed a retry so far, as counted in the diff
+stats of the project memory, the larger the files that are asked for in full. The
+counts are kept outside of the logs, which are archived at the start of every run.
+
+It also chooses what a retry sends when some edits did not apply: the full history,
+or only the failing files around the failed hunks, see ESPADA_RETRY_CONTEXT.
+"""
+
+import json  # Importing json for the diff stats
+import os  # Importing os to read the retry context from the environment
+
+from typing import Callable, List, Optional  # Importing type hints from typing
+
+from espada.core.base_memory import BaseMemory  # Importing BaseMemory for the diff log
+from espada.core.default.constants import (  # Importing the limits of the edit loop
+    MAX_EDIT_REFINEMENT_STEPS,
+    WHOLE_FILE_MAX_TOKENS,
+)
+from espada.core.default.paths import DIFF_STATS_FILE  # Importing the diff stats name
+from espada.core.files_dict import FilesDict  # Importing FilesDict for the files
+
+RETRY_CONTEXT_ENV_VAR = "ESPADA_RETRY_CONTEXT"  # what a retry sends, one of RETRY_CONTEXTS
+
+# What a retry of failed edits sends to the model
+FULL_CONTEXT = "full"  # the whole conversation, with the uploaded files and all previous answers
+DELTA_CONTEXT = "delta"  # excerpts of the failing files around the failed hunks, and the failed hunks
+RETRY_CONTEXTS = (FULL_CONTEXT, DELTA_CONTEXT)
+
+
+def _diff_stats(memory: BaseMemory) -> dict:
+    try:
+        stats = json.loads(memory.get(DIFF_STATS_FILE) or "{}")
+    except (TypeError, ValueError):
+        return {}
+    return stats if isinstance(stats, dict) else {}
+
+
+def record_diff_response(memory: BaseMemory, retried: bool) -> None:
+    """Counts a response whose edits were applied, and whether some did not apply and were retried."""
+    stats = _diff_stats(memory)
+    responses = int(stats.get("responses", 0)) + 1
+    retries = int(stats.get("retries", 0)) + retried
+    memory[DIFF_STATS_FILE] = json.dumps({"responses": responses, "retries": retries})
+
+
+def diff_retry_rate(memory: BaseMemory) -> Optional[float]:
+    """
+    Returns the share of the recorded responses whose edits did not all apply and
+    were retried, or None if nothing has been recorded yet.
+    """
+    stats = _diff_stats(memory)
+    responses = stats.get("responses")
+    if not responses:
+        return None
+    return stats.get("retries", 0) / responses
+
+
+def whole_file_max_tokens(retry_rate: Optional[float]) -> int:
+    """Returns the size up to which files are asked for in full, given the retry rate of diffs."""
+    # a diff that fails costs up to MAX_EDIT_REFINEMENT_STEPS more responses
+    expected_responses = 1 + (retry_rate or 0) * MAX_EDIT_REFINEMENT_STEPS
+    return round(WHOLE_FILE_MAX_TOKENS * expected_responses)
+
+
+def choose_whole_files(
+    files_dict: FilesDict,
+    num_tokens: Callable[[str], int],
+    retry_rate: Optional[float] = None,
+) -> List[str]:
+    """Returns the names of the files to ask for in full, the others are edited with diffs."""
+    max_tokens = whole_file_max_tokens(retry_rate)
+    return [
+        file_name
+        for file_name, content in files_dict.items()
+        if num_tokens(content) <= max_tokens
+    ]
+
+
+_retry_context: Optional[str] = None
+
+
+def set_retry_context(retry_context: Optional[str]) -> None:
+    """Sets what a retry of failed edits sends, overriding ESPADA_RETRY_CONTEXT."""
+    if retry_context is not None and retry_context not in RETRY_CONTEXTS:
+        raise ValueError(
+            f"Unknown retry context {retry_context}, expected one of {', '.join(RETRY_CONTEXTS)}"
+        )
+    global _retry_context
+    _retry_context = retry_context
+
+
+def get_retry_context() -> str:
+    retry_context = (
+        _retry_context or os.getenv(RETRY_CONTEXT_ENV_VAR, "") or FULL_CONTEXT
+    )
+    if retry_context not in RETRY_CONTEXTS:
+        raise ValueError(
+            f"Unknown retry context {retry_context} in {RETRY_CONTEXT_ENV_VAR}, expected one of {', '.join(RETRY_CONTEXTS)}"
+        )
+    return retry_context
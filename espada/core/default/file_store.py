@@ -1,9 +1,10 @@
+import shutil  # Importing shutil for copying files that were not read
 import tempfile  # Importing tempfile for creating temporary directories
 
 from pathlib import Path  # Importing Path for file path manipulations
 from typing import Union  # Importing Union for type hinting
 
-from espada.core.files_dict import FilesDict  # Importing FilesDict for file dictionary operations
+from espada.core.files_dict import FilesDict, LazyFilesDict  # Importing FilesDict and its lazily read variant
 from espada.core.linting import Linting  # Importing Linting for code linting operations
 
 
@@ -21,11 +22,17 @@ class FileStore:
 
     def push(self, files: FilesDict):
         # Save files to the working directory
-        for name, content in files.items():
+        for name in files:
             path = self.working_dir / name  # Determine the file path
+            source = files.source_path(name)  # Files that were not read are copied on disk
+            if source is not None and source.resolve() == path.resolve():
+                continue  # The file is already there, unchanged
             path.parent.mkdir(parents=True, exist_ok=True)  # Create parent directories if needed
+            if source is not None:
+                shutil.copyfile(source, path)  # Copy the file without reading it
+                continue
             with open(path, "w", encoding="utf-8") as f:  # Open the file for writing
-                f.write(content)  # Write the file content
+                f.write(files[name])  # Write the file content
         return self  # Return the FileStore instance
 
     def linting(self, files: FilesDict) -> FilesDict:
@@ -35,13 +42,10 @@ class FileStore:
 
     def pull(self) -> FilesDict:
         # Retrieve files from the working directory
-        files = {}  # Initialize a dictionary to store file contents
-        for path in self.working_dir.glob("**/*"):  # Iterate over all files in the directory
-            if path.is_file():  # Check if the path is a file
-                with open(path, "r") as f:  # Open the file for reading
-                    try:
-                        content = f.read()  # Read the file content
-                    except UnicodeDecodeError:
-                        content = "binary file"  # Handle binary files
-                    files[str(path.relative_to(self.working_dir))] = content  # Store the content in the dictionary
-        return FilesDict(files)  # Return the files as a FilesDict
+        # Files are only listed here and read on first access, binary files read as "binary file"
+        names = [
+            str(path.relative_to(self.working_dir))
+            for path in self.working_dir.glob("**/*")
+            if path.is_file()
+        ]
+        return LazyFilesDict.from_paths(self.working_dir, names, undecodable="binary file")
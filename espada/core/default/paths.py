@@ -8,6 +8,8 @@ MEMORY_REL_PATH = os.path.join(META_DATA_REL_PATH, "memory")  # Relative path to
 CODE_GEN_LOG_FILE = "all_output.txt"  # File name for the code generation log
 IMPROVE_LOG_FILE = "improve.txt"  # File name for the improvement log
 DIFF_LOG_FILE = "diff_errors.txt"  # File name for the diff errors log
+DIFF_STATS_FILE = "diff_stats.json"  # File name for the diff retry counts, kept when the logs are archived
+HUNK_PATHS_LOG_FILE = "hunk_paths.txt"  # File name for the log of how hunks were validated
 DEBUG_LOG_FILE = "debug_log_file.txt"  # File name for the debug log
 ENTRYPOINT_FILE = "run.sh"  # File name for the entrypoint script
 ENTRYPOINT_LOG_FILE = "gen_entrypoint_chat.txt"  # File name for the entrypoint log 
@@ -5,25 +5,45 @@ import re
 import sys
 import traceback
 
+# Importing Counter for tallying how hunks were validated
+from collections import Counter
 # Importing Path for file path manipulations and type hints for type checking
 from pathlib import Path
-from typing import List, MutableMapping, Union
+from typing import Dict, List, MutableMapping, Optional, Sequence, Union
 
 # Importing message types from langchain schema
-from langchain.schema import HumanMessage, SystemMessage
+from langchain.schema import AIMessage, HumanMessage, SystemMessage
 # Importing colored for terminal text coloring
 from termcolor import colored
 
-# Importing AI class for AI operations
-from espada.core.ai import AI
+# Importing AI class for AI operations and mark_cacheable for prompt prefix caching
+from espada.core.ai import AI, mark_cacheable
 # Importing BaseExecutionEnv for execution environment operations
 from espada.core.base_execution_env import BaseExecutionEnv
 # Importing BaseMemory for memory operations
 from espada.core.base_memory import BaseMemory
 # Importing functions for handling chat to file operations
-from espada.core.chat_to_files import apply_diffs, chat_to_files_dict, parse_diffs
+from espada.core.chat_to_files import (
+    DIFF_FORMAT,
+    SEARCH_REPLACE_FORMAT,
+    apply_edits,
+    chat_to_files_dict,
+    get_edit_format,
+    parse_diffs,
+    parse_edits,
+    validate_and_apply_diffs,
+)
 # Importing constants for default settings
-from espada.core.default.constants import MAX_EDIT_REFINEMENT_STEPS
+from espada.core.default.constants import MAX_EDIT_REFINEMENT_STEPS, RETRY_CONTEXT_LINES
+# Importing the choice between diffs and whole files and of the retry context in improve mode
+from espada.core.default.edit_policy import (
+    DELTA_CONTEXT,
+    FULL_CONTEXT,
+    choose_whole_files,
+    diff_retry_rate,
+    get_retry_context,
+    record_diff_response,
+)
 # Importing paths for various log and configuration files
 from espada.core.default.paths import (
     CODE_GEN_LOG_FILE,
@@ -31,18 +51,33 @@ from espada.core.default.paths import (
     DIFF_LOG_FILE,
     ENTRYPOINT_FILE,
     ENTRYPOINT_LOG_FILE,
+    HUNK_PATHS_LOG_FILE,
     IMPROVE_LOG_FILE,
     PREPROMPTS_PATH,
     STEPS_FILE,
     WORKSPACE_PATH,
     memory_path,
 )
-# Importing FilesDict for file dictionary operations and file_to_lines_dict for file line operations
-from espada.core.files_dict import FilesDict, file_to_lines_dict
+# Importing the names of the hunk validation paths
+from espada.core.diff import EXACT_MATCH, FUZZY_MATCH, Diff
+# Importing the streaming diff validator for validating hunks while they are generated
+from espada.core.diff_stream import DiffStreamAborted, StreamingDiffValidator
+# Importing FilesDict for file dictionary operations
+from espada.core.files_dict import FilesDict
 # Importing PrepromptsHolder for handling preprompts
 from espada.core.preprompts_holder import PrepromptsHolder
 # Importing Prompt for prompt operations
 from espada.core.prompt import Prompt
+# Importing the tools and parsers of the structured output mode
+from espada.core.structured_output import (
+    EDITS_TOOL,
+    ENTRYPOINT_TOOL,
+    FILES_TOOL,
+    edits_from_response,
+    entrypoint_from_response,
+    files_from_response,
+    tool_kwargs,
+)
 
 
 def curr_fn() -> str:
@@ -50,23 +85,51 @@ def curr_fn() -> str:
     return inspect.stack()[1].function
 
 
-def setup_sys_prompt(preprompts: MutableMapping[Union[str, Path], str]) -> str:
+def file_format_preprompt(ai: AI) -> str:
+    """Returns the name of the preprompt describing how the AI emits new files."""
+    return "file_format_tool" if getattr(ai, "structured_output", False) else "file_format"
+
+
+def setup_sys_prompt(
+    preprompts: MutableMapping[Union[str, Path], str], file_format: str = "file_format"
+) -> str:
 
     return (
         preprompts["roadmap"]
-        + preprompts["generate"].replace("FILE_FORMAT", preprompts["file_format"])
+        + preprompts["generate"].replace("FILE_FORMAT", preprompts[file_format])
         + "\nUseful to know:\n"
         + preprompts["philosophy"]
     )
 
 
+# The preprompt describing each edit format
+EDIT_FORMAT_PREPROMPTS = {
+    DIFF_FORMAT: "file_format_diff",
+    SEARCH_REPLACE_FORMAT: "file_format_search_replace",
+}
+
+
 def setup_sys_prompt_existing_code(
-    preprompts: MutableMapping[Union[str, Path], str]
+    preprompts: MutableMapping[Union[str, Path], str],
+    edit_format: str = DIFF_FORMAT,
+    whole_files: bool = False,
+    structured_output: bool = False,
 ) -> str:
 
+    improve = preprompts["improve"]
+    if edit_format == SEARCH_REPLACE_FORMAT:
+        # the improve preprompt is written for diffs
+        improve = improve.replace("the unified git diff syntax", "SEARCH/REPLACE blocks")
+    if structured_output and edit_format == DIFF_FORMAT:
+        # the edit tool takes whole files as well as diffs
+        file_format = preprompts["file_format_edit_tool"]
+    else:
+        file_format = preprompts[EDIT_FORMAT_PREPROMPTS[edit_format]]
+        if whole_files:
+            file_format += "\n" + preprompts["file_format_whole"]
     return (
         preprompts["roadmap"]
-        + preprompts["improve"].replace("FILE_FORMAT", preprompts["file_format_diff"])
+        + improve.replace("FILE_FORMAT", file_format)
         + "\nUseful to know:\n"
         + preprompts["philosophy"]
     )
@@ -78,11 +141,14 @@ def gen_code(
 
     preprompts = preprompts_holder.get_preprompts()
     messages = ai.start(
-        setup_sys_prompt(preprompts), prompt.to_langchain_content(), step_name=curr_fn()
+        setup_sys_prompt(preprompts, file_format_preprompt(ai)),
+        prompt.to_langchain_content(),
+        step_name=curr_fn(),
+        **tool_kwargs(ai, FILES_TOOL),
     )
     chat = messages[-1].content.strip()
     memory.log(CODE_GEN_LOG_FILE, "\n\n".join(x.pretty_repr() for x in messages))
-    files_dict = chat_to_files_dict(chat)
+    files_dict = files_from_response(chat)
     return files_dict
 
 
@@ -108,14 +174,16 @@ def gen_entrypoint(
         + "\nInformation about the codebase:\n\n"
         + files_dict.to_chat(),
         step_name=curr_fn(),
+        **tool_kwargs(ai, ENTRYPOINT_TOOL),
     )
     print()
     chat = messages[-1].content.strip()
-    regex = r"```\S*\n(.+?)```"
-    matches = re.finditer(regex, chat, re.DOTALL)
-    entrypoint_code = FilesDict(
-        {ENTRYPOINT_FILE: "\n".join(match.group(1) for match in matches)}
-    )
+    script = entrypoint_from_response(chat)
+    if script is None:
+        regex = r"```\S*\n(.+?)```"
+        matches = re.finditer(regex, chat, re.DOTALL)
+        script = "\n".join(match.group(1) for match in matches)
+    entrypoint_code = FilesDict({ENTRYPOINT_FILE: script})
     memory.log(ENTRYPOINT_LOG_FILE, "\n\n".join(x.pretty_repr() for x in messages))
     return entrypoint_code
 
@@ -178,65 +246,304 @@ def improve_fn(
 ) -> FilesDict:
 
     preprompts = preprompts_holder.get_preprompts()
+    edit_format = get_edit_format()
+    # Small files are asked for in full rather than as diffs, given their size in tokens
+    whole_files = []
+    token_usage_log = getattr(ai, "token_usage_log", None)
+    if edit_format == DIFF_FORMAT and token_usage_log is not None:
+        whole_files = choose_whole_files(
+            files_dict, token_usage_log.tokenizer.num_tokens, diff_retry_rate(memory)
+        )
+    # The system prompt and the uploaded files are re-sent unchanged on every retry,
+    # so they are marked as a cacheable prompt prefix
     messages = [
-        SystemMessage(content=setup_sys_prompt_existing_code(preprompts)),
+        mark_cacheable(
+            SystemMessage(
+                content=setup_sys_prompt_existing_code(
+                    preprompts,
+                    edit_format,
+                    whole_files=bool(whole_files),
+                    structured_output=getattr(ai, "structured_output", False),
+                )
+            )
+        ),
     ]
 
-    # Add files as input
-    messages.append(HumanMessage(content=f"{files_dict.to_chat()}"))
+    # Add files as input, only diffs refer to line numbers
+    messages.append(
+        mark_cacheable(
+            HumanMessage(
+                content=f"{files_dict.to_chat(line_numbers=edit_format == DIFF_FORMAT)}"
+            )
+        )
+    )
+    if whole_files:
+        messages.append(
+            HumanMessage(content="Whole files:\n" + "\n".join(whole_files))
+        )
     messages.append(HumanMessage(content=prompt.to_langchain_content()))
     memory.log(
         DEBUG_LOG_FILE,
         "UPLOADED FILES:\n" + files_dict.to_log() + "\nPROMPT:\n" + prompt.text,
     )
-    return _improve_loop(ai, files_dict, memory, messages, diff_timeout=diff_timeout)
+    return _improve_loop(
+        ai,
+        files_dict,
+        memory,
+        messages,
+        diff_timeout=diff_timeout,
+        edit_format=edit_format,
+        whole_files=whole_files,
+        retry_context=get_retry_context(),
+    )
 
 
 def _improve_loop(
-    ai: AI, files_dict: FilesDict, memory: BaseMemory, messages: List, diff_timeout=3
+    ai: AI,
+    files_dict: FilesDict,
+    memory: BaseMemory,
+    messages: List,
+    diff_timeout=3,
+    edit_format: str = DIFF_FORMAT,
+    whole_files: Sequence[str] = (),
+    retry_context: str = FULL_CONTEXT,
 ) -> FilesDict:
-    messages = ai.next(messages, step_name=curr_fn())
-    files_dict, errors = salvage_correct_hunks(
-        messages, files_dict, memory, diff_timeout=diff_timeout
+    # the system prompt and the user's request, a delta retry starts over from them
+    request = list(messages)
+    messages, files_dict, errors, diffs, aborted = _next_edits(
+        ai, messages, files_dict, memory, diff_timeout, edit_format, whole_files
     )
 
     retries = 0
     while errors and retries < MAX_EDIT_REFINEMENT_STEPS:
-        messages.append(
-            HumanMessage(
-                content="Some previously produced diffs were not on the requested format, or the code part was not found in the code. Details:\n"
+        if aborted:
+            # nothing was applied, so every diff has to be given again
+            content = (
+                "The previous response was interrupted at a diff that was not on the requested format, or whose code part was not found in the code, and none of its diffs were applied. Details:\n"
+                + "\n".join(errors)
+                + "\n Provide all diffs again, making sure that the failing one is now on the correct format and can be found in the code. Make sure to not repeat past mistakes. \n"
+            )
+        elif edit_format == SEARCH_REPLACE_FORMAT:
+            content = (
+                "Some previously produced SEARCH/REPLACE blocks were not on the requested format, or their SEARCH section was not found in the code. Details:\n"
+                + "\n".join(errors)
+                + "\n Only rewrite the problematic blocks, the others have been applied. Make sure that the SEARCH sections of the failing ones now match the code exactly. Make sure to not repeat past mistakes. \n"
+            )
+        else:
+            content = (
+                "Some previously produced diffs were not on the requested format, or the code part was not found in the code. Details:\n"
                 + "\n".join(errors)
                 + "\n Only rewrite the problematic diffs, making sure that the failing ones are now on the correct format and can be found in the code. Make sure to not repeat past mistakes. \n"
             )
-        )
-        messages = ai.next(messages, step_name=curr_fn())
-        files_dict, errors = salvage_correct_hunks(
-            messages, files_dict, memory, diff_timeout
+        if retry_context == DELTA_CONTEXT and diffs:
+            # drop the uploaded files and the previous answers if the failing parts are known
+            messages = _delta_context(request, diffs, files_dict) or messages
+        messages.append(HumanMessage(content=content))
+        messages, files_dict, errors, diffs, aborted = _next_edits(
+            ai, messages, files_dict, memory, diff_timeout, edit_format, whole_files
         )
         retries += 1
 
     return files_dict
 
 
+def _delta_context(
+    request: List, diffs: Dict[str, Diff], files_dict: FilesDict
+) -> Optional[List]:
+    """
+    Returns the conversation a delta retry continues: the system prompt, the failing
+    files around their failed hunks, the user's request and the failed hunks as the
+    previous answer. None if no hunk failed, e.g. when a whole diff could not be parsed.
+    """
+    failed_diffs = [diff for diff in diffs.values() if diff.failed_hunks]
+    if not failed_diffs:
+        return None
+    excerpts = "".join(
+        _failed_hunk_excerpt(diff, files_dict.get(diff.filename_post, ""))
+        for diff in failed_diffs
+    )
+    failed_hunks = "\n".join(
+        "```diff\n"
+        + f"--- {diff.filename_pre}\n+++ {diff.filename_post}\n"
+        + "".join(hunk.hunk_to_string() for _, hunk in diff.failed_hunks)
+        + "```"
+        for diff in failed_diffs
+    )
+    return [
+        request[0],
+        HumanMessage(
+            content="The other diffs have been applied. Excerpts of the current code of the files whose diffs failed, "
+            + "with the same line numbers as in the files:\n```\n"
+            + excerpts
+            + "```"
+        ),
+        request[-1],
+        AIMessage(content=failed_hunks),
+    ]
+
+
+def _failed_hunk_excerpt(
+    diff: Diff, file_content: str, context_lines: int = RETRY_CONTEXT_LINES
+) -> str:
+    # The lines of the file around each failed hunk, where the hunk was placed once the
+    # applied hunks before it shifted the lines, separated by "..." where lines are left out
+    lines = file_content.split("\n")
+    windows = []
+    for start_line, hunk in diff.failed_hunks:
+        shift = sum(
+            applied.hunk_len_post_edit - applied.hunk_len_pre_edit
+            for applied in diff.hunks
+            if applied.start_line_pre_edit < start_line
+        )
+        first = min(max(1, start_line + shift - context_lines), len(lines))
+        last = min(len(lines), start_line + shift + len(hunk.lines) + context_lines)
+        windows.append((first, max(first, last)))
+    excerpt = [f"File: {diff.filename_post}"]
+    shown = 0  # last line shown so far
+    for first, last in sorted(windows):
+        first = max(first, shown + 1)
+        if first > last:
+            continue
+        if first > shown + 1:
+            excerpt.append("...")
+        excerpt.extend(
+            f"{line_number} {lines[line_number - 1]}"
+            for line_number in range(first, last + 1)
+        )
+        shown = last
+    if shown < len(lines):
+        excerpt.append("...")
+    return "\n".join(excerpt) + "\n\n"
+
+
+def _next_edits(
+    ai: AI,
+    messages: List,
+    files_dict: FilesDict,
+    memory: BaseMemory,
+    diff_timeout,
+    edit_format: str,
+    whole_files: Sequence[str] = (),
+) -> tuple[List, FilesDict, List[str], Dict[str, Diff], bool]:
+    # Asks for the next response and applies the edits in it, diffs are returned so
+    # that a retry can refer to the hunks that failed, and whether the response was
+    # interrupted, in which case none of its edits were applied
+    diff_stream = None
+    if edit_format == SEARCH_REPLACE_FORMAT:
+        messages = ai.next(messages, step_name="_improve_loop")
+        files_dict, errors = salvage_search_replace(messages, files_dict, memory)
+        diffs = {}
+    else:
+        if getattr(ai, "structured_output", False):
+            # the hunks are only parsed once the tool call is complete
+            messages = ai.next(
+                messages, step_name="_improve_loop", tools=[EDITS_TOOL]
+            )
+        else:
+            messages, diff_stream = _next_with_diff_stream(ai, messages, files_dict)
+        files_dict, errors, diffs = _salvage_diffs(
+            messages,
+            files_dict,
+            memory,
+            diff_timeout,
+            diff_stream=diff_stream,
+            whole_files=whole_files,
+        )
+    aborted = diff_stream is not None and diff_stream.aborted
+    return messages, files_dict, errors, diffs, aborted
+
+
+def _next_with_diff_stream(
+    ai: AI, messages: List, files_dict: FilesDict
+) -> tuple[List, Optional[StreamingDiffValidator]]:
+    # Without streaming there are no tokens to validate early
+    if not getattr(ai, "streaming", False):
+        return ai.next(messages, step_name="_improve_loop"), None
+
+    diff_stream = StreamingDiffValidator(files_dict)
+    try:
+        messages = ai.next(messages, step_name="_improve_loop", callbacks=[diff_stream])
+    except DiffStreamAborted:
+        # keep the interrupted response so the retry can refer to it
+        ai.token_usage_log.update_log(
+            messages=messages, answer=diff_stream.text, step_name="_improve_loop"
+        )
+        messages.append(AIMessage(content=diff_stream.text))
+    return messages, diff_stream
+
+
 def salvage_correct_hunks(
-    messages: List, files_dict: FilesDict, memory: BaseMemory, diff_timeout=3
+    messages: List,
+    files_dict: FilesDict,
+    memory: BaseMemory,
+    diff_timeout=3,
+    diff_stream: Optional[StreamingDiffValidator] = None,
+    whole_files: Sequence[str] = (),
 ) -> tuple[FilesDict, List[str]]:
+    files_dict, error_messages, _ = _salvage_diffs(
+        messages, files_dict, memory, diff_timeout, diff_stream, whole_files
+    )
+    return files_dict, error_messages
+
+
+def _salvage_diffs(
+    messages: List,
+    files_dict: FilesDict,
+    memory: BaseMemory,
+    diff_timeout=3,
+    diff_stream: Optional[StreamingDiffValidator] = None,
+    whole_files: Sequence[str] = (),
+) -> tuple[FilesDict, List[str], Dict[str, Diff]]:
     error_messages = []
     ai_response = messages[-1].content.strip()
 
-    diffs = parse_diffs(ai_response, diff_timeout=diff_timeout)
-    # validate and correct diffs
+    # diffs validated while the response was streamed are reused
+    streamed = diff_stream.result(ai_response) if diff_stream is not None else None
+    edits = edits_from_response(ai_response)
+    if edits is not None:
+        # an edit_files tool call gives the diffs and the whole files separately
+        diffs, rewrites = edits
+        files_dict, problems = validate_and_apply_diffs(diffs, files_dict)
+        error_messages.extend(problems)
+        for file_name, content in rewrites.items():
+            files_dict[file_name] = content
+    elif streamed is not None:
+        diffs, problems = streamed
+        error_messages.extend(problems)
+        files_dict, _ = validate_and_apply_diffs(diffs, files_dict, validate=False)
+    else:
+        diffs = parse_diffs(ai_response, diff_timeout=diff_timeout)
+        # validate and correct diffs, new files need neither, then apply them
+        files_dict, problems = validate_and_apply_diffs(diffs, files_dict)
+        error_messages.extend(problems)
+    if whole_files and edits is None:
+        # files asked for in full are replaced by their new content, if given
+        for file_name, content in chat_to_files_dict(ai_response).items():
+            # a diff block preceded by a file name is not a new content
+            if file_name in whole_files and not content.startswith("--- "):
+                files_dict[file_name] = content
+    memory.log(IMPROVE_LOG_FILE, "\n\n".join(x.pretty_repr() for x in messages))
+    memory.log(DIFF_LOG_FILE, "\n\n".join(error_messages))
+    record_diff_response(memory, retried=bool(error_messages))
+    hunk_paths = Counter()
+    for diff in diffs.values():
+        hunk_paths.update(diff.hunk_paths)
+    memory.log(
+        HUNK_PATHS_LOG_FILE,
+        f"{EXACT_MATCH}: {hunk_paths[EXACT_MATCH]}, {FUZZY_MATCH}: {hunk_paths[FUZZY_MATCH]}",
+    )
+    return files_dict, error_messages, diffs
 
-    for _, diff in diffs.items():
-        # if diff is a new file, validation and correction is unnecessary
-        if not diff.is_new_file():
-            problems = diff.validate_and_correct(
-                file_to_lines_dict(files_dict[diff.filename_pre])
-            )
-            error_messages.extend(problems)
-    files_dict = apply_diffs(diffs, files_dict)
+
+def salvage_search_replace(
+    messages: List, files_dict: FilesDict, memory: BaseMemory
+) -> tuple[FilesDict, List[str]]:
+    ai_response = messages[-1].content.strip()
+    edits = parse_edits(ai_response)
+    files_dict, error_messages = apply_edits(edits, files_dict)
     memory.log(IMPROVE_LOG_FILE, "\n\n".join(x.pretty_repr() for x in messages))
     memory.log(DIFF_LOG_FILE, "\n\n".join(error_messages))
+    record_diff_response(memory, retried=bool(error_messages))
     return files_dict, error_messages
 
 
@@ -1,16 +1,661 @@
 import logging  # Importing the logging library for logging purposes
 
-from collections import Counter  # Importing Counter from collections to count elements
-from typing import List  # Importing List from typing for type hinting
+from array import array  # Importing array for compact line labels
+from bisect import bisect_left, bisect_right  # Importing bisect for slicing sorted rows
+from collections import Counter, deque  # Importing Counter and deque for windows
+from collections.abc import Mapping, Sequence  # Importing the line container bases
+from typing import Dict, List, Optional, Tuple  # Importing type hints from typing
+
+try:
+    import numpy as np  # Importing numpy for vectorized similarity ratios
+except ImportError:  # numpy is optional, the ratios are then computed one by one
+    np = None
 
 # Constants representing different line categories in a hunk
 RETAIN = "retain"
 ADD = "add"
 REMOVE = "remove"
 
+LABELS = (RETAIN, ADD, REMOVE)  # line categories by the code stored for them
+LABEL_CODES = {label: code for code, label in enumerate(LABELS)}
+LINE_PREFIXES = (" ", "+", "-")  # prefixes of the lines in a diff, by code
+
+# How a hunk was validated, counted in Diff.hunk_paths
+EXACT_MATCH = "exact"  # its context is found verbatim at its start line
+FUZZY_MATCH = "fuzzy"  # it went through the similarity based correction
+
+
+class LineStore(Mapping):
+    """
+    Read-only mapping of line numbers to the lines of a file, like `file_to_lines_dict`
+    returns, backed by a list of the lines.
+
+    `from_line` returns a view of the lines from a given line number on that shares
+    the list, so cutting off the part of a file that earlier hunks have consumed is
+    free instead of copying the remaining lines into a new dict.
+    """
+
+    def __init__(self, lines: List[str], first_line: int = 1, start: Optional[int] = None):
+        self.lines = lines  # lines[i] is line number first_line + i
+        self.first_line = first_line
+        self.start = first_line if start is None else start
+
+    @classmethod
+    def from_dict(cls, lines_dict: dict) -> "LineStore":
+        """Stores the lines of a dict whose keys are consecutive line numbers."""
+        if isinstance(lines_dict, LineStore):
+            return lines_dict
+        first_line = next(iter(lines_dict), 1)
+        if any(
+            key != line_number for line_number, key in enumerate(lines_dict, first_line)
+        ):
+            raise ValueError("The lines must be numbered consecutively")
+        return cls(list(lines_dict.values()), first_line)
+
+    @property
+    def last_line(self) -> int:
+        return self.first_line + len(self.lines) - 1
+
+    def from_line(self, line_number: int) -> "LineStore":
+        """Returns a view of the lines from `line_number` on, or of these lines if later."""
+        return LineStore(self.lines, self.first_line, max(self.start, line_number))
+
+    def shares_lines(self, other) -> bool:
+        """Returns whether `other` is a view of the same lines."""
+        return isinstance(other, LineStore) and other.lines is self.lines
+
+    def __getitem__(self, line_number):
+        if isinstance(line_number, int) and self.start <= line_number <= self.last_line:
+            return self.lines[line_number - self.first_line]
+        raise KeyError(line_number)
+
+    def __contains__(self, line_number) -> bool:
+        return isinstance(line_number, int) and self.start <= line_number <= self.last_line
+
+    def __iter__(self):
+        return iter(range(self.start, self.last_line + 1))
+
+    def __len__(self) -> int:
+        return max(self.last_line - self.start + 1, 0)
+
+    def values(self) -> List[str]:
+        return self.lines[self.start - self.first_line :]
+
+    def __repr__(self) -> str:
+        return f"LineStore(lines {self.start}-{self.last_line})"
+
+
+class LineIndex:
+    """
+    Inverted index over the lines of a file, for finding the lines similar to a hunk line.
+
+    Lines are normalized as in `count_ratio` and indexed by their character counts:
+    a line is listed under (c, k) for every character c it contains at least k times.
+    A line that lacks more of these (c, k) entries of a probe than the similarity
+    threshold allows cannot be similar to it, so only the lines listed under nearly
+    all of the probe's rarest entries are compared in full. The result is the same
+    as comparing the probe to every line of the file, at a fraction of the cost.
+
+    If numpy is available, the lines are also encoded once into a matrix of character
+    histograms, so that the ratios of a probe against many lines, or of several
+    blocks against a window of lines, are computed in one vectorized operation. The
+    matrix only has columns for the characters found on the most lines, the others
+    are kept as sorted (row, count) lists, so its size stays bounded for files with
+    many distinct characters and the ratios stay exact.
+    """
+
+    PREFIX_MARGIN = 4  # rare entries looked up beyond the minimum, to narrow candidates
+    DENSE_COLUMNS = 128  # characters given a column of the histogram matrix
+
+    def __init__(self, lines_dict: dict):
+        self.lines_dict = lines_dict
+        # lines are stored by row, in the order of lines_dict
+        self._line_numbers: List[int] = list(lines_dict)
+        self._rows: Dict[int, int] = {
+            line_number: row for row, line_number in enumerate(self._line_numbers)
+        }
+        normalized_lines = [normalize_line(line) for line in lines_dict.values()]
+        self._lengths: List[int] = [len(line) for line in normalized_lines]
+        self._histograms = None
+        if np is not None:
+            self._encode(normalized_lines)
+        else:
+            self._counters = [Counter(line) for line in normalized_lines]
+            self._blank_rows = [row for row, n in enumerate(self._lengths) if n == 0]
+            self._by_char_count: Dict[tuple, list] = {}
+            for row, counter in enumerate(self._counters):
+                for char, count in counter.items():
+                    for k in range(1, count + 1):
+                        self._by_char_count.setdefault((char, k), []).append(row)
+
+    def _encode(self, normalized_lines: List[str]) -> None:
+        # One row of character counts per line, for the most common characters
+        codes = np.frombuffer(
+            "".join(normalized_lines).encode("utf-32-le", "surrogatepass"),
+            dtype=np.uint32,
+        )
+        chars, columns = np.unique(codes, return_inverse=True)
+        self._length_array = np.array(self._lengths, dtype=np.int64)
+        n_rows, n_chars = len(normalized_lines), len(chars)
+        row_ids = np.repeat(np.arange(n_rows, dtype=np.int64), self._length_array)
+        # the (row, character) pairs of the file, by row then character
+        pairs, pair_counts = np.unique(row_ids * n_chars + columns, return_counts=True)
+        pair_rows, pair_chars = np.divmod(pairs, n_chars)
+
+        # newlines never occur within a line, but they do in blocks of lines
+        n_dense = max(self.DENSE_COLUMNS - 1, 0)
+        line_counts = np.bincount(pair_chars, minlength=n_chars)
+        dense_chars = np.argsort(-line_counts, kind="stable")[:n_dense]
+        dense_columns = np.full(n_chars, -1, dtype=np.int64)
+        dense_columns[dense_chars] = np.arange(len(dense_chars))
+        char_list = [chr(code) for code in chars.tolist()]
+        self._vocabulary: Dict[str, int] = {
+            char_list[char]: column for column, char in enumerate(dense_chars.tolist())
+        }
+        self._vocabulary.setdefault("\n", len(self._vocabulary))
+
+        is_dense = dense_columns[pair_chars] >= 0
+        max_count = int(pair_counts.max()) if len(pair_counts) else 0
+        dtype = np.uint8 if max_count <= 0xFF else np.uint16 if max_count <= 0xFFFF else np.int32
+        self._histograms = np.zeros((n_rows, len(self._vocabulary)), dtype=dtype)
+        self._histograms[
+            pair_rows[is_dense], dense_columns[pair_chars[is_dense]]
+        ] = pair_counts[is_dense]
+
+        # the rows, ascending, and counts of each other character
+        self._sparse: Dict[str, tuple] = {}
+        is_sparse = ~is_dense
+        order = np.argsort(pair_chars[is_sparse], kind="stable")
+        sparse_chars = pair_chars[is_sparse][order]
+        sparse_rows = pair_rows[is_sparse][order]
+        sparse_counts = pair_counts[is_sparse][order]
+        boundaries = np.flatnonzero(np.diff(sparse_chars)) + 1
+        starts = [0, *boundaries.tolist()] if len(sparse_chars) else []
+        for start, char_rows, char_counts in zip(
+            starts, np.split(sparse_rows, boundaries), np.split(sparse_counts, boundaries)
+        ):
+            char = char_list[int(sparse_chars[start])]
+            self._sparse[char] = (char_rows.astype(np.intp), char_counts)
+
+        self._blank_rows = np.flatnonzero(self._length_array == 0)
+        # the rows listed under each (c, k) entry, filled in as probes need them
+        self._by_char_count = {}
+
+    def _sparse_counts(self, char: str, rows):
+        # The counts of a character without a column in the given rows
+        char_rows, char_counts = self._sparse[char]
+        found = np.minimum(np.searchsorted(char_rows, rows), len(char_rows) - 1)
+        return np.where(char_rows[found] == rows, char_counts[found], 0)
+
+    def _postings(self, entry: tuple):
+        # Rows of the lines that contain character c at least k times
+        if self._histograms is None:
+            return self._by_char_count.get(entry, ())
+        rows = self._by_char_count.get(entry)
+        if rows is None:
+            char, k = entry
+            column = self._vocabulary.get(char)
+            if column is not None:
+                rows = np.flatnonzero(self._histograms[:, column] >= k)
+            elif char in self._sparse:
+                char_rows, char_counts = self._sparse[char]
+                rows = char_rows[char_counts >= k]
+            else:
+                rows = np.zeros(0, dtype=np.intp)
+            self._by_char_count[entry] = rows
+        return rows
+
+    def similar_lines(
+        self,
+        probe: str,
+        lines_dict: Optional[dict] = None,
+        similarity_threshold=0.9,
+    ) -> List[int]:
+        """
+        Returns the numbers of the lines that are similar to the probe in ascending
+        order, optionally restricted to the lines of `lines_dict`.
+        """
+        if lines_dict is None:
+            lines_dict = self.lines_dict
+        probe_counter = Counter(normalize_line(probe))
+        probe_len = sum(probe_counter.values())
+        # the shorter string can be similar only if its length is within the threshold
+        min_len = similarity_threshold * probe_len - 1e-9
+        max_len = (
+            probe_len / similarity_threshold + 1e-9 if similarity_threshold else None
+        )
+        # a view of the indexed lines is a range of rows
+        first_row, last_row = 0, len(self._line_numbers) - 1
+        is_view = isinstance(self.lines_dict, LineStore) and self.lines_dict.shares_lines(
+            lines_dict
+        )
+        if is_view:
+            first_row = max(lines_dict.start - self.lines_dict.start, 0)
+            last_row = lines_dict.last_line - self.lines_dict.start
+        rows = self._candidate_rows(
+            probe_counter, probe_len, similarity_threshold, first_row, last_row
+        )
+
+        line_numbers = self._line_numbers
+        if self._histograms is not None:
+            lengths = self._length_array[rows]
+            in_range = lengths >= min_len
+            if max_len is not None:
+                in_range &= lengths <= max_len
+            rows = rows[in_range]
+            if not is_view and lines_dict is not self.lines_dict:
+                rows = np.array(
+                    [row for row in rows.tolist() if line_numbers[row] in lines_dict],
+                    dtype=np.intp,
+                )
+            ratios = self._ratios(probe_counter, probe_len, rows)
+            rows = rows[ratios >= similarity_threshold].tolist()
+            return [line_numbers[row] for row in rows]
+
+        rows = [
+            row
+            for row in rows
+            if min_len <= self._lengths[row]
+            and (max_len is None or self._lengths[row] <= max_len)
+        ]
+        if not is_view and lines_dict is not self.lines_dict:
+            rows = [row for row in rows if line_numbers[row] in lines_dict]
+        ratios = self._ratios(probe_counter, probe_len, rows)
+        return [
+            line_numbers[row]
+            for row, ratio in zip(rows, ratios)
+            if ratio >= similarity_threshold
+        ]
+
+    def ratios(self, probe: str, line_numbers: List[int]) -> List[float]:
+        """Returns `count_ratio` of the probe against each of the given lines."""
+        probe_counter = Counter(normalize_line(probe))
+        rows = [self._rows[line_number] for line_number in line_numbers]
+        return list(self._ratios(probe_counter, sum(probe_counter.values()), rows))
+
+    def block_ratios(
+        self, block_histograms: List[Counter], first_line: int, n_lines: int
+    ) -> List[float]:
+        """
+        Returns `count_ratio` of each block against the `n_lines` lines of the file
+        starting at `first_line`, joined by newlines. The blocks are given by their
+        character counts, as returned by `block_histogram`.
+        """
+        block_lengths = [sum(histogram.values()) for histogram in block_histograms]
+        last_line = first_line + n_lines - 1
+        if (
+            self._histograms is None
+            or n_lines <= 0
+            or first_line not in self._rows
+            or self._rows.get(last_line) != self._rows[first_line] + n_lines - 1
+        ):
+            window = block_histogram(
+                "\n".join(
+                    self.lines_dict[line_number]
+                    for line_number in range(first_line, first_line + n_lines)
+                )
+            )
+            window_len = sum(window.values())
+            ratios = []
+            for histogram, block_len in zip(block_histograms, block_lengths):
+                longer_length = max(block_len, window_len)
+                intersection = sum((histogram & window).values())
+                ratios.append(intersection / longer_length if longer_length else 1)
+            return ratios
+
+        first_row = self._rows[first_line]
+        window = self._histograms[first_row : first_row + n_lines].sum(
+            axis=0, dtype=np.int64
+        )
+        window[self._vocabulary["\n"]] += n_lines - 1
+        window_len = int(self._length_array[first_row : first_row + n_lines].sum())
+        window_len += n_lines - 1
+        blocks = np.zeros((len(block_histograms), len(window)), dtype=np.int64)
+        sparse_window: Dict[str, int] = {}
+        sparse_intersections = np.zeros(len(block_histograms), dtype=np.int64)
+        for index, histogram in enumerate(block_histograms):
+            for char, count in histogram.items():
+                column = self._vocabulary.get(char)
+                if column is not None:
+                    blocks[index, column] = count
+                elif char in self._sparse:
+                    if char not in sparse_window:
+                        char_rows, char_counts = self._sparse[char]
+                        sparse_window[char] = int(
+                            char_counts[
+                                np.searchsorted(char_rows, first_row) : np.searchsorted(
+                                    char_rows, first_row + n_lines
+                                )
+                            ].sum()
+                        )
+                    sparse_intersections[index] += min(count, sparse_window[char])
+        intersections = np.minimum(blocks, window).sum(axis=1) + sparse_intersections
+        return self._divide(
+            intersections, np.maximum(np.array(block_lengths, dtype=np.int64), window_len)
+        ).tolist()
+
+    def _candidate_rows(
+        self,
+        probe_counter: Counter,
+        probe_len: int,
+        threshold,
+        first_row: int,
+        last_row: int,
+    ):
+        # Rows between first_row and last_row that hold nearly all of the probe's
+        # rarest (c, k) entries, in ascending order
+        if probe_len == 0 and threshold > 0:
+            # only blank lines are similar to a blank probe
+            return self._row_range(self._blank_rows, first_row, last_row)
+        entries = [
+            (char, k) for char, count in probe_counter.items() for k in range(1, count + 1)
+        ]
+        entries.sort(key=lambda entry: len(self._postings(entry)))
+        # at most this many entries of the probe may be missing from a similar line,
+        # so a similar line holds all but that many of the rarest few entries
+        max_missing = int((1 - threshold) * probe_len + 1e-9)
+        prefix = entries[: max_missing + self.PREFIX_MARGIN]
+        min_hits = len(prefix) - max_missing
+        if min_hits <= 0:
+            if self._histograms is not None:
+                return np.arange(first_row, last_row + 1)
+            return range(first_row, last_row + 1)
+        postings = [
+            self._row_range(self._postings(entry), first_row, last_row)
+            for entry in prefix
+        ]
+        if self._histograms is not None:
+            hits = np.bincount(
+                np.concatenate(postings) - first_row,
+                minlength=max(last_row - first_row + 1, 0),
+            )
+            return np.flatnonzero(hits >= min_hits) + first_row
+        hits = Counter()
+        for rows in postings:
+            hits.update(rows)
+        return sorted(row for row, n_hits in hits.items() if n_hits >= min_hits)
+
+    def _row_range(self, rows, first_row: int, last_row: int):
+        # The part of an ascending list of rows between first_row and last_row
+        if self._histograms is not None:
+            return rows[
+                np.searchsorted(rows, first_row) : np.searchsorted(
+                    rows, last_row, side="right"
+                )
+            ]
+        return rows[bisect_left(rows, first_row) : bisect_right(rows, last_row)]
+
+    def _ratios(self, probe_counter: Counter, probe_len: int, rows):
+        # Same ratios as count_ratio, without normalizing the lines again
+        if self._histograms is None:
+            ratios = []
+            for row in rows:
+                counter = self._counters[row]
+                intersection = sum(
+                    min(count, counter[char]) for char, count in probe_counter.items()
+                )
+                longer_length = max(probe_len, self._lengths[row])
+                ratios.append(intersection / longer_length if longer_length else 1)
+            return ratios
+        rows = np.asarray(rows, dtype=np.intp)
+        columns, counts, sparse = [], [], []
+        for char, count in probe_counter.items():
+            column = self._vocabulary.get(char)
+            # characters missing from the file add to the length only
+            if column is not None:
+                columns.append(column)
+                counts.append(count)
+            elif char in self._sparse:
+                sparse.append((char, count))
+        columns = np.asarray(columns, dtype=np.intp)
+        intersections = np.minimum(
+            self._histograms[np.ix_(rows, columns)], np.asarray(counts, dtype=np.int64)
+        ).sum(axis=1)
+        if sparse and len(rows):
+            for char, count in sparse:
+                intersections += np.minimum(self._sparse_counts(char, rows), count)
+        return self._divide(
+            intersections, np.maximum(self._length_array[rows], probe_len)
+        )
+
+    @staticmethod
+    def _divide(intersections, longer_lengths):
+        # Two empty strings are identical, hence a ratio of 1
+        ratios = np.ones(len(longer_lengths))
+        np.divide(intersections, longer_lengths, out=ratios, where=longer_lengths > 0)
+        return ratios
+
+
+class ForwardWindow:
+    """
+    Rolling window over the next lines of a hunk that are not added, starting at the
+    hunk line being validated, with the character counts of the forward blocks that
+    `Hunk.validate_lines` compares to the code.
+
+    The window holds `block_len + 1` lines and is updated line by line as validation
+    advances and corrects the hunk, so the blocks are available at every mismatch
+    without joining and counting the rest of the hunk again.
+    """
+
+    def __init__(self, lines: "HunkLines", start: int, block_len: int):
+        self.lines = lines  # the hunk lines, corrected in place during validation
+        self.start = start
+        self.block_len = block_len
+        self.histogram = Counter()
+        self._counters = deque()
+        self._next = start  # first hunk line not looked at yet
+        self._fill()
+
+    def advance(self) -> None:
+        """Moves the window past the hunk line at its start."""
+        if self._counters and self.lines.label(self.start) != ADD:
+            self.histogram.subtract(self._counters.popleft())
+        self.start += 1
+        self._next = max(self._next, self.start)
+        self._fill()
+
+    def remove_first(self, shift=0) -> None:
+        """
+        Drops the line at the start of the window, after it was relabelled as added
+        or, with a shift of -1, removed from the hunk.
+        """
+        self.histogram.subtract(self._counters.popleft())
+        self._next += shift
+        self._fill()
+
+    def skip_inserted(self) -> None:
+        """Moves the window past a line inserted at its start."""
+        self.start += 1
+        self._next += 1
+
+    def blocks(self, missing_line: str) -> List[Counter]:
+        """
+        Returns the character counts of the block of the next `block_len` lines, of
+        the missing line followed by one line less, and of the block that follows the
+        first line, as joined by `Hunk.make_forward_block`.
+        """
+        counters, block_len = self._counters, self.block_len
+        n_lines = len(counters)
+
+        forward = self.histogram.copy()
+        for counter in list(counters)[block_len:]:
+            forward.subtract(counter)
+        forward["\n"] += max(min(n_lines, block_len) - 1, 0)
+
+        missing = self.histogram.copy()
+        missing.update(block_histogram(missing_line))
+        for counter in list(counters)[block_len - 1 :]:
+            missing.subtract(counter)
+        # the missing line is joined to the block even if the block is empty
+        missing["\n"] += max(min(n_lines, block_len - 1), 1)
+
+        false = self.histogram.copy()
+        if counters:
+            false.subtract(counters[0])
+        false["\n"] += max(n_lines - 2, 0)
+        # drop the characters whose counts went down to zero
+        return [+forward, +missing, +false]
+
+    def _fill(self) -> None:
+        while len(self._counters) <= self.block_len and self._next < len(self.lines):
+            if self.lines.label(self._next) != ADD:
+                counter = block_histogram(self.lines.content(self._next))
+                self._counters.append(counter)
+                self.histogram.update(counter)
+            self._next += 1
+
+
+class HunkLines(Sequence):
+    """
+    The lines of a hunk as (category, content) pairs, stored compactly as category
+    codes in an array next to a list of the contents.
+
+    The lines are kept in a gap buffer: those before a cursor in order and those from
+    the cursor on in reverse order. Validation walks a hunk from front to back and
+    inserts or removes lines where it is, so an edit moves the cursor along instead of
+    shifting the rest of the hunk. Most hunks are never edited in the middle, so the
+    back half of the buffer is only allocated once it is needed.
+    """
+
+    __slots__ = ("_front_labels", "_front_contents", "_back_labels", "_back_contents")
+
+    def __init__(self, lines=()):
+        lines = list(lines)
+        self._front_labels = array("b", [LABEL_CODES[label] for label, _ in lines])
+        self._front_contents: List[str] = [content for _, content in lines]
+        self._back_labels: Optional[array] = None
+        self._back_contents: Optional[List[str]] = None
+
+    def label(self, index: int) -> str:
+        """Returns the category of the line at the index."""
+        if 0 <= index < len(self._front_contents):
+            return LABELS[self._front_labels[index]]
+        labels, _, position = self._locate(index)
+        return LABELS[labels[position]]
+
+    def content(self, index: int) -> str:
+        """Returns the content of the line at the index."""
+        if 0 <= index < len(self._front_contents):
+            return self._front_contents[index]
+        _, contents, position = self._locate(index)
+        return contents[position]
+
+    def count_label(self, label: str) -> int:
+        """Returns the number of lines of the category."""
+        code = LABEL_CODES[label]
+        count = self._front_labels.count(code)
+        if self._back_labels is not None:
+            count += self._back_labels.count(code)
+        return count
+
+    def insert(self, index: int, line: tuple) -> None:
+        self._move_gap(index)
+        self._front_labels.append(LABEL_CODES[line[0]])
+        self._front_contents.append(line[1])
+
+    def extend(self, lines) -> None:
+        self._move_gap(len(self))
+        for label, content in lines:
+            self._front_labels.append(LABEL_CODES[label])
+            self._front_contents.append(content)
+
+    def append(self, line: tuple) -> None:
+        self.insert(len(self), line)
+
+    def pop(self, index: int = -1) -> tuple:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("pop index out of range")
+        self._move_gap(index)
+        return LABELS[self._back_labels.pop()], self._back_contents.pop()
+
+    def codes_and_contents(self):
+        """Yields the category code and content of every line, in order."""
+        yield from zip(self._front_labels, self._front_contents)
+        if self._back_labels is not None:
+            yield from zip(reversed(self._back_labels), reversed(self._back_contents))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        labels, contents, position = self._locate(index)
+        return LABELS[labels[position]], contents[position]
+
+    def __setitem__(self, index: int, line: tuple) -> None:
+        labels, contents, position = self._locate(index)
+        labels[position] = LABEL_CODES[line[0]]
+        contents[position] = line[1]
+
+    def __len__(self) -> int:
+        n_back = len(self._back_contents) if self._back_contents is not None else 0
+        return len(self._front_contents) + n_back
+
+    def __iter__(self):
+        for code, content in self.codes_and_contents():
+            yield LABELS[code], content
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (HunkLines, list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __deepcopy__(self, memo) -> "HunkLines":
+        # the contents are strings, so copying the containers is enough
+        copied = HunkLines()
+        copied._front_labels = array("b", self._front_labels)
+        copied._front_contents = list(self._front_contents)
+        if self._back_labels is not None:
+            copied._back_labels = array("b", self._back_labels)
+            copied._back_contents = list(self._back_contents)
+        return copied
+
+    def __repr__(self) -> str:
+        return f"HunkLines({list(self)!r})"
+
+    def _locate(self, index: int):
+        # The buffers holding the line at the index, and its position in there
+        n_front = len(self._front_contents)
+        if index < 0:
+            index += len(self)
+        if 0 <= index < n_front:
+            return self._front_labels, self._front_contents, index
+        if self._back_contents is not None:
+            position = len(self._back_contents) - 1 - (index - n_front)
+            if 0 <= position < len(self._back_contents):
+                return self._back_labels, self._back_contents, position
+        raise IndexError("hunk line index out of range")
+
+    def _move_gap(self, index: int) -> None:
+        # Moves the cursor in front of the line at the index
+        n_front = len(self._front_contents)
+        if index < n_front:
+            if self._back_labels is None:
+                self._back_labels, self._back_contents = array("b"), []
+            self._back_labels.extend(self._front_labels[index:][::-1])
+            self._back_contents.extend(self._front_contents[index:][::-1])
+            del self._front_labels[index:]
+            del self._front_contents[index:]
+        elif index > n_front and self._back_contents:
+            n_moved = min(index - n_front, len(self._back_contents))
+            self._front_labels.extend(self._back_labels[-n_moved:][::-1])
+            self._front_contents.extend(self._back_contents[-n_moved:][::-1])
+            del self._back_labels[-n_moved:]
+            del self._back_contents[-n_moved:]
+
 
 class Hunk:
 
+    __slots__ = (
+        "start_line_pre_edit",
+        "hunk_len_pre_edit",
+        "start_line_post_edit",
+        "hunk_len_post_edit",
+        "lines",
+        "forward_block_len",
+        "is_new_file",
+    )
+
     def __init__(
         self,
         start_line_pre_edit,
@@ -23,49 +668,46 @@ class Hunk:
         self.hunk_len_pre_edit = hunk_len_pre_edit
         self.start_line_post_edit = start_line_post_edit
         self.hunk_len_post_edit = hunk_len_post_edit
-        self.category_counts = {RETAIN: 0, ADD: 0, REMOVE: 0}
-        self.lines = list()
-        self.add_lines(lines)
+        self.lines = HunkLines(lines)
         self.forward_block_len = 10
         # Note that this assumption should not be done on hunk level, however, if the below is true, no validation is possible anyway.
-        if self.category_counts[RETAIN] == 0 and self.category_counts[REMOVE] == 0:
+        category_counts = self.category_counts
+        if category_counts[RETAIN] == 0 and category_counts[REMOVE] == 0:
             self.is_new_file = True
         else:
             self.is_new_file = False
 
+    @property
+    def category_counts(self) -> Dict[str, int]:
+        """The number of lines of each category."""
+        return {label: self.lines.count_label(label) for label in LABELS}
+
     def add_retained_line(self, line, index) -> None:
         """Adds a retained line to the hunk at the specified index."""
         self.lines.insert(index, (RETAIN, line))
-        self.category_counts[RETAIN] += 1
 
     def relabel_line(self, index, new_label) -> None:
         """Changes the label of a line at the specified index."""
-        old_label = self.lines[index][0]
-        self.lines[index] = (new_label, self.lines[index][1])
-        self.category_counts[old_label] -= 1
-        self.category_counts[new_label] += 1
+        self.lines[index] = (new_label, self.lines.content(index))
 
     def pop_line(self, line, index) -> None:
         """Removes a line from the hunk at the specified index."""
+        assert self.lines.label(index) == line[0]
         self.lines.pop(index)
-        assert self.category_counts[line[0]] > 0
-        self.category_counts[line[0]] -= 1
 
     def add_lines(self, new_lines) -> None:
         """Adds multiple lines to the hunk."""
-        for line in new_lines:
-            self.lines.append(line)
-            self.category_counts[line[0]] += 1
+        self.lines.extend(new_lines)
 
     def hunk_to_string(self) -> str:
         """Converts the hunk to a string representation."""
-        string = f"@@ -{self.start_line_pre_edit},{self.hunk_len_pre_edit} +{self.start_line_post_edit},{self.hunk_len_post_edit} @@\n"
-        for line_type, line_content in self.lines:
-            line_prefix = (
-                " " if line_type == RETAIN else "+" if line_type == ADD else "-"
-            )
-            string += f"{line_prefix}{line_content}\n"
-        return string
+        header = f"@@ -{self.start_line_pre_edit},{self.hunk_len_pre_edit} +{self.start_line_post_edit},{self.hunk_len_post_edit} @@\n"
+        return header + "".join(
+            [
+                f"{LINE_PREFIXES[code]}{line_content}\n"
+                for code, line_content in self.lines.codes_and_contents()
+            ]
+        )
 
     def make_forward_block(self, hunk_ind: int, forward_block_len) -> str:
         """Creates a block of lines for forward comparison."""
@@ -75,6 +717,21 @@ class Hunk:
         forward_block = "\n".join(forward_lines[0:forward_block_len])
         return forward_block
 
+    def matches_exactly(self, lines_dict: dict) -> bool:
+        """
+        Checks whether the retained and removed lines of the hunk are found verbatim in
+        the original code from its start line on, so that it applies as it is.
+        """
+        file_ind = self.start_line_pre_edit
+        add_code = LABEL_CODES[ADD]
+        for code, line_content in self.lines.codes_and_contents():
+            if code == add_code:
+                continue
+            if file_ind not in lines_dict or lines_dict[file_ind] != line_content:
+                return False
+            file_ind += 1
+        return True
+
     def check_start_line(self, lines_dict: dict) -> bool:
         """Check if the starting line of a hunk is present in the original code and returns a boolean value accordingly."""
         if self.is_new_file:
@@ -86,8 +743,15 @@ class Hunk:
         else:
             pass
 
-    def find_start_line(self, lines_dict: dict, problems: list) -> bool:
+    def find_start_line(
+        self,
+        lines_dict: dict,
+        problems: list,
+        line_index: Optional[LineIndex] = None,
+    ) -> bool:
         """Finds the starting line of the hunk in the original code and returns a boolean value accordingly. If the starting line is not found, it appends a problem message to the problems list."""
+        if line_index is None:
+            line_index = LineIndex(lines_dict)
 
         # ToDo handle the case where the start line is 0 or 1 characters separately
         if self.lines[0][0] == ADD:
@@ -96,11 +760,13 @@ class Hunk:
             # find the first line that is not an add
             for index, line in enumerate(self.lines):
                 if line[0] != ADD:
-                    for line_number, line_content in lines_dict.items():
-                        # if the line is similar to a non-blank line in line_dict, we can pick the line prior to it
-                        if is_similar(line[1], line_content) and line[1] != "":
-                            start_line = line_number - 1
-                            break
+                    # if the line is similar to a non-blank line in line_dict, we can pick the line prior to it
+                    if line[1] != "":
+                        candidates = line_index.similar_lines(line[1], lines_dict)
+                        if candidates:
+                            start_line = (
+                                self.best_start_line(candidates, index, lines_dict) - 1
+                            )
                     # if the start line is not found, append a problem message
                     if start_line is None:
                         problems.append(
@@ -114,98 +780,114 @@ class Hunk:
                         retain_line = lines_dict.get(start_line, "")
                         if retain_line:
                             self.add_retained_line(lines_dict[start_line], 0)
-                            return self.validate_and_correct(lines_dict, problems)
+                            return self.validate_and_correct(
+                                lines_dict, problems, line_index
+                            )
                         else:
                             problems.append(
                                 f"In {self.hunk_to_string()}:The starting line of the diff {self.hunk_to_string()} does not exist in the code"
                             )
                             return False
-        pot_start_lines = {
-            key: is_similar(self.lines[0][1], line) for key, line in lines_dict.items()
-        }
-        sum_of_matches = sum(pot_start_lines.values())
-        if sum_of_matches == 0:
+        pot_start_lines = line_index.similar_lines(self.lines[0][1], lines_dict)
+        if not pot_start_lines:
             # before we go any further, we should check if it's a comment from LLM
             if self.lines[0][1].count("#") > 0:
                 # if it is, we can mark it as an ADD lines
                 self.relabel_line(0, ADD)
                 # and restart the validation at the next line
-                return self.validate_and_correct(lines_dict, problems)
+                return self.validate_and_correct(lines_dict, problems, line_index)
 
             else:
                 problems.append(
                     f"In {self.hunk_to_string()}:The starting line of the diff {self.hunk_to_string()} does not exist in the code"
                 )
                 return False
-        elif sum_of_matches == 1:
-            start_ind = list(pot_start_lines.keys())[
-                list(pot_start_lines.values()).index(True)
-            ]  # lines are one indexed
+        elif len(pot_start_lines) == 1:
+            start_ind = pot_start_lines[0]  # lines are one indexed
         else:
-            logging.warning("multiple candidates for starting index")
-            # ToDo handle all the cases better again here. Smartest choice is that, for each candidate check match to the next line etc (recursively)
-            start_ind = list(pot_start_lines.keys())[
-                list(pot_start_lines.values()).index(True)
-            ]
+            logging.debug("multiple candidates for starting index")
+            start_ind = self.best_start_line(pot_start_lines, 0, lines_dict)
         self.start_line_pre_edit = start_ind
 
         # This should now be fulfilled by default
         assert is_similar(self.lines[0][1], lines_dict[self.start_line_pre_edit])
         return True
 
-    def validate_lines(self, lines_dict: dict, problems: list) -> bool:
+    def best_start_line(
+        self, candidates: List[int], hunk_ind: int, lines_dict: dict
+    ) -> int:
+        """
+        Picks the candidate file line for hunk line `hunk_ind` that is followed by the
+        longest run of file lines matching the next lines of the hunk. Ties go to the
+        earliest candidate.
+        """
+        if len(candidates) == 1:
+            return candidates[0]
+        context = [
+            line[1] for line in self.lines[hunk_ind + 1 :] if line[0] != ADD
+        ][: self.forward_block_len]
+        best_line, best_score = candidates[0], -1
+        for line_number in candidates:
+            score = 0
+            for offset, hunk_line in enumerate(context, 1):
+                file_line = lines_dict.get(line_number + offset)
+                if file_line is None or not is_similar(hunk_line, file_line):
+                    break
+                score += 1
+            if score > best_score:
+                best_line, best_score = line_number, score
+        return best_line
+
+    def validate_lines(
+        self,
+        lines_dict: dict,
+        problems: list,
+        line_index: Optional[LineIndex] = None,
+    ) -> bool:
         """Validates the lines of the hunk against the original file and returns a boolean value accordingly. If the lines do not match, it appends a problem message to the problems list."""
+        if line_index is None:
+            line_index = LineIndex(lines_dict)
         hunk_ind = 0
         file_ind = self.start_line_pre_edit
         # make an orig hunk lines for logging
         # orig_hunk_lines = deepcopy(self.lines)
-        while hunk_ind < len(self.lines) and file_ind <= max(lines_dict):
-            if self.lines[hunk_ind][0] == ADD:
+        # forward blocks of the hunk, tracked from the first mismatch on
+        window = None
+        last_line = (
+            lines_dict.last_line if isinstance(lines_dict, LineStore) else max(lines_dict)
+        )
+        while hunk_ind < len(self.lines) and file_ind <= last_line:
+            if self.lines.label(hunk_ind) == ADD:
                 # this cannot be validated, jump one index
+                if window is not None:
+                    window.advance()
                 hunk_ind += 1
-            elif not is_similar(self.lines[hunk_ind][1], lines_dict[file_ind]):
+            elif not is_similar(self.lines.content(hunk_ind), lines_dict[file_ind]):
                 # before we go any further, we should relabel the comment from LLM
-                if self.lines[hunk_ind][1].count("#") > 0:
+                if self.lines.content(hunk_ind).count("#") > 0:
                     self.relabel_line(hunk_ind, ADD)
+                    if window is not None:
+                        window.remove_first()
                     continue
 
-                # make a forward block from the code for comparisons
-                forward_code = "\n".join(
-                    [
-                        lines_dict[ind]
-                        for ind in range(
-                            file_ind,
-                            min(
-                                file_ind + self.forward_block_len,
-                                max(lines_dict.keys()),
-                            ),
-                        )
-                    ]
-                )
-                # make the original forward block for quantitative comparison
-                forward_block = self.make_forward_block(
-                    hunk_ind, self.forward_block_len
-                )
-                orig_count_ratio = count_ratio(forward_block, forward_code)
+                if window is None:
+                    window = ForwardWindow(
+                        self.lines, hunk_ind, self.forward_block_len
+                    )
                 # Here we have 2 cases
                 # 1) some lines were simply skipped in the diff and we should add them to the diff
-                # If this is the case, adding the line to the diff, should give an improved forward diff
-                forward_block_missing_line = self.make_forward_block(
-                    hunk_ind, self.forward_block_len - 1
-                )
-                # insert the missing line in front of the block
-                forward_block_missing_line = "\n".join(
-                    [lines_dict[file_ind], forward_block_missing_line]
-                )
-                missing_line_count_ratio = count_ratio(
-                    forward_block_missing_line, forward_code
-                )
+                # If this is the case, adding the missing line to the diff, should give an improved forward diff
                 # 2) Additional lines, not belonging to the code were added to the diff
-                forward_block_false_line = self.make_forward_block(
-                    hunk_ind + 1, self.forward_block_len
-                )
-                false_line_count_ratio = count_ratio(
-                    forward_block_false_line, forward_code
+                # so compare the original forward block, the block with the missing line inserted in
+                # front and the block without its first line to the forward block of the code at once
+                (
+                    orig_count_ratio,
+                    missing_line_count_ratio,
+                    false_line_count_ratio,
+                ) = line_index.block_ratios(
+                    window.blocks(lines_dict[file_ind]),
+                    file_ind,
+                    min(file_ind + self.forward_block_len, last_line) - file_ind,
                 )
                 if (
                     orig_count_ratio >= missing_line_count_ratio
@@ -218,6 +900,7 @@ class Hunk:
 
                 elif missing_line_count_ratio > false_line_count_ratio:
                     self.add_retained_line(lines_dict[file_ind], hunk_ind)
+                    window.skip_inserted()
                     hunk_ind += 1
                     file_ind += 1
                     # NOTE: IF THE LLM SKIPS SOME LINES AND HAS ADDs ADJACENT TO THE SKIPPED BLOCK,
@@ -225,8 +908,11 @@ class Hunk:
                     # IF IT MATTERED, WE ASSUME THE LLM WOULD NOT SKIP THE BLOCK
                 else:
                     self.pop_line(self.lines[hunk_ind], hunk_ind)
+                    window.remove_first(shift=-1)
 
             else:
+                if window is not None:
+                    window.advance()
                 hunk_ind += 1
                 file_ind += 1
         # if we have not validated all lines, we have a problem
@@ -245,16 +931,19 @@ class Hunk:
         self,
         lines_dict: dict,
         problems: list,
+        line_index: Optional[LineIndex] = None,
     ) -> bool:
 
+        if line_index is None:
+            line_index = LineIndex(lines_dict)
         start_true = self.check_start_line(lines_dict)
 
         if not start_true:
-            if not self.find_start_line(lines_dict, problems):
+            if not self.find_start_line(lines_dict, problems, line_index):
                 return False
 
         # Now we should be able to validate the hunk line by line and add missing line
-        if not self.validate_lines(lines_dict, problems):
+        if not self.validate_lines(lines_dict, problems, line_index):
             return False
         # Pass the validation
         return True
@@ -262,10 +951,31 @@ class Hunk:
 
 class Diff:
 
+    __slots__ = (
+        "filename_pre",
+        "filename_post",
+        "hunks",
+        "_past_hunk",
+        "_lines_dict",
+        "_cut_lines",
+        "_line_index",
+        "hunk_paths",
+        "failed_hunks",
+    )
+
     def __init__(self, filename_pre, filename_post) -> None:
         self.filename_pre = filename_pre
         self.filename_post = filename_post
         self.hunks = []
+        # number of validated hunks by EXACT_MATCH or FUZZY_MATCH
+        self.hunk_paths: Counter = Counter()
+        # hunks removed by the validation, with the start line they were given
+        self.failed_hunks: List[Tuple[int, Hunk]] = []
+        # state carried between the hunks of one validation
+        self._past_hunk = None
+        self._lines_dict = None
+        self._cut_lines: Optional[LineStore] = None
+        self._line_index = None
 
     def is_new_file(self) -> bool:
         """Determines if the diff represents a new file."""
@@ -275,50 +985,90 @@ class Diff:
 
     def diff_to_string(self) -> str:
         """Converts the diff to a string representation."""
-        string = f"--- {self.filename_pre}\n+++ {self.filename_post}\n"
-        for hunk in self.hunks:
-            string += hunk.hunk_to_string()
-        return string.strip()
+        header = f"--- {self.filename_pre}\n+++ {self.filename_post}\n"
+        return (header + "".join(hunk.hunk_to_string() for hunk in self.hunks)).strip()
 
     def validate_and_correct(self, lines_dict: dict) -> List[str]:
         """Validates and corrects each hunk in the diff."""
         problems = []
-        past_hunk = None
-        cut_lines_dict = lines_dict.copy()
-        for hunk in self.hunks:
-            if past_hunk is not None:
-                # make sure to not cut so much that the start_line gets out of range
-                cut_ind = min(
-                    past_hunk.start_line_pre_edit + past_hunk.hunk_len_pre_edit,
-                    hunk.start_line_pre_edit,
+        self._past_hunk = None
+        self._lines_dict = None
+        self.hunk_paths = Counter()
+        self.failed_hunks = []
+        # iterate over a copy, invalid hunks are removed from the diff on the way
+        for hunk in list(self.hunks):
+            self.validate_and_correct_hunk(hunk, lines_dict, problems)
+        self.clear_validation_state()
+        return problems
+
+    def clear_validation_state(self) -> None:
+        """
+        Drops the file and its index held while validating, which would otherwise be
+        kept, and pickled back from validation workers, along with the diff.
+        """
+        self._past_hunk = None
+        self._lines_dict = None
+        self._cut_lines = None
+        self._line_index = None
+
+    def validate_and_correct_hunk(
+        self, hunk: Hunk, lines_dict: dict, problems: List[str]
+    ) -> bool:
+        """
+        Validates and corrects the next hunk of the diff, given that all previous hunks
+        have already been passed to this method. This allows validating hunks one by one
+        as they arrive, with the same result as validating the complete diff.
+        """
+        if self._lines_dict is not lines_dict:
+            # store the file once for all hunks, it is indexed once a hunk needs correcting
+            self._lines_dict = lines_dict
+            self._cut_lines = LineStore.from_dict(lines_dict)
+            self._line_index = None
+        past_hunk = self._past_hunk
+        cut_lines = self._cut_lines
+        given_start_line = hunk.start_line_pre_edit
+        if past_hunk is not None:
+            # make sure to not cut so much that the start_line gets out of range
+            cut_ind = min(
+                past_hunk.start_line_pre_edit + past_hunk.hunk_len_pre_edit,
+                hunk.start_line_pre_edit,
+            )
+            cut_lines = cut_lines.from_line(cut_ind)
+        if hunk.matches_exactly(cut_lines):
+            # most hunks apply as they are, those skip the fuzzy correction
+            self.hunk_paths[EXACT_MATCH] += 1
+            is_valid = True
+        else:
+            self.hunk_paths[FUZZY_MATCH] += 1
+            if self._line_index is None:
+                self._line_index = LineIndex(
+                    LineStore(self._cut_lines.lines, self._cut_lines.first_line)
                 )
-                cut_lines_dict = {
-                    key: val for key, val in cut_lines_dict.items() if key >= (cut_ind)
-                }
-            is_valid = hunk.validate_and_correct(cut_lines_dict, problems)
-            if not is_valid and len(problems) > 0:
-                for idx, val in enumerate(problems):
-                    print(f"\nInvalid Hunk NO.{idx}---\n{val}\n---")
-                self.hunks.remove(hunk)
-            # now correct the numbers, assuming the start line pre-edit has been fixed
-            hunk.hunk_len_pre_edit = (
-                hunk.category_counts[RETAIN] + hunk.category_counts[REMOVE]
+            is_valid = hunk.validate_and_correct(
+                cut_lines, problems, self._line_index
             )
-            hunk.hunk_len_post_edit = (
-                hunk.category_counts[RETAIN] + hunk.category_counts[ADD]
+        if not is_valid and len(problems) > 0:
+            for idx, val in enumerate(problems):
+                print(f"\nInvalid Hunk NO.{idx}---\n{val}\n---")
+            self.hunks.remove(hunk)
+            self.failed_hunks.append((given_start_line, hunk))
+        # now correct the numbers, assuming the start line pre-edit has been fixed
+        category_counts = hunk.category_counts
+        hunk.hunk_len_pre_edit = category_counts[RETAIN] + category_counts[REMOVE]
+        hunk.hunk_len_post_edit = category_counts[RETAIN] + category_counts[ADD]
+        if past_hunk is not None:
+            hunk.start_line_post_edit = (
+                hunk.start_line_pre_edit
+                + past_hunk.hunk_len_post_edit
+                - past_hunk.hunk_len_pre_edit
+                + past_hunk.start_line_post_edit
+                - past_hunk.start_line_pre_edit
             )
-            if past_hunk is not None:
-                hunk.start_line_post_edit = (
-                    hunk.start_line_pre_edit
-                    + past_hunk.hunk_len_post_edit
-                    - past_hunk.hunk_len_pre_edit
-                    + past_hunk.start_line_post_edit
-                    - past_hunk.start_line_pre_edit
-                )
-            else:
-                hunk.start_line_post_edit = hunk.start_line_pre_edit
-            past_hunk = hunk
-        return problems
+        else:
+            hunk.start_line_post_edit = hunk.start_line_pre_edit
+        self._past_hunk = hunk
+        self._cut_lines = cut_lines
+        return is_valid
 
 
 def is_similar(str1, str2, similarity_threshold=0.9) -> bool:
@@ -326,9 +1076,19 @@ def is_similar(str1, str2, similarity_threshold=0.9) -> bool:
     return count_ratio(str1, str2) >= similarity_threshold
 
 
+def block_histogram(block: str) -> Counter:
+    """Returns the character counts that `count_ratio` compares for a block of lines."""
+    return Counter(normalize_line(block))
+
+
+def normalize_line(line: str) -> str:
+    """Normalizes a line for similarity comparisons, ignoring spaces and case."""
+    return line.replace(" ", "").lower()
+
+
 def count_ratio(str1, str2) -> float:
 
-    str1, str2 = str1.replace(" ", "").lower(), str2.replace(" ", "").lower()
+    str1, str2 = normalize_line(str1), normalize_line(str2)
 
     counter1, counter2 = Counter(str1), Counter(str2)
     intersection = sum((counter1 & counter2).values())
@@ -0,0 +1,130 @@
+import copy  # Importing copy for validating hunks without touching the parsed ones
+import logging  # Importing logging for the failures of the streamed validation
+
+from typing import Dict, List, Optional, Tuple  # Importing type hints from typing
+
+from langchain.callbacks.base import BaseCallbackHandler  # Importing the callback base
+
+from espada.core.chat_to_files import DiffStreamParser  # Importing the diff parser
+from espada.core.diff import Diff, Hunk  # Importing the Diff and Hunk classes
+from espada.core.files_dict import FilesDict, file_to_lines_dict  # Importing files
+
+logger = logging.getLogger(__name__)
+
+
+class DiffStreamAborted(Exception):
+    """Raised from the token stream when the first hunk of a response is invalid."""
+
+    def __init__(self, problems: List[str]):
+        super().__init__("\n".join(problems))
+        self.problems = problems
+
+
+class StreamingDiffValidator(BaseCallbackHandler):
+    """
+    Callback handler that parses and validates diffs while the completion streams in.
+
+    Every token is fed to a `DiffStreamParser`, and each hunk is validated against
+    the current files as soon as it is closed, so validation is done by the time the
+    completion is. If the first hunk of the response cannot be matched to the code,
+    the completion is interrupted with `DiffStreamAborted` so it can be retried
+    right away instead of after the whole response has been generated. Any other
+    error is logged and leaves the diffs to the batch validation, so that it never
+    interrupts the completion.
+    """
+
+    raise_error = True  # let DiffStreamAborted interrupt the LLM call
+
+    def __init__(self, files_dict: FilesDict, abort_on_invalid_first_hunk=True):
+        self.files_dict = files_dict
+        self.abort_on_invalid_first_hunk = abort_on_invalid_first_hunk
+        self.parser = DiffStreamParser(on_hunk=self._on_hunk, on_diff=self._on_diff)
+        self.diffs: Dict[str, Diff] = {}
+        self.problems: List[str] = []
+        self.aborted = False
+        self._chunks: List[str] = []
+        self._validated: Dict[int, Tuple[Diff, List[str]]] = {}
+        self._lines_dicts: Dict[str, dict] = {}
+        self._validated_hunks = 0
+        # set when the streamed diffs cannot stand in for validating the full response
+        self._incomplete = False
+        # set when parsing or validating failed, the parser is not fed any further
+        self._failed = False
+
+    @property
+    def text(self) -> str:
+        """The part of the completion received so far."""
+        return "".join(self._chunks)
+
+    def on_llm_new_token(self, token: str, **kwargs) -> None:
+        self._chunks.append(token)
+        if self._failed:
+            return
+        try:
+            self.parser.feed(token)
+        except DiffStreamAborted:
+            raise
+        except Exception:
+            logger.exception("Streamed diff validation failed, validating once complete")
+            self._failed = True
+
+    def result(self, content: str) -> Optional[Tuple[Dict[str, Diff], List[str]]]:
+        """
+        Returns the validated diffs and problems of the response `content`, or None if
+        it was not streamed through this handler, e.g. because it came from a cache.
+        """
+        if self.aborted:
+            return {}, self.problems
+        if self._failed or self._incomplete or self.text.strip() != content.strip():
+            return None
+        try:
+            self.parser.close()
+        except Exception:
+            logger.exception("Streamed diff validation failed, validating once complete")
+            self._failed = True
+            return None
+        return self.diffs, self.problems
+
+    def _on_hunk(self, diff: Diff, hunk: Hunk) -> None:
+        # if diff is a new file, validation and correction is unnecessary
+        if diff.is_new_file() or self._incomplete:
+            return
+        if diff.filename_pre not in self.files_dict:
+            # leave it to the batch validation to report
+            self._incomplete = True
+            return
+        if diff.filename_pre not in self._lines_dicts:
+            self._lines_dicts[diff.filename_pre] = file_to_lines_dict(
+                self.files_dict[diff.filename_pre]
+            )
+        validated, problems = self._validated.setdefault(
+            id(diff), (Diff(diff.filename_pre, diff.filename_post), [])
+        )
+        validated_hunk = copy.deepcopy(hunk)
+        validated.hunks.append(validated_hunk)
+        n_problems = len(problems)
+        validated.validate_and_correct_hunk(
+            validated_hunk, self._lines_dicts[diff.filename_pre], problems
+        )
+        self._validated_hunks += 1
+        if (
+            self.abort_on_invalid_first_hunk
+            and self._validated_hunks == 1
+            and len(problems) > n_problems
+        ):
+            self.aborted = True
+            self.problems = problems + [
+                "The response was interrupted at this hunk and none of its diffs were applied."
+            ]
+            raise DiffStreamAborted(self.problems)
+
+    def _on_diff(self, diff: Diff) -> None:
+        if diff.is_new_file() or self._incomplete:
+            self.diffs[diff.filename_post] = diff
+            return
+        validated, problems = self._validated.get(
+            id(diff), (Diff(diff.filename_pre, diff.filename_post), [])
+        )
+        validated.clear_validation_state()
+        self.diffs[diff.filename_post] = validated
+        self.problems.extend(problems)
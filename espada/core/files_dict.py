@@ -1,6 +1,18 @@
+import hashlib
+import mmap
+import os
+import threading
+import weakref
+
 from collections import OrderedDict
 from pathlib import Path
-from typing import Union
+from typing import Iterable, Iterator, List, Mapping, Optional, TextIO, Tuple, Union
+
+# Rendered files are kept across calls up to this many characters in total, a 50 MB
+# selection of code takes 60 to 100 MB once its lines are numbered
+RENDER_CACHE_MAX_CHARS = 128 * 1024 * 1024
+# Files from this size on are decoded straight from a memory map, without a copy of their bytes
+MMAP_MIN_BYTES = 1024 * 1024
 
 
 # class Code(MutableMapping[str | Path, str]):
@@ -8,6 +20,51 @@ from typing import Union
 class FilesDict(dict):
     # Custom dictionary class that extends the built-in dict to handle file paths as keys
     # and file contents as values.
+    # Contents are content-addressed: equal contents are shared as a single string
+    # through the content store, which only refers to them weakly, so a content is
+    # freed once no FilesDict holds it. Copies share them, so a copy is a snapshot
+    # whose cost depends on the number of files and not on their size, and equal
+    # files are compared by identity, without reading their content.
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.update(*args, **kwargs)
+
+    def update(self, *args, **kwargs):
+        # Go through __setitem__, which dict's own update does not.
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def copy(self) -> "FilesDict":
+        # Copy-on-write snapshot: the contents are shared, and a change to either
+        # dictionary only replaces its own entry.
+        snapshot = FilesDict()
+        dict.update(snapshot, self)  # the contents are already checked and shared
+        return snapshot
+
+    def changed_files(
+        self, other: Mapping[Union[str, Path], str]
+    ) -> List[Union[str, Path]]:
+        # Names of the files that were added, removed or changed in other, sorted.
+        # Unchanged files share their stored content and are skipped by identity.
+
+        missing = object()
+        return sorted(
+            (
+                file_name
+                for file_name in set(self) | set(other)
+                if _stored(self, file_name, missing)
+                is not _stored(other, file_name, missing)
+                and self.get(file_name) != other.get(file_name)
+            ),
+            key=str,
+        )
+
+    def source_path(self, key: Union[str, Path]) -> Optional[Path]:
+        # Path of the file on disk that still holds the content of the entry, if it
+        # was not read yet. Contents in memory have no source.
+
+        return None
 
     def __setitem__(self, key: Union[str, Path], value: str):
         # Override the __setitem__ method to enforce key and value types.
@@ -18,33 +75,291 @@ class FilesDict(dict):
         if not isinstance(value, str):
             # Ensure the value is a string.
             raise TypeError("Values must be strings")
-        super().__setitem__(key, value)  # Call the parent class's __setitem__ method.
+        # Call the parent class's __setitem__ method with the shared content.
+        super().__setitem__(key, _content_store.share(value))
 
-    def to_chat(self):
+    def to_chat(self, line_numbers: bool = True):
         # Convert the dictionary to a formatted string suitable for chat display.
+        # Lines are numbered for diffs, edit formats without line numbers leave them out.
+        # The files are rendered one by one, unchanged ones come from the render cache,
+        # and joined once, so the whole selection is copied a single time.
+
+        return "".join(self._chat_chunks(line_numbers))
+
+    def write_chat(self, stream: TextIO, line_numbers: bool = True) -> None:
+        # Write the same text as to_chat to a stream, one file at a time, without
+        # holding the whole chat string in memory.
+
+        for chunk in self._chat_chunks(line_numbers):
+            stream.write(chunk)
 
-        chat_str = ""
-        for file_name, file_content in self.items():
-            # Iterate over each file and its content in the dictionary.
-            lines_dict = file_to_lines_dict(file_content)
-            # Convert file content to a dictionary of line numbers and lines.
-            chat_str += f"File: {file_name}\n"
-            for line_number, line_content in lines_dict.items():
-                # Append each line with its line number to the chat string.
-                chat_str += f"{line_number} {line_content}\n"
-            chat_str += "\n"
-        return f"```\n{chat_str}```"  # Return the formatted string enclosed in code block markers.
+    def _chat_chunks(self, line_numbers: bool) -> Iterator[str]:
+        yield "```\n"
+        for file_name, file_content, held in self._read_items():
+            # only contents the dictionary holds anyway are worth keeping rendered
+            yield render_file(file_name, file_content, line_numbers, cache=held)
+        yield "```"  # Close the code block markers.
+
+    def _read_items(self) -> Iterable[Tuple[Union[str, Path], str, bool]]:
+        # The files, their contents and whether the dictionary holds them in memory,
+        # for rendering them without changing the dictionary.
+        return ((key, value, True) for key, value in self.items())
 
     def to_log(self):
         # Convert the dictionary to a plain string suitable for logging.
 
-        log_str = ""
-        for file_name, file_content in self.items():
-            # Iterate over each file and its content in the dictionary.
-            log_str += f"File: {file_name}\n"
-            log_str += file_content  # Append the file content directly to the log string.
-            log_str += "\n"
-        return log_str  # Return the plain log string.
+        return "".join(
+            f"File: {file_name}\n{file_content}\n"
+            for file_name, file_content, _ in self._read_items()
+        )  # Return the plain log string.
+
+
+class LazyFilesDict(FilesDict):
+    # FilesDict whose files are read from disk on first access, for large repositories.
+    # Until then an entry holds a _FileSource with the path of the file, so selecting
+    # or pulling files costs one stat per file. Rendering the chat reads the files it
+    # needs without keeping them, and copies share the unread entries, so applying
+    # diffs only reads the edited files and pushing copies the others on disk.
+
+    @classmethod
+    def from_paths(
+        cls,
+        root: Union[str, Path],
+        names: Iterable[Union[str, Path]],
+        undecodable: Optional[str] = None,
+    ) -> "LazyFilesDict":
+        # Files that are not valid UTF-8 read as `undecodable`, or raise if it is None.
+
+        files = cls()
+        for name in names:
+            dict.__setitem__(files, name, _FileSource(Path(root) / name, undecodable))
+        return files
+
+    def __getitem__(self, key: Union[str, Path]) -> str:
+        value = dict.__getitem__(self, key)
+        if isinstance(value, _FileSource):
+            value = _content_store.share(value.read())
+            dict.__setitem__(self, key, value)
+        return value
+
+    def __iter__(self):
+        # Overriding __iter__ makes dict(), {**files} and dict.update read the entries
+        # through __getitem__ rather than copying the unread ones.
+        return dict.__iter__(self)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            dict.__delitem__(self, key)
+            return value
+        return dict.pop(self, key, *default)
+
+    def copy(self) -> "LazyFilesDict":
+        snapshot = LazyFilesDict()
+        for key in self:
+            dict.__setitem__(snapshot, key, dict.__getitem__(self, key))
+        return snapshot
+
+    def __eq__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return len(self) == len(other) and not self.changed_files(other)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def source_path(self, key: Union[str, Path]) -> Optional[Path]:
+        value = dict.__getitem__(self, key)
+        return value.path if isinstance(value, _FileSource) else None
+
+    def _read_items(self) -> Iterator[Tuple[Union[str, Path], str, bool]]:
+        for key in self:
+            value = dict.__getitem__(self, key)
+            if isinstance(value, _FileSource):
+                yield key, value.read(), False
+            else:
+                yield key, value, True
+
+    def loaded_size(self) -> int:
+        # Characters of the contents held in memory.
+        return sum(
+            len(value) for value in dict.values(self) if isinstance(value, str)
+        )
+
+    def unloaded_size(self) -> int:
+        # Bytes on disk of the files that were not read yet, from their metadata only.
+        return sum(
+            value.size()
+            for value in dict.values(self)
+            if isinstance(value, _FileSource)
+        )
+
+
+class _FileSource:
+    # Content of a file that was not read yet.
+
+    __slots__ = ("path", "undecodable")
+
+    def __init__(self, path: Path, undecodable: Optional[str]):
+        self.path = path
+        self.undecodable = undecodable
+
+    def size(self) -> int:
+        return self.path.stat().st_size
+
+    def read(self) -> str:
+        try:
+            with open(self.path, "rb") as f:
+                if os.fstat(f.fileno()).st_size < MMAP_MIN_BYTES:
+                    content = f.read().decode("utf-8")
+                else:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                        content = str(mapped, "utf-8")
+        except UnicodeDecodeError:
+            if self.undecodable is None:
+                raise
+            return self.undecodable
+        # like a file opened in text mode, with universal newlines
+        if "\r" in content:
+            content = content.replace("\r\n", "\n").replace("\r", "\n")
+        return content
+
+
+class _Content(str):
+    # A content held by the content store, which a plain str could not be weakly
+    # referenced by. It is pickled as a plain str, e.g. for validation workers.
+
+    def __reduce__(self):
+        return str, (str(self),)
+
+
+class _ContentStore:
+    # The contents of the FilesDicts, by digest. The store refers to them weakly, an
+    # entry goes away with the last dictionary holding its content.
+
+    def __init__(self):
+        self._contents: "weakref.WeakValueDictionary[bytes, _Content]" = (
+            weakref.WeakValueDictionary()
+        )
+        self._lock = threading.Lock()
+
+    def share(self, content: str) -> _Content:
+        # The stored content equal to `content`, which is stored if there is none.
+        if type(content) is _Content:
+            return content  # only ever created by the store
+        key = content_digest(content)
+        with self._lock:
+            shared = self._contents.get(key)
+            if shared is None:
+                shared = self._contents[key] = _Content(content)
+        return shared
+
+
+_content_store = _ContentStore()
+
+
+def _stored(files: Mapping, key, default):
+    # The stored value of an entry, without reading an unread file.
+    if isinstance(files, dict):
+        return dict.get(files, key, default)
+    return files.get(key, default)
+
+
+class _RenderCache:
+    # Least recently used chunks of rendered files, bounded by their total length.
+    # A key holds the file name and a digest of the content rather than the content
+    # itself, and counts toward the bound like the chunks.
+
+    def __init__(self, max_chars: int):
+        self.max_chars = max_chars
+        self._chunks: "OrderedDict[Tuple[str, bytes, bool], str]" = OrderedDict()
+        self._chars = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(key: Tuple[str, bytes, bool], chunk: str) -> int:
+        return len(key[0]) + len(key[1]) + len(chunk)
+
+    def get(self, key: Tuple[str, bytes, bool]):
+        with self._lock:
+            chunk = self._chunks.get(key)
+            if chunk is not None:
+                self._chunks.move_to_end(key)
+            return chunk
+
+    def put(self, key: Tuple[str, bytes, bool], chunk: str) -> None:
+        size = self._size(key, chunk)
+        if size > self.max_chars:
+            return
+        with self._lock:
+            if key in self._chunks:
+                return
+            self._chunks[key] = chunk
+            self._chars += size
+            while self._chars > self.max_chars:
+                evicted_key, evicted = self._chunks.popitem(last=False)
+                self._chars -= self._size(evicted_key, evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._chunks.clear()
+            self._chars = 0
+
+
+_render_cache = _RenderCache(RENDER_CACHE_MAX_CHARS)
+
+
+def content_digest(file_content: str) -> bytes:
+    # 128-bit digest of a file content, hashing is much cheaper than rendering.
+    return hashlib.blake2b(
+        file_content.encode("utf-8", "surrogatepass"), digest_size=16
+    ).digest()
+
+
+def render_file(
+    file_name: Union[str, Path],
+    file_content: str,
+    line_numbers: bool = True,
+    cache: bool = True,
+) -> str:
+    # Render a file as it appears in the chat, "File: name" and its numbered lines.
+    # The result is cached by content hash, unless `cache` is False, e.g. for a file
+    # read from disk only to be rendered.
+
+    if not cache:
+        return _render_chunk(file_name, file_content, line_numbers)
+    key = (str(file_name), content_digest(file_content), line_numbers)
+    chunk = _render_cache.get(key)
+    if chunk is None:
+        chunk = _render_chunk(file_name, file_content, line_numbers)
+        _render_cache.put(key, chunk)
+    return chunk
+
+
+def _render_chunk(
+    file_name: Union[str, Path], file_content: str, line_numbers: bool
+) -> str:
+    # The lines are numbered in a single pass.
+    if line_numbers:
+        body = "\n".join(
+            [
+                f"{line_number} {line_content}"
+                for line_number, line_content in enumerate(file_content.split("\n"), 1)
+            ]
+        )
+    else:
+        body = file_content
+    return f"File: {file_name}\n{body}\n\n"
 
 
 def file_to_lines_dict(file_content: str) -> dict:
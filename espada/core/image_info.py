@@ -0,0 +1,195 @@
+"""
+Dimensions of the images of vision prompts, read from their headers.
+
+The token cost of an image depends only on its width and height, which PNG and JPEG
+store in their first bytes, so only the base64 prefix holding the header is decoded
+instead of the whole image. The dimensions of the images seen last are kept, keyed by
+the base64 data, whose hash Python computes only once, so that an image is accounted
+for in microseconds on every turn of a conversation. Images loaded from disk are
+registered with the dimensions read from their raw bytes when they are encoded.
+"""
+
+import base64  # Importing base64 for decoding the prefix holding the header
+import binascii  # Importing binascii for the errors of base64 decoding
+import io  # Importing io for handing the decoded bytes to PIL
+import struct  # Importing struct for unpacking the dimensions from the header
+import threading  # Importing threading to guard the cache
+
+from collections import OrderedDict  # Importing OrderedDict for the LRU cache
+from dataclasses import dataclass, field  # Importing dataclass for the image metadata
+from typing import Callable, Dict, Optional, Tuple  # Importing type hints from typing
+
+from PIL import Image  # Importing Image from PIL for other formats
+
+IMAGE_INFO_CACHE_SIZE = 256
+# Prefix decoded first, enough for a PNG header and most JPEG headers, doubled if needed
+HEADER_PREFIX_CHARS = 4096
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_JPEG_SOI = b"\xff\xd8"
+# Start of frame markers, which hold the dimensions; C4, C8 and CC are not frames
+_JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# Markers without a length field
+_JPEG_STANDALONE_MARKERS = frozenset(range(0xD0, 0xDA)) | {0x01}
+
+
+@dataclass
+class ImageInfo:
+    width: int
+    height: int
+    # Token costs by detail, computed once per image
+    _costs: Dict[str, int] = field(default_factory=dict, repr=False, compare=False)
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self.width, self.height
+
+    def cost(self, detail: str, compute: Callable[[int, int], int]) -> int:
+        """Returns the token cost of the image for the detail, computed from the size once."""
+        cost = self._costs.get(detail)
+        if cost is None:
+            cost = self._costs[detail] = compute(self.width, self.height)
+        return cost
+
+
+class _Truncated(Exception):
+    # The header continues beyond the decoded prefix
+    pass
+
+
+def _png_size(data: bytes) -> Tuple[int, int]:
+    # The IHDR chunk comes first, right after the signature
+    if len(data) < 24:
+        raise _Truncated()
+    if data[12:16] != b"IHDR":
+        raise ValueError("PNG without an IHDR chunk")
+    return struct.unpack(">II", data[16:24])
+
+
+def _jpeg_size(data: bytes) -> Tuple[int, int]:
+    # Walks the segments up to the first start of frame
+    i = 2
+    while True:
+        while i < len(data) and data[i] == 0xFF:
+            i += 1  # skips fill bytes, the marker follows the last 0xFF
+        if i >= len(data):
+            raise _Truncated()
+        if data[i - 1] != 0xFF:
+            raise ValueError("JPEG segment without a marker")
+        marker = data[i]
+        if marker in _JPEG_STANDALONE_MARKERS:
+            i += 1
+            continue
+        if marker == 0xDA:
+            raise ValueError("JPEG scan before any frame")
+        if i + 8 > len(data):
+            raise _Truncated()
+        if marker in _JPEG_SOF_MARKERS:
+            height, width = struct.unpack(">HH", data[i + 4 : i + 8])
+            return width, height
+        (length,) = struct.unpack(">H", data[i + 1 : i + 3])
+        i += 1 + length
+
+
+def header_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """
+    Returns the (width, height) of a PNG or JPEG read from the first bytes of the
+    image, None if the format is not one of these or the header is malformed.
+    Raises _Truncated if the header continues beyond `data`.
+    """
+    try:
+        if data.startswith(_PNG_SIGNATURE):
+            return _png_size(data)
+        if data.startswith(_JPEG_SOI):
+            return _jpeg_size(data)
+    except (ValueError, struct.error):
+        return None
+    return None
+
+
+def _strip_data_url(image: str) -> str:
+    # Images are given as data URLs, "data:image/png;base64,<data>", or as bare base64
+    if image.startswith("data:"):
+        return image[image.find(",") + 1 :]
+    return image
+
+
+def _decoded_size(image_base64: str) -> Tuple[int, int]:
+    n_chars = HEADER_PREFIX_CHARS
+    while n_chars < len(image_base64):
+        try:
+            prefix = base64.b64decode(image_base64[: n_chars - n_chars % 4])
+            size = header_size(prefix)
+        except binascii.Error:
+            break  # e.g. line breaks, decoded in full below
+        except _Truncated:
+            n_chars *= 2
+            continue
+        if size is not None:
+            return size
+        break
+    image_data = base64.b64decode(image_base64)
+    try:
+        size = header_size(image_data)
+    except _Truncated:
+        size = None
+    if size is not None:
+        return size
+    with Image.open(io.BytesIO(image_data)) as image:
+        return image.size
+
+
+class _ImageInfoCache:
+    # Least recently used image metadata, keyed by the image as given
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._infos: "OrderedDict[str, ImageInfo]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, image: str) -> Optional[ImageInfo]:
+        with self._lock:
+            info = self._infos.get(image)
+            if info is not None:
+                self._infos.move_to_end(image)
+            return info
+
+    def put(self, image: str, info: ImageInfo) -> None:
+        with self._lock:
+            self._infos[image] = info
+            self._infos.move_to_end(image)
+            while len(self._infos) > self.max_size:
+                self._infos.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._infos.clear()
+
+
+_cache = _ImageInfoCache(IMAGE_INFO_CACHE_SIZE)
+
+
+def image_info(image: str) -> ImageInfo:
+    """Returns the metadata of a base64 image or data URL, from the cache if it was seen."""
+    info = _cache.get(image)
+    if info is None:
+        info = ImageInfo(*_decoded_size(_strip_data_url(image)))
+        _cache.put(image, info)
+    return info
+
+
+def register_image(image: str, image_data: bytes) -> None:
+    """Caches the metadata of an image that was encoded from `image_data`."""
+    if _cache.get(image) is not None:
+        return
+    try:
+        size = header_size(image_data)
+    except _Truncated:
+        size = None
+    if size is None:
+        try:
+            with Image.open(io.BytesIO(image_data)) as pil_image:
+                size = pil_image.size
+        except Exception:
+            return  # not an image PIL can read, the tokenizer will fail on it as before
+    _cache.put(image, ImageInfo(*size))
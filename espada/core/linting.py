@@ -30,11 +30,13 @@ class Linting:
         if config is None:
             config = {}
 
-        for filename, content in files_dict.items():
+        for filename in files_dict:
             extension = filename[
                 filename.rfind(".") :
             ].lower()  # Ensure case insensitivity
             if extension in self.linters:
+                # only the files that have a linter are read
+                content = files_dict[filename]
                 original_content = content
                 linted_content = self.linters[extension](content, config)
                 if linted_content != original_content:
@@ -0,0 +1,242 @@
+import hashlib  # Importing hashlib for content-addressed cache keys
+import json  # Importing json for normalizing messages before hashing
+import os  # Importing os for reading the cache location from the environment
+import sqlite3  # Importing sqlite3 for the on-disk cache tier
+import threading  # Importing threading for guarding the in-memory tier and connections
+import time  # Importing time for TTL bookkeeping
+
+from collections import OrderedDict  # Importing OrderedDict for the LRU tier
+from dataclasses import dataclass  # Importing dataclass for the cache statistics
+from pathlib import Path  # Importing Path for file path manipulations
+from typing import Any, List, Optional, Tuple, Union  # Importing type hints from typing
+
+DEFAULT_CACHE_DIR = Path(
+    os.getenv("ESPADA_CACHE_DIR", Path.home() / ".cache" / "espada")
+)  # Shared, cwd-independent location for the on-disk tier
+DEFAULT_CACHE_FILE = "llm_cache.db"  # File name of the on-disk tier
+DEFAULT_MAX_ENTRIES = 256  # Number of responses kept in the in-memory LRU tier
+DEFAULT_TTL = 7 * 24 * 60 * 60  # Seconds a cached response stays valid
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024  # Upper bound on the size of the on-disk tier
+
+
+@dataclass
+class CacheStats:
+    # Hit and miss counters of an LLMCache, for the current process
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+
+    @property
+    def hits(self) -> int:
+        return self.memory_hits + self.disk_hits
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class LLMCache:
+    """
+    Content-addressed cache of LLM responses.
+
+    Responses are keyed by a hash of the model name, the temperature and the
+    (collapsed) messages sent to the model. Lookups go through a size-bounded
+    in-memory LRU tier first and fall back to a SQLite database in WAL mode, which
+    many processes can read and write concurrently. Entries older than `ttl`
+    seconds are discarded, and the least recently used entries are evicted once
+    the database holds more than `max_bytes` of responses.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path, None] = None,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        ttl: Optional[float] = DEFAULT_TTL,
+        max_bytes: Optional[int] = DEFAULT_MAX_BYTES,
+    ):
+        self.path = Path(path) if path is not None else DEFAULT_CACHE_DIR / DEFAULT_CACHE_FILE
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.stats = CacheStats()
+        self._memory: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        # The total size of the responses is kept up to date by triggers, so that a put
+        # does not sum the whole table; databases created before it are summed once
+        self._connection().executescript(
+            """
+            BEGIN IMMEDIATE;
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at);
+            CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at);
+            CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+            INSERT OR IGNORE INTO meta (name, value)
+                SELECT 'total_size', COALESCE(SUM(size), 0) FROM responses;
+            CREATE TRIGGER IF NOT EXISTS responses_insert AFTER INSERT ON responses BEGIN
+                UPDATE meta SET value = value + NEW.size WHERE name = 'total_size';
+            END;
+            CREATE TRIGGER IF NOT EXISTS responses_update AFTER UPDATE OF size ON responses
+            BEGIN
+                UPDATE meta SET value = value + NEW.size - OLD.size
+                WHERE name = 'total_size';
+            END;
+            CREATE TRIGGER IF NOT EXISTS responses_delete AFTER DELETE ON responses BEGIN
+                UPDATE meta SET value = value - OLD.size WHERE name = 'total_size';
+            END;
+            COMMIT;
+            """
+        )
+
+    @staticmethod
+    def make_key(
+        model_name: str,
+        temperature: float,
+        messages: List[Any],
+        tools: Optional[List[dict]] = None,
+    ) -> str:
+        """Returns the content hash identifying a request to the model."""
+        payload = {
+            "model": model_name,
+            "temperature": round(float(temperature or 0), 6),
+            "messages": [
+                {"type": message.type, "content": message.content}
+                for message in messages
+            ],
+        }
+        if tools:
+            # a tool call answers in JSON, not in chat
+            payload["tools"] = tools
+        normalized = json.dumps(
+            payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+        )
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Returns the cached response for the key, or None if absent or expired."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, created_at = entry
+                if not self._is_expired(created_at, now):
+                    self._memory.move_to_end(key)
+                    self.stats.memory_hits += 1
+                    return value
+                del self._memory[key]
+
+        with self._connection() as conn:
+            row = conn.execute(
+                "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self._is_expired(row[1], now):
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is not None:
+                conn.execute(
+                    "UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key)
+                )
+
+        with self._lock:
+            if row is None:
+                self.stats.misses += 1
+                return None
+            self.stats.disk_hits += 1
+            self._remember(key, row[0], row[1])
+        return row[0]
+
+    def put(self, key: str, value: str) -> None:
+        """Stores a response in both tiers and evicts entries that no longer fit."""
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+
+        size = len(value.encode("utf-8"))
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO responses "
+                "(key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?) "
+                # an upsert rather than a replace, which would not fire the delete trigger
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value, "
+                "size = excluded.size, created_at = excluded.created_at, "
+                "accessed_at = excluded.accessed_at",
+                (key, value, size, now, now),
+            )
+            self._evict(conn, now)
+
+    def clear(self) -> None:
+        """Removes every entry from both tiers."""
+        with self._lock:
+            self._memory.clear()
+        with self._connection() as conn:
+            conn.execute("DELETE FROM responses")
+
+    def _remember(self, key: str, value: str, created_at: float) -> None:
+        # Must be called with the lock held
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _is_expired(self, created_at: float, now: float) -> bool:
+        return self.ttl is not None and now - created_at > self.ttl
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        if self.ttl is not None:
+            conn.execute(
+                "DELETE FROM responses WHERE created_at < ?", (now - self.ttl,)
+            )
+        if self.max_bytes is None:
+            return
+        total = self._total_size(conn)
+        if total <= self.max_bytes:
+            return
+        stale_keys = []
+        for key, size in conn.execute(
+            "SELECT key, size FROM responses ORDER BY accessed_at"
+        ):
+            if total <= self.max_bytes:
+                break
+            stale_keys.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM responses WHERE key = ?", stale_keys)
+
+    @staticmethod
+    def _total_size(conn: sqlite3.Connection) -> int:
+        (total,) = conn.execute(
+            "SELECT value FROM meta WHERE name = 'total_size'"
+        ).fetchone()
+        return total
+
+    def _connection(self) -> sqlite3.Connection:
+        # SQLite connections may not be shared across threads or forked processes,
+        # so every thread of every process opens its own
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+
+_response_cache: Optional[LLMCache] = None
+
+
+def set_response_cache(cache: Optional[LLMCache]) -> None:
+    """Sets the cache used by every AI that is not given one explicitly."""
+    global _response_cache
+    _response_cache = cache
+
+
+def get_response_cache() -> Optional[LLMCache]:
+    return _response_cache
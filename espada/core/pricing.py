@@ -0,0 +1,76 @@
+"""
+Prices of the models `AI` can talk to, in US dollars per million tokens.
+
+Models are looked up by the longest name prefix in `MODEL_PRICES`, so dated snapshots
+such as "gpt-4o-2024-08-06" or "claude-3-5-sonnet-20241022" are priced like their
+family, unless they are listed themselves. Azure deployments are priced like the
+OpenAI model they are named after. Local models, see the LOCAL_MODEL environment
+variable, cost nothing. Prompt tokens served from the provider's prompt cache are
+charged at the cached price; Anthropic's cache writes are charged as regular prompt
+tokens. Prices change, update the table rather than trusting it blindly.
+"""
+
+import os  # Importing os for the LOCAL_MODEL environment variable
+
+from dataclasses import dataclass  # Importing dataclass for the prices of a model
+from typing import Dict, Optional  # Importing type hints from typing
+
+
+@dataclass(frozen=True)
+class ModelPrice:
+    # US dollars per million tokens
+    prompt: float
+    completion: float
+    # Prompt tokens read from the provider's prompt cache, charged as prompt tokens if None
+    cached_prompt: Optional[float] = None
+
+    def cost(
+        self, prompt_tokens: int, completion_tokens: int, cached_prompt_tokens: int = 0
+    ) -> float:
+        """Returns the cost of a completion in US dollars."""
+        cached_prompt_tokens = min(cached_prompt_tokens, prompt_tokens)
+        cached_price = self.prompt if self.cached_prompt is None else self.cached_prompt
+        return (
+            (prompt_tokens - cached_prompt_tokens) * self.prompt
+            + cached_prompt_tokens * cached_price
+            + completion_tokens * self.completion
+        ) / 1_000_000
+
+
+FREE = ModelPrice(prompt=0.0, completion=0.0)
+
+MODEL_PRICES: Dict[str, ModelPrice] = {
+    # OpenAI, also served by Azure
+    "gpt-4o-mini": ModelPrice(prompt=0.15, completion=0.60, cached_prompt=0.075),
+    "gpt-4o-2024-05-13": ModelPrice(prompt=5.00, completion=15.00),
+    "gpt-4o": ModelPrice(prompt=2.50, completion=10.00, cached_prompt=1.25),
+    "gpt-4-turbo": ModelPrice(prompt=10.00, completion=30.00),
+    "gpt-4-1106": ModelPrice(prompt=10.00, completion=30.00),
+    "gpt-4-0125": ModelPrice(prompt=10.00, completion=30.00),
+    "gpt-4-vision": ModelPrice(prompt=10.00, completion=30.00),
+    "gpt-4-32k": ModelPrice(prompt=60.00, completion=120.00),
+    "gpt-4": ModelPrice(prompt=30.00, completion=60.00),
+    "gpt-35-turbo": ModelPrice(prompt=0.50, completion=1.50),  # Azure's spelling
+    "gpt-3.5-turbo": ModelPrice(prompt=0.50, completion=1.50),
+    "o1-mini": ModelPrice(prompt=3.00, completion=12.00, cached_prompt=1.50),
+    "o1": ModelPrice(prompt=15.00, completion=60.00, cached_prompt=7.50),
+    # Anthropic
+    "claude-3-5-sonnet": ModelPrice(prompt=3.00, completion=15.00, cached_prompt=0.30),
+    "claude-3-5-haiku": ModelPrice(prompt=0.80, completion=4.00, cached_prompt=0.08),
+    "claude-3-opus": ModelPrice(prompt=15.00, completion=75.00, cached_prompt=1.50),
+    "claude-3-sonnet": ModelPrice(prompt=3.00, completion=15.00, cached_prompt=0.30),
+    "claude-3-haiku": ModelPrice(prompt=0.25, completion=1.25, cached_prompt=0.03),
+    "claude-2": ModelPrice(prompt=8.00, completion=24.00),
+    "claude-instant": ModelPrice(prompt=0.80, completion=2.40),
+}
+
+
+def get_model_price(model_name: str) -> Optional[ModelPrice]:
+    """Returns the prices of the model, None if it is unknown."""
+    if os.getenv("LOCAL_MODEL"):
+        return FREE
+    name = model_name.lower()
+    prefixes = [prefix for prefix in MODEL_PRICES if name.startswith(prefix)]
+    if not prefixes:
+        return None
+    return MODEL_PRICES[max(prefixes, key=len)]
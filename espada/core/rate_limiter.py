@@ -0,0 +1,198 @@
+import asyncio  # Importing asyncio for waiting without blocking the event loop
+import os  # Importing os for reading the rate limits from the environment
+import random  # Importing random for jittering the waits of competing processes
+import sqlite3  # Importing sqlite3 for sharing the buckets between processes
+import threading  # Importing threading for per-thread connections
+import time  # Importing time for refilling the buckets
+
+from dataclasses import dataclass  # Importing dataclass for the rate limits
+from pathlib import Path  # Importing Path for file path manipulations
+from typing import Dict, Optional, Union  # Importing type hints from typing
+
+from espada.core.llm_cache import DEFAULT_CACHE_DIR  # Importing the state directory
+
+DEFAULT_STATE_FILE = "rate_limits.db"  # File name of the shared bucket state
+RATE_LIMITS_ENV_VAR = "ESPADA_RATE_LIMITS"  # e.g. "gpt-4o=500:30000,claude-3-opus=50:"
+
+
+@dataclass
+class RateLimit:
+    # Quota of a model, None meaning unlimited
+    requests_per_minute: Optional[float] = None
+    tokens_per_minute: Optional[float] = None
+
+
+class TokenBucketRateLimiter:
+    """
+    Proactive, cross-process rate limiter for a single model.
+
+    Two token buckets, one counting requests and one counting tokens, refill
+    continuously at the configured per-minute rates. Their levels are stored in a
+    SQLite database and updated under an exclusive transaction, so every process
+    on the machine draws from the same quota. A call waits until both buckets
+    hold enough for the request instead of being rejected by the provider.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        limit: RateLimit,
+        path: Union[str, Path, None] = None,
+    ):
+        self.model_name = model_name
+        self.limit = limit
+        self.path = Path(path) if path is not None else DEFAULT_CACHE_DIR / DEFAULT_STATE_FILE
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS buckets ("
+            "model TEXT PRIMARY KEY, "
+            "requests REAL NOT NULL, "
+            "tokens REAL NOT NULL, "
+            "updated_at REAL NOT NULL)"
+        )
+
+    def acquire(self, tokens: int) -> float:
+        """Blocks until the request fits the quota and returns the time waited."""
+        waited = 0.0
+        while True:
+            wait = self._try_acquire(tokens, time.time())
+            if wait == 0:
+                return waited
+            wait *= 1 + random.random() * 0.1
+            time.sleep(wait)
+            waited += wait
+
+    async def aacquire(self, tokens: int) -> float:
+        """Asynchronous counterpart of `acquire`."""
+        waited = 0.0
+        while True:
+            wait = await asyncio.to_thread(self._try_acquire, tokens, time.time())
+            if wait == 0:
+                return waited
+            wait *= 1 + random.random() * 0.1
+            await asyncio.sleep(wait)
+            waited += wait
+
+    def settle(self, tokens: int) -> None:
+        """
+        Charges tokens that were only known after the request, e.g. the completion.
+        The token bucket may go negative, which delays the following requests.
+        """
+        if self.limit.tokens_per_minute is None or tokens <= 0:
+            return
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            requests, available_tokens = self._refill(conn, time.time())
+            self._store(conn, requests, available_tokens - tokens, time.time())
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _try_acquire(self, tokens: int, now: float) -> float:
+        # Takes from both buckets if possible, otherwise returns the seconds to wait
+        rpm, tpm = self.limit.requests_per_minute, self.limit.tokens_per_minute
+        # a request larger than the whole bucket could never be served otherwise
+        tokens = min(tokens, tpm) if tpm is not None else tokens
+
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            requests, available_tokens = self._refill(conn, now)
+            missing_requests = 1 - requests if rpm is not None else 0
+            missing_tokens = tokens - available_tokens if tpm is not None else 0
+            if missing_requests <= 0 and missing_tokens <= 0:
+                requests -= 1
+                available_tokens -= tokens
+                wait = 0.0
+            else:
+                wait = max(
+                    missing_requests * 60 / rpm if missing_requests > 0 else 0,
+                    missing_tokens * 60 / tpm if missing_tokens > 0 else 0,
+                )
+            self._store(conn, requests, available_tokens, now)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+    def _refill(self, conn: sqlite3.Connection, now: float):
+        rpm, tpm = self.limit.requests_per_minute, self.limit.tokens_per_minute
+        row = conn.execute(
+            "SELECT requests, tokens, updated_at FROM buckets WHERE model = ?",
+            (self.model_name,),
+        ).fetchone()
+        if row is None:
+            return rpm or 0, tpm or 0
+        requests, tokens, updated_at = row
+        elapsed = max(now - updated_at, 0)
+        if rpm is not None:
+            requests = min(rpm, requests + elapsed * rpm / 60)
+        if tpm is not None:
+            tokens = min(tpm, tokens + elapsed * tpm / 60)
+        return requests, tokens
+
+    def _store(
+        self, conn: sqlite3.Connection, requests: float, tokens: float, now: float
+    ) -> None:
+        conn.execute(
+            "INSERT OR REPLACE INTO buckets (model, requests, tokens, updated_at) "
+            "VALUES (?, ?, ?, ?)",
+            (self.model_name, requests, tokens, now),
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        # Transactions are managed explicitly, hence autocommit mode
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+
+def parse_rate_limits(spec: str) -> Dict[str, RateLimit]:
+    """
+    Parses rate limits of the form "model=requests_per_minute:tokens_per_minute",
+    separated by commas. Either number may be left empty to leave it unlimited.
+    """
+    limits = {}
+    for entry in spec.split(","):
+        if not entry.strip():
+            continue
+        model_name, _, quota = entry.strip().rpartition("=")
+        if not model_name:
+            raise ValueError(f"Invalid rate limit {entry!r}, expected model=rpm:tpm")
+        rpm, _, tpm = quota.partition(":")
+        limits[model_name] = RateLimit(
+            requests_per_minute=float(rpm) if rpm else None,
+            tokens_per_minute=float(tpm) if tpm else None,
+        )
+    return limits
+
+
+_rate_limits: Dict[str, RateLimit] = {}
+
+
+def set_rate_limit(model_name: str, limit: Optional[RateLimit]) -> None:
+    """Configures the quota of a model for this process, overriding ESPADA_RATE_LIMITS."""
+    if limit is None:
+        _rate_limits.pop(model_name, None)
+    else:
+        _rate_limits[model_name] = limit
+
+
+def get_rate_limiter(model_name: str) -> Optional[TokenBucketRateLimiter]:
+    # The environment is read on every call since .env files are loaded late
+    limit = _rate_limits.get(model_name) or parse_rate_limits(
+        os.getenv(RATE_LIMITS_ENV_VAR, "")
+    ).get(model_name)
+    if limit is None:
+        return None
+    return TokenBucketRateLimiter(model_name, limit)
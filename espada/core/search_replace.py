@@ -0,0 +1,119 @@
+"""
+SEARCH/REPLACE edits, a cheaper alternative to unified diffs in improve mode.
+
+An edit names a file and gives a block of its code to search for and the code to
+replace it with. It carries no line numbers and no context beyond the searched
+block, so the code is uploaded without line numbers and the model writes fewer
+tokens than for a diff. The searched block is anchored in the file exactly if
+possible, then ignoring indentation and finally by line similarity, as in
+`espada.core.diff`.
+"""
+
+from typing import List, Optional, Tuple  # Importing type hints from typing
+
+from espada.core.diff import LineIndex, LineStore, is_similar  # Importing line matching
+
+SEARCH_MARKER = "<<<<<<< SEARCH"
+DIVIDER_MARKER = "======="
+REPLACE_MARKER = ">>>>>>> REPLACE"
+
+
+class SearchReplace:
+
+    __slots__ = ("filename", "search_lines", "replace_lines")
+
+    def __init__(
+        self, filename: str, search_lines: List[str], replace_lines: List[str]
+    ) -> None:
+        self.filename = filename
+        self.search_lines = search_lines
+        self.replace_lines = replace_lines
+
+    def creates_file(self) -> bool:
+        """An empty SEARCH section creates the file, or appends to it."""
+        return not any(line.strip() for line in self.search_lines)
+
+    def to_string(self) -> str:
+        """Converts the edit back to the format the LLM wrote it in."""
+        return "\n".join(
+            [self.filename, SEARCH_MARKER]
+            + self.search_lines
+            + [DIVIDER_MARKER]
+            + self.replace_lines
+            + [REPLACE_MARKER]
+        )
+
+    def locate(
+        self, lines: List[str], start: int = 0
+    ) -> Optional[Tuple[int, int, List[str]]]:
+        """
+        Finds the searched block in the lines of a file and returns the range of lines to
+        replace, as (first, end) indices, with the replacement lines. Matches at or after
+        `start` are preferred, since edits are given in the order of the file.
+        """
+        n_lines = len(self.search_lines)
+        first_line = self.search_lines[0]
+        for candidates in (range(start, len(lines)), range(0, start)):
+            for first in candidates:
+                if (
+                    lines[first] == first_line
+                    and lines[first : first + n_lines] == self.search_lines
+                ):
+                    return first, first + n_lines, self.replace_lines
+
+        # the indentation is often off, shift the replacement like the found block
+        stripped = [line.strip() for line in self.search_lines]
+        for candidates in (range(start, len(lines)), range(0, start)):
+            for first in candidates:
+                if lines[first].strip() == stripped[0] and [
+                    line.strip() for line in lines[first : first + n_lines]
+                ] == stripped:
+                    return (
+                        first,
+                        first + n_lines,
+                        self._reindent(lines[first : first + n_lines]),
+                    )
+
+        # otherwise every line must be similar, anchored at the first non-blank one
+        anchor = next(i for i, line in enumerate(self.search_lines) if line.strip())
+        # the lines change with every edit, so they are only indexed when needed
+        line_index = LineIndex(LineStore(lines))
+        firsts = [
+            line_number - 1 - anchor
+            for line_number in line_index.similar_lines(self.search_lines[anchor])
+        ]
+        matches = [
+            first
+            for first in firsts
+            if 0 <= first <= len(lines) - n_lines
+            and all(
+                is_similar(search_line, file_line)
+                for search_line, file_line in zip(
+                    self.search_lines, lines[first : first + n_lines]
+                )
+            )
+        ]
+        if not matches:
+            return None
+        first = next((first for first in matches if first >= start), matches[0])
+        return first, first + n_lines, self._reindent(lines[first : first + n_lines])
+
+    def _reindent(self, found_lines: List[str]) -> List[str]:
+        # Shifts the replacement by the indentation the found block has in addition
+        for search_line, found_line in zip(self.search_lines, found_lines):
+            if search_line.strip():
+                break
+        else:
+            return self.replace_lines
+        search_indent = search_line[: len(search_line) - len(search_line.lstrip())]
+        found_indent = found_line[: len(found_line) - len(found_line.lstrip())]
+        if found_indent.startswith(search_indent):
+            extra = found_indent[len(search_indent) :]
+            return [extra + line if line.strip() else line for line in self.replace_lines]
+        if search_indent.startswith(found_indent):
+            excess = search_indent[len(found_indent) :]
+            return [
+                line[len(excess) :] if line.startswith(excess) else line
+                for line in self.replace_lines
+            ]
+        return self.replace_lines
@@ -0,0 +1,155 @@
+"""
+Structured output, an alternative to scraping files and diffs from the chat with regexes.
+
+When the AI is created with `structured_output=True`, the steps bind a tool to the
+model and force it to call the tool, so that files, diffs and entrypoint scripts are
+emitted as JSON arguments, e.g. `{"files": [{"path": ..., "content": ...}]}`. The
+arguments are accumulated while they are streamed and handed to the steps as the
+content of the response, which is parsed in a single pass with `json.loads`. A
+response that is not a tool call, e.g. from a model without tool support or from
+the clipboard, is parsed from the chat as before.
+"""
+
+import json  # Importing json for parsing the arguments of tool calls
+
+from typing import Any, Dict, Optional, Tuple  # Importing type hints from typing
+
+# Importing the chat parsers, used when the response is not a tool call
+from espada.core.chat_to_files import DiffStreamParser, chat_to_files_dict, clean_path
+from espada.core.diff import Diff  # Importing the Diff class for the parsed hunks
+from espada.core.files_dict import FilesDict  # Importing FilesDict for the parsed files
+
+_FILES_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "path": {
+                "type": "string",
+                "description": "Lowercase relative path of the file, including its extension.",
+            },
+            "content": {
+                "type": "string",
+                "description": "Complete content of the file. No placeholders.",
+            },
+        },
+        "required": ["path", "content"],
+    },
+}
+
+FILES_TOOL = {
+    "name": "write_files",
+    "description": "Writes every file of the codebase with its complete content.",
+    "parameters": {
+        "type": "object",
+        "properties": {"files": _FILES_SCHEMA},
+        "required": ["files"],
+    },
+}
+
+EDITS_TOOL = {
+    "name": "edit_files",
+    "description": "Edits existing files with diff hunks and writes new files in full.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "diffs": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "path": {
+                            "type": "string",
+                            "description": "Path of an existing file, as it was given.",
+                        },
+                        "hunks": {
+                            "type": "array",
+                            "items": {"type": "string"},
+                            "description": "Hunks of the unified diff of the file, each starting with its @@ header.",
+                        },
+                    },
+                    "required": ["path", "hunks"],
+                },
+            },
+            "files": _FILES_SCHEMA,
+        },
+        "required": ["diffs"],
+    },
+}
+
+ENTRYPOINT_TOOL = {
+    "name": "write_entrypoint",
+    "description": "Writes the unix script that installs the dependencies and runs the codebase.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "script": {
+                "type": "string",
+                "description": "Content of the script, without a shebang.",
+            }
+        },
+        "required": ["script"],
+    },
+}
+
+
+def tool_kwargs(ai: Any, tool: dict) -> dict:
+    """Returns the keyword arguments of `AI.next` asking for a call of the tool, if the AI emits tool calls."""
+    if getattr(ai, "structured_output", False):
+        return {"tools": [tool]}
+    return {}
+
+
+def tool_arguments(response: str) -> Optional[dict]:
+    """Returns the arguments of a tool call response, or None if the response is chat."""
+    if not response.startswith("{"):
+        return None
+    try:
+        arguments = json.loads(response)
+    except ValueError:
+        return None
+    return arguments if isinstance(arguments, dict) else None
+
+
+def _files_from_arguments(files: Any) -> FilesDict:
+    # Tolerates entries that lack a path or content, they cannot be written anyway
+    files_dict = FilesDict()
+    for file in files or []:
+        if isinstance(file, dict) and file.get("path") and "content" in file:
+            files_dict[clean_path(file["path"])] = str(file["content"]).strip()
+    return files_dict
+
+
+def files_from_response(response: str) -> FilesDict:
+    """Returns the files written by a write_files tool call, or found in the chat."""
+    arguments = tool_arguments(response)
+    if arguments is None or "files" not in arguments:
+        return chat_to_files_dict(response)
+    return _files_from_arguments(arguments["files"])
+
+
+def entrypoint_from_response(response: str) -> Optional[str]:
+    """Returns the script written by a write_entrypoint tool call, None if the response is chat."""
+    arguments = tool_arguments(response)
+    if arguments is None or "script" not in arguments:
+        return None
+    return str(arguments["script"])
+
+
+def edits_from_response(response: str) -> Optional[Tuple[Dict[str, Diff], FilesDict]]:
+    """
+    Returns the diffs and the whole files written by an edit_files tool call, None if
+    the response is chat. The hunks of each file are put back under ---/+++ headers and
+    go through the same parser as the diffs in the chat, in a single pass.
+    """
+    arguments = tool_arguments(response)
+    if arguments is None or "diffs" not in arguments:
+        return None
+    parser = DiffStreamParser()
+    for diff in arguments["diffs"] or []:
+        if not isinstance(diff, dict) or not diff.get("path"):
+            continue
+        path = clean_path(diff["path"])
+        hunks = "\n".join(str(hunk).strip("\n") for hunk in diff.get("hunks") or [])
+        parser.feed(f"```diff\n--- {path}\n+++ {path}\n{hunks}\n```\n")
+    return parser.close(), _files_from_arguments(arguments.get("files"))
@@ -1,30 +1,31 @@
-import base64  # Importing base64 module for encoding and decoding base64 strings
-import io  # Importing io module for handling input and output operations
+import asyncio  # Importing asyncio module for running tokenization off the event loop
+import csv  # Importing csv module for exporting the log as CSV
+import hashlib  # Importing hashlib for the keys of the token counts
+import json  # Importing json module for exporting the log as JSON lines
 import logging  # Importing logging module for logging messages
 import math  # Importing math module for mathematical operations
+import threading  # Importing threading module to guard the cumulative counters
 
-from dataclasses import dataclass  # Importing dataclass decorator for creating data classes
-from typing import List, Union  # Importing List and Union types for type hinting
-
-import tiktoken  # Importing tiktoken module for tokenization
+from collections import OrderedDict  # Importing OrderedDict for the least recently used token counts
+from dataclasses import asdict, dataclass, fields  # Importing dataclass helpers for creating and exporting data classes
+from io import StringIO  # Importing StringIO for writing CSV to a string
+from pathlib import Path  # Importing Path for the export file
+from typing import List, Optional, Union  # Importing List, Optional and Union types for type hinting
 
 from langchain.schema import AIMessage, HumanMessage, SystemMessage  # Importing message classes from langchain schema
-from PIL import Image  # Importing Image class from PIL (Python Imaging Library) for image processing
 
-try:
-    from langchain.callbacks.openai_info import (
-        get_openai_token_cost_for_model,  # fmt: skip
-    )
-except ImportError:
-    from langchain_community.callbacks.openai_info import (
-        get_openai_token_cost_for_model,  # fmt: skip
-    )
+from espada.core.image_info import image_info  # Importing image_info for the cached dimensions of images
+from espada.core.pricing import get_model_price  # Importing get_model_price for the cost of each step
+from espada.core.tokenizer_registry import get_encoding_for_model  # Importing get_encoding_for_model for the shared encodings
 
 
 Message = Union[AIMessage, HumanMessage, SystemMessage]
 
 logger = logging.getLogger(__name__)
 
+# Number of texts whose token counts a tokenizer remembers
+TOKEN_COUNT_CACHE_SIZE = 4096
+
 
 @dataclass
 class TokenUsage:
@@ -36,6 +37,47 @@ class TokenUsage:
     total_prompt_tokens: int
     total_completion_tokens: int
     total_tokens: int
+    in_step_cached_prompt_tokens: int = 0
+    total_cached_prompt_tokens: int = 0
+    # US dollars, None if the model has no known price
+    in_step_cost: Optional[float] = None
+    total_cost: Optional[float] = None
+    # Seconds from the request to the first streamed token, None if nothing was streamed
+    time_to_first_token: Optional[float] = None
+    # Seconds from the request to the complete response
+    wall_time: Optional[float] = None
+    # Served from the response cache, so neither billed nor timed
+    cached_response: bool = False
+
+
+def text_digest(txt: str) -> bytes:
+    # Return a 128-bit digest of the text, a cache key that does not keep the text alive
+    return hashlib.blake2b(txt.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+
+def high_detail_image_tokens(width: int, height: int) -> int:
+    # Return the number of tokens of a high detail image of the given size
+
+    # Calculate the initial scale to fit within 2048 square while maintaining aspect ratio
+    max_dimension = max(width, height)
+    scale_factor = min(2048 / max_dimension, 1)  # Ensure we don't scale up
+    new_width = int(width * scale_factor)
+    new_height = int(height * scale_factor)
+
+    # Scale such that the shortest side is 768px
+    shortest_side = min(new_width, new_height)
+    if shortest_side > 768:
+        resize_factor = 768 / shortest_side
+        new_width = int(new_width * resize_factor)
+        new_height = int(new_height * resize_factor)
+
+    # Calculate the number of 512px tiles needed
+    width_tiles = math.ceil(new_width / 512)
+    height_tiles = math.ceil(new_height / 512)
+    total_tiles = width_tiles * height_tiles
+
+    # Each tile costs 170 tokens, plus a base cost of 85 tokens for high detail
+    return total_tiles * 170 + 85
 
 
 class Tokenizer:
@@ -44,15 +86,37 @@ class Tokenizer:
     def __init__(self, model_name):
         # Initialize the tokenizer with the model name
         self.model_name = model_name
-        self._tiktoken_tokenizer = (
-            tiktoken.encoding_for_model(model_name)
-            if "gpt-4" in model_name or "gpt-3.5" in model_name
-            else tiktoken.get_encoding("cl100k_base")
-        )
+        # The encoding is shared by the process and only loaded when first needed
+        self._encoding = None
+        # Conversations are counted again on every turn, so the counts of the texts
+        # seen last are kept, keyed by a digest so that the texts are not kept alive
+        self._token_counts: "OrderedDict[bytes, int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def _tiktoken_tokenizer(self):
+        if self._encoding is None:
+            self._encoding = get_encoding_for_model(self.model_name)
+        return self._encoding
+
+    @_tiktoken_tokenizer.setter
+    def _tiktoken_tokenizer(self, encoding) -> None:
+        self._encoding = encoding
 
     def num_tokens(self, txt: str) -> int:
-        # Return the number of tokens in the given text
-        return len(self._tiktoken_tokenizer.encode(txt))
+        # Return the number of tokens in the given text, only new texts are tokenized
+        key = text_digest(txt)
+        with self._lock:
+            n_tokens = self._token_counts.get(key)
+            if n_tokens is not None:
+                self._token_counts.move_to_end(key)
+                return n_tokens
+        n_tokens = len(self._tiktoken_tokenizer.encode(txt))
+        with self._lock:
+            self._token_counts[key] = n_tokens
+            if len(self._token_counts) > TOKEN_COUNT_CACHE_SIZE:
+                self._token_counts.popitem(last=False)
+        return n_tokens
 
     def num_tokens_for_base64_image(
         self, image_base64: str, detail: str = "high"
@@ -62,34 +126,8 @@ class Tokenizer:
         if detail == "low":
             return 85  # Fixed cost for low detail images
 
-        # Decode image from base64
-        image_data = base64.b64decode(image_base64)
-
-        # Convert byte data to image for size extraction
-        image = Image.open(io.BytesIO(image_data))
-
-        # Calculate the initial scale to fit within 2048 square while maintaining aspect ratio
-        max_dimension = max(image.size)
-        scale_factor = min(2048 / max_dimension, 1)  # Ensure we don't scale up
-        new_width = int(image.size[0] * scale_factor)
-        new_height = int(image.size[1] * scale_factor)
-
-        # Scale such that the shortest side is 768px
-        shortest_side = min(new_width, new_height)
-        if shortest_side > 768:
-            resize_factor = 768 / shortest_side
-            new_width = int(new_width * resize_factor)
-            new_height = int(new_height * resize_factor)
-
-        # Calculate the number of 512px tiles needed
-        width_tiles = math.ceil(new_width / 512)
-        height_tiles = math.ceil(new_height / 512)
-        total_tiles = width_tiles * height_tiles
-
-        # Each tile costs 170 tokens, plus a base cost of 85 tokens for high detail
-        token_cost = total_tiles * 170 + 85
-
-        return token_cost
+        # The size is read from the header once per image, see espada.core.image_info
+        return image_info(image_base64).cost(detail, high_detail_image_tokens)
 
     def num_tokens_from_messages(self, messages: List[Message]) -> int:
         # Return the number of tokens from a list of messages
@@ -127,30 +165,103 @@ class TokenUsageLog:
         self._cumulative_prompt_tokens = 0
         self._cumulative_completion_tokens = 0
         self._cumulative_total_tokens = 0
+        self._cumulative_cached_prompt_tokens = 0
+        self._cumulative_cost = 0.0
         self._log = []
         self._tokenizer = Tokenizer(model_name)
-
-    def update_log(self, messages: List[Message], answer: str, step_name: str) -> None:
-        # Update the log with new token usage data
-
-        prompt_tokens = self._tokenizer.num_tokens_from_messages(messages)
-        completion_tokens = self._tokenizer.num_tokens(answer)
+        self._price = get_model_price(model_name)
+        self._lock = threading.Lock()
+
+    @property
+    def tokenizer(self) -> Tokenizer:
+        # The tokenizer of the logged model, shared with e.g. the rate limiter
+        return self._tokenizer
+
+    def update_log(
+        self,
+        messages: List[Message],
+        answer: str,
+        step_name: str,
+        cached_prompt_tokens: int = 0,
+        prompt_tokens: Optional[int] = None,
+        completion_tokens: Optional[int] = None,
+        time_to_first_token: Optional[float] = None,
+        wall_time: Optional[float] = None,
+        cached_response: bool = False,
+    ) -> None:
+        # Update the log with new token usage data, cached_prompt_tokens being the
+        # part of the prompt the provider reported as served from its prompt cache.
+        # Token counts reported by the provider are authoritative, only the missing
+        # ones are counted locally. The step is priced on its own tokens only, and
+        # costs nothing if the response came from the response cache.
+
+        if prompt_tokens is None:
+            prompt_tokens = self._tokenizer.num_tokens_from_messages(messages)
+        if completion_tokens is None:
+            completion_tokens = self._tokenizer.num_tokens(answer)
         total_tokens = prompt_tokens + completion_tokens
+        if self._price is None:
+            in_step_cost = None
+        elif cached_response:
+            in_step_cost = 0.0
+        else:
+            in_step_cost = self._price.cost(
+                prompt_tokens, completion_tokens, cached_prompt_tokens
+            )
 
-        self._cumulative_prompt_tokens += prompt_tokens
-        self._cumulative_completion_tokens += completion_tokens
-        self._cumulative_total_tokens += total_tokens
-
-        self._log.append(
-            TokenUsage(
-                step_name=step_name,
-                in_step_prompt_tokens=prompt_tokens,
-                in_step_completion_tokens=completion_tokens,
-                in_step_total_tokens=total_tokens,
-                total_prompt_tokens=self._cumulative_prompt_tokens,
-                total_completion_tokens=self._cumulative_completion_tokens,
-                total_tokens=self._cumulative_total_tokens,
+        # Concurrent sessions may share one log, so the running totals and the
+        # entry they end up in are updated together
+        with self._lock:
+            self._cumulative_prompt_tokens += prompt_tokens
+            self._cumulative_completion_tokens += completion_tokens
+            self._cumulative_total_tokens += total_tokens
+            self._cumulative_cached_prompt_tokens += cached_prompt_tokens
+            if in_step_cost is not None:
+                self._cumulative_cost += in_step_cost
+
+            self._log.append(
+                TokenUsage(
+                    step_name=step_name,
+                    in_step_prompt_tokens=prompt_tokens,
+                    in_step_completion_tokens=completion_tokens,
+                    in_step_total_tokens=total_tokens,
+                    total_prompt_tokens=self._cumulative_prompt_tokens,
+                    total_completion_tokens=self._cumulative_completion_tokens,
+                    total_tokens=self._cumulative_total_tokens,
+                    in_step_cached_prompt_tokens=cached_prompt_tokens,
+                    total_cached_prompt_tokens=self._cumulative_cached_prompt_tokens,
+                    in_step_cost=in_step_cost,
+                    total_cost=None if in_step_cost is None else self._cumulative_cost,
+                    time_to_first_token=time_to_first_token,
+                    wall_time=wall_time,
+                    cached_response=cached_response,
+                )
             )
+
+    async def aupdate_log(
+        self,
+        messages: List[Message],
+        answer: str,
+        step_name: str,
+        cached_prompt_tokens: int = 0,
+        prompt_tokens: Optional[int] = None,
+        completion_tokens: Optional[int] = None,
+        time_to_first_token: Optional[float] = None,
+        wall_time: Optional[float] = None,
+        cached_response: bool = False,
+    ) -> None:
+        # Tokenize in a worker thread so concurrent sessions are not blocked by tiktoken
+        await asyncio.to_thread(
+            self.update_log,
+            messages,
+            answer,
+            step_name,
+            cached_prompt_tokens,
+            prompt_tokens,
+            completion_tokens,
+            time_to_first_token,
+            wall_time,
+            cached_response,
         )
 
     def log(self) -> List[TokenUsage]:
@@ -160,11 +271,33 @@ class TokenUsageLog:
     def format_log(self) -> str:
         # Format the log into a CSV string
 
-        result = "step_name,prompt_tokens_in_step,completion_tokens_in_step,total_tokens_in_step,total_prompt_tokens,total_completion_tokens,total_tokens\n"
+        result = "step_name,prompt_tokens_in_step,completion_tokens_in_step,total_tokens_in_step,total_prompt_tokens,total_completion_tokens,total_tokens,cached_prompt_tokens_in_step,total_cached_prompt_tokens\n"
         for log in self._log:
-            result += f"{log.step_name},{log.in_step_prompt_tokens},{log.in_step_completion_tokens},{log.in_step_total_tokens},{log.total_prompt_tokens},{log.total_completion_tokens},{log.total_tokens}\n"
+            result += f"{log.step_name},{log.in_step_prompt_tokens},{log.in_step_completion_tokens},{log.in_step_total_tokens},{log.total_prompt_tokens},{log.total_completion_tokens},{log.total_tokens},{log.in_step_cached_prompt_tokens},{log.total_cached_prompt_tokens}\n"
         return result
 
+    def to_csv(self) -> str:
+        # Format every field of the log, costs and latencies included, as CSV
+        output = StringIO()
+        writer = csv.DictWriter(
+            output,
+            fieldnames=[field.name for field in fields(TokenUsage)],
+            lineterminator="\n",
+        )
+        writer.writeheader()
+        writer.writerows(asdict(log) for log in self._log)
+        return output.getvalue()
+
+    def to_jsonl(self) -> str:
+        # Format every field of the log as one JSON object per step
+        return "".join(json.dumps(asdict(log)) + "\n" for log in self._log)
+
+    def export(self, path: Union[str, Path]) -> None:
+        # Write the log to a .csv file, or as JSON lines to any other file
+        path = Path(path)
+        content = self.to_csv() if path.suffix.lower() == ".csv" else self.to_jsonl()
+        path.write_text(content, encoding="utf-8")
+
     def is_openai_model(self) -> bool:
         # Check if the model is an OpenAI model
         return "gpt" in self.model_name.lower()
@@ -173,22 +306,20 @@ class TokenUsageLog:
         # Return the total number of tokens used
         return self._cumulative_total_tokens
 
-    def usage_cost(self) -> float | None:
-        # Calculate the usage cost for OpenAI models
+    def cached_prompt_tokens(self) -> int:
+        # Return the number of prompt tokens served from the provider's prompt cache
+        return self._cumulative_cached_prompt_tokens
 
-        if not self.is_openai_model():
-            return None
+    def uncached_prompt_tokens(self) -> int:
+        # Return the number of prompt tokens the provider had to process from scratch
+        return max(self._cumulative_prompt_tokens - self._cumulative_cached_prompt_tokens, 0)
 
-        try:
-            result = 0
-            for log in self.log():
-                result += get_openai_token_cost_for_model(
-                    self.model_name, log.total_prompt_tokens, is_completion=False
-                )
-                result += get_openai_token_cost_for_model(
-                    self.model_name, log.total_completion_tokens, is_completion=True
-                )
-            return result
-        except Exception as e:
-            print(f"Error calculating usage cost: {e}")
+    def usage_cost(self) -> float | None:
+        # Return the cost of all steps in US dollars, None if the model has no known price
+        if self._price is None:
             return None
+        return self._cumulative_cost
+
+    def wall_time(self) -> float:
+        # Return the seconds spent waiting for the model over all steps
+        return sum(log.wall_time or 0.0 for log in self._log)
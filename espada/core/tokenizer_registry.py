@@ -0,0 +1,129 @@
+"""
+Process-wide registry of tiktoken encodings, shared by every `Tokenizer`.
+
+Loading an encoding reads its BPE ranks and, on a cold cache, downloads them, which
+used to happen whenever an `AI` was created. Encodings are now loaded once per
+process, on first use, and the CLI warms them up on a background thread at startup so
+that neither the startup nor the creation of an `AI` waits for them.
+
+To run offline, put the encoding files, e.g. cl100k_base.tiktoken and
+o200k_base.tiktoken as published by OpenAI, in a directory and point the
+ESPADA_TIKTOKEN_DIR environment variable at it. They are copied into tiktoken's
+cache, see TIKTOKEN_CACHE_DIR, where tiktoken finds and verifies them instead of
+downloading them.
+"""
+
+import hashlib  # Importing hashlib for the names of tiktoken's cache files
+import logging  # Importing logging for the failures of the warm-up
+import os  # Importing os for the cache and bundle directories
+import tempfile  # Importing tempfile for tiktoken's default cache directory
+import threading  # Importing threading for loading encodings once and in the background
+import uuid  # Importing uuid for the temporary files of the cache
+
+from concurrent.futures import Future  # Importing Future for encodings being loaded
+from pathlib import Path  # Importing Path for file path manipulations
+from typing import Any, Dict, Iterable, Optional  # Importing type hints from typing
+
+import tiktoken  # Importing tiktoken for the encodings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ENCODING = "cl100k_base"
+TIKTOKEN_DIR_ENV_VAR = "ESPADA_TIKTOKEN_DIR"  # directory of bundled <encoding>.tiktoken files
+# Where tiktoken downloads the encodings from, its cache files are named by the URL
+TIKTOKEN_URL = "https://openaipublic.blob.core.windows.net/encodings/{name}.tiktoken"
+
+_encodings: Dict[str, "Future[Any]"] = {}
+_lock = threading.Lock()
+
+
+def encoding_name_for_model(model_name: str) -> str:
+    """Returns the name of the encoding used to count the tokens of the model."""
+    if "gpt-4" in model_name or "gpt-3.5" in model_name:
+        try:
+            return tiktoken.encoding_name_for_model(model_name)
+        except KeyError:
+            pass
+    return DEFAULT_ENCODING
+
+
+def _tiktoken_cache_dir() -> Optional[Path]:
+    # Mirrors the lookup of tiktoken.load.read_file_cached, an empty value disables the cache
+    for env_var in ("TIKTOKEN_CACHE_DIR", "DATA_GYM_CACHE_DIR"):
+        if env_var in os.environ:
+            return Path(os.environ[env_var]) if os.environ[env_var] else None
+    return Path(tempfile.gettempdir()) / "data-gym-cache"
+
+
+def seed_tiktoken_cache(name: str, bundle_dir: Optional[str] = None) -> bool:
+    """
+    Copies the bundled file of the encoding into tiktoken's cache, unless it is cached
+    already. Returns whether the encoding can be loaded from the cache.
+    """
+    bundle_dir = bundle_dir or os.getenv(TIKTOKEN_DIR_ENV_VAR)
+    cache_dir = _tiktoken_cache_dir()
+    if not bundle_dir or cache_dir is None:
+        return False
+    bundled = Path(bundle_dir) / f"{name}.tiktoken"
+    url = TIKTOKEN_URL.format(name=name)
+    cache_path = cache_dir / hashlib.sha1(url.encode()).hexdigest()
+    if cache_path.exists():
+        return True
+    if not bundled.is_file():
+        return False
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    # Written aside and renamed, so other processes never read a partial file
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{uuid.uuid4()}.tmp")
+    tmp_path.write_bytes(bundled.read_bytes())
+    os.replace(tmp_path, cache_path)
+    return True
+
+
+def _load_encoding(name: str) -> Any:
+    seed_tiktoken_cache(name)
+    return tiktoken.get_encoding(name)
+
+
+def get_encoding(name: str) -> Any:
+    """
+    Returns the encoding, loading it if no thread has yet. Threads asking for an
+    encoding that is being loaded wait for it rather than loading it again.
+    """
+    with _lock:
+        future = _encodings.get(name)
+        loading = future is None
+        if loading:
+            future = _encodings[name] = Future()
+    if loading:
+        try:
+            future.set_result(_load_encoding(name))
+        except BaseException as e:
+            with _lock:
+                del _encodings[name]  # a later call may succeed, e.g. once online
+            future.set_exception(e)
+    return future.result()
+
+
+def get_encoding_for_model(model_name: str) -> Any:
+    """Returns the encoding used to count the tokens of the model."""
+    return get_encoding(encoding_name_for_model(model_name))
+
+
+def _warm_up(names: Iterable[str]) -> None:
+    for name in names:
+        try:
+            get_encoding(name)
+        except Exception as e:
+            # The tokenizer retries, and reports the error, when it is used
+            logger.debug("Could not warm up the %s encoding: %s", name, e)
+
+
+def warm_up(model_names: Iterable[str] = ()) -> threading.Thread:
+    """Loads the encodings of the models, and the default one, on a background thread."""
+    names = [encoding_name_for_model(model_name) for model_name in model_names]
+    names = list(dict.fromkeys([*names, DEFAULT_ENCODING]))
+    thread = threading.Thread(
+        target=_warm_up, args=(names,), name="tokenizer-warm-up", daemon=True
+    )
+    thread.start()
+    return thread
@@ -7,12 +7,12 @@ from langchain.schema import AIMessage, HumanMessage, SystemMessage  # Import me
 from espada.core.ai import AI  # Import AI class from espada.core.ai
 from espada.core.base_execution_env import BaseExecutionEnv  # Import BaseExecutionEnv class from espada.core.base_execution_env
 from espada.core.base_memory import BaseMemory  # Import BaseMemory class from espada.core.base_memory
-from espada.core.chat_to_files import chat_to_files_dict  # Import chat_to_files_dict function from espada.core.chat_to_files
 from espada.core.default.paths import CODE_GEN_LOG_FILE, ENTRYPOINT_FILE  # Import constants from espada.core.default.paths
-from espada.core.default.steps import curr_fn, improve_fn, setup_sys_prompt  # Import functions from espada.core.default.steps
+from espada.core.default.steps import curr_fn, file_format_preprompt, improve_fn, setup_sys_prompt  # Import functions from espada.core.default.steps
 from espada.core.files_dict import FilesDict  # Import FilesDict class from espada.core.files_dict
 from espada.core.preprompts_holder import PrepromptsHolder  # Import PrepromptsHolder class from espada.core.preprompts_holder
 from espada.core.prompt import Prompt  # Import Prompt class from espada.core.prompt
+from espada.core.structured_output import FILES_TOOL, files_from_response, tool_kwargs  # Import the write_files tool and the parser of its calls
 
 # Type hint for chat messages
 Message = Union[AIMessage, HumanMessage, SystemMessage]
@@ -116,20 +116,22 @@ def clarified_gen(
 
     print()
 
+    file_format = file_format_preprompt(ai)
     messages = [
-        SystemMessage(content=setup_sys_prompt(preprompts)),
+        SystemMessage(content=setup_sys_prompt(preprompts, file_format)),
     ] + messages[
         1:
     ]  # skip the first clarify message, which was the original clarify priming prompt
     messages = ai.next(
         messages,
-        preprompts["generate"].replace("FILE_FORMAT", preprompts["file_format"]),
+        preprompts["generate"].replace("FILE_FORMAT", preprompts[file_format]),
         step_name=curr_fn(),
+        **tool_kwargs(ai, FILES_TOOL),
     )
     print()
     chat = messages[-1].content.strip()
     memory.log(CODE_GEN_LOG_FILE, "\n\n".join(x.pretty_repr() for x in messages))
-    files_dict = chat_to_files_dict(chat)
+    files_dict = files_from_response(chat)
     return files_dict
 
 
@@ -139,9 +141,12 @@ def lite_gen(
 
     preprompts = preprompts_holder.get_preprompts()
     messages = ai.start(
-        prompt.to_langchain_content(), preprompts["file_format"], step_name=curr_fn()
+        prompt.to_langchain_content(),
+        preprompts[file_format_preprompt(ai)],
+        step_name=curr_fn(),
+        **tool_kwargs(ai, FILES_TOOL),
     )
     chat = messages[-1].content.strip()
     memory.log(CODE_GEN_LOG_FILE, "\n\n".join(x.pretty_repr() for x in messages))
-    files_dict = chat_to_files_dict(chat)
+    files_dict = files_from_response(chat)
     return files_dict
@@ -0,0 +1,207 @@
+"""
+This module benchmarks the diff pipeline of improve mode on synthetic files, to check
+that parsing, validating and applying diffs scale with the size of the file and the diff.
+"""
+
+import contextlib
+import copy
+import io
+import random
+import time
+
+from typing import Callable, List, Optional, Tuple
+
+import typer
+
+from espada.core import diff as diff_module
+from espada.core.chat_to_files import apply_diffs, parse_diffs, validate_and_apply_diffs
+from espada.core.diff import EXACT_MATCH
+from espada.core.files_dict import FilesDict, file_to_lines_dict
+
+app = typer.Typer()
+
+FILE_NAME = "bench.py"
+
+
+def make_lines(n_lines: int, rng: random.Random) -> List[str]:
+    """Returns `n_lines` varied lines of synthetic Python code."""
+    words = ["total", "items", "result", "config", "path", "index", "buffer", "user"]
+    calls = ["load", "compute", "merge", "validate", "render", "parse", "flush"]
+    return [
+        "    " * rng.randint(1, 3)
+        + f"{rng.choice(words)}_{i} = {rng.choice(calls)}("
+        + ", ".join(rng.sample(words, rng.randint(0, 4)))
+        + f", {rng.randint(0, 10 ** rng.randint(1, 6))})"
+        for i in range(n_lines)
+    ]
+
+
+def make_case(n_lines: int, n_hunks: int, seed: int = 0) -> Tuple[str, str]:
+    """
+    Returns the content of a synthetic file and an LLM-style response with a diff
+    that edits it in `n_hunks` evenly spaced places.
+    """
+    lines = make_lines(n_lines, random.Random(seed))
+    stride = max(n_lines // max(n_hunks, 1), 4)
+    diff_lines = [f"--- {FILE_NAME}", f"+++ {FILE_NAME}"]
+    offset = 0
+    for start in range(1, n_lines - 3, stride)[:n_hunks]:
+        diff_lines.append(f"@@ -{start},3 +{start + offset},4 @@")
+        diff_lines.append(" " + lines[start - 1])
+        diff_lines.append("-" + lines[start])
+        diff_lines.append("+" + lines[start].replace("compute", "recompute"))
+        diff_lines.append("+    # changed by the benchmark")
+        diff_lines.append(" " + lines[start + 1])
+        offset += 1
+    response = "Here are the changes:\n```diff\n" + "\n".join(diff_lines) + "\n```\n"
+    return "\n".join(lines), response
+
+
+def make_sloppy_case(n_lines: int, n_hunks: int, seed: int = 0) -> Tuple[str, str]:
+    """
+    Returns the content of a synthetic file and a response with `n_hunks` long hunks
+    that together span the file, written the way LLMs get them wrong: some context
+    lines are skipped and comments are added as if they were context.
+    """
+    lines = make_lines(n_lines, random.Random(seed))
+    # skipped lines stand out from their neighbours, as they mostly do in real code
+    lines = [
+        f"    assert check_{i}('{'x' * 40}')" if i % 20 == 12 else line
+        for i, line in enumerate(lines)
+    ]
+    stride = max(n_lines // max(n_hunks, 1), 20)
+    diff_lines = [f"--- {FILE_NAME}", f"+++ {FILE_NAME}"]
+    for start in range(0, n_lines, stride)[:n_hunks]:
+        end = min(start + stride, n_lines)
+        diff_lines.append(f"@@ -{start + 1},{end - start} +{start + 1},{end - start} @@")
+        for i in range(start, end):
+            # near the end of the file there is too little code left to tell
+            if i % 20 == 12 and i < n_lines - 20:
+                continue
+            if i % 20 == 15:
+                diff_lines.append(" # the next line stays the same")
+            diff_lines.append(("-" if i % 5 == 0 else " ") + lines[i])
+            if i % 7 == 0:
+                diff_lines.append("+    record()")
+    response = "Here are the changes:\n```diff\n" + "\n".join(diff_lines) + "\n```\n"
+    return "\n".join(lines), response
+
+
+def best_time(
+    fn: Callable[..., object],
+    repeat: int,
+    setup: Optional[Callable[[], object]] = None,
+) -> float:
+    """
+    Returns the fastest of `repeat` runs of `fn`, in seconds. If given, `setup` runs
+    untimed before every run and its result is passed to `fn`.
+    """
+    timings = []
+    for _ in range(repeat):
+        args = (setup(),) if setup is not None else ()
+        start = time.perf_counter()
+        fn(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def make_files(
+    case: Callable[[int, int], Tuple[str, str]], n_files: int, n_lines: int, n_hunks: int
+) -> Tuple[FilesDict, str]:
+    """Returns `n_files` files made by `case` and a response editing all of them."""
+    content, response = case(n_lines, n_hunks)
+    if n_files == 1:
+        return FilesDict({FILE_NAME: content}), response
+    names = [f"bench{i}.py" for i in range(n_files)]
+    files = FilesDict({name: content for name in names})
+    return files, "".join(response.replace(FILE_NAME, name) for name in names)
+
+
+def validate(diffs: dict, files: FilesDict) -> None:
+    """Validates and corrects the diffs like salvage_correct_hunks does."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        for diff in diffs.values():
+            diff.validate_and_correct(file_to_lines_dict(files[diff.filename_pre]))
+
+
+def validate_and_apply(diffs: dict, files: FilesDict, workers: int) -> None:
+    """Validates, corrects and applies the diffs in `workers` processes."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        validate_and_apply_diffs(diffs, files, workers=workers)
+
+
+@app.command()
+def main(
+    sizes: List[int] = typer.Option(
+        [1_000, 10_000, 100_000], "--size", help="Number of lines of the edited file."
+    ),
+    hunks: List[int] = typer.Option(
+        [10, 100, 500, 2000], "--hunks", help="Number of hunks in the diff."
+    ),
+    repeat: int = typer.Option(5, "--repeat", help="Runs per measurement."),
+    sloppy: bool = typer.Option(
+        False,
+        "--sloppy",
+        help="Use long hunks with skipped context lines and LLM comments to correct.",
+    ),
+    use_numpy: bool = typer.Option(
+        True,
+        "--numpy/--no-numpy",
+        help="Compute similarity ratios with numpy, if installed, or one by one.",
+    ),
+    n_files: int = typer.Option(
+        1, "--files", help="Number of files edited by the response, all alike."
+    ),
+    workers: int = typer.Option(
+        0,
+        "--workers",
+        help="Processes validating and applying the diffs of different files.",
+    ),
+):
+    """
+    Prints the time needed to parse, validate and apply a diff for every combination
+    of file size and hunk count, together with the cost of validating per hunk and
+    of applying per file line, which stay flat as long as both scale linearly. The last
+    column times both steps together with `--workers` processes, and the one before
+    gives the share of hunks that applied exactly and skipped the fuzzy correction.
+    """
+    if not use_numpy:
+        diff_module.np = None
+    print(
+        f"{'lines':>8} {'hunks':>6} {'parse ms':>10} {'validate ms':>12} "
+        f"{'validate us/hunk':>17} {'exact %':>8} {'apply ms':>10} "
+        f"{'apply us/line':>14} {'both ms':>10}"
+    )
+    for n_lines in sizes:
+        for n_hunks in hunks:
+            case = make_sloppy_case if sloppy else make_case
+            files, response = make_files(case, n_files, n_lines, n_hunks)
+            diffs = parse_diffs(response)
+            # small files fit fewer hunks than requested
+            n_hunks = sum(len(diff.hunks) for diff in diffs.values())
+            parse_time = best_time(lambda: parse_diffs(response), repeat)
+            validate_time = best_time(
+                lambda fresh_diffs: validate(fresh_diffs, files),
+                repeat,
+                setup=lambda: copy.deepcopy(diffs),
+            )
+            validated = copy.deepcopy(diffs)
+            validate(validated, files)
+            n_exact = sum(diff.hunk_paths[EXACT_MATCH] for diff in validated.values())
+            apply_time = best_time(lambda: apply_diffs(diffs, files), repeat)
+            both_time = best_time(
+                lambda fresh_diffs: validate_and_apply(fresh_diffs, files, workers),
+                repeat,
+                setup=lambda: copy.deepcopy(diffs),
+            )
+            print(
+                f"{n_lines:>8} {n_hunks:>6} {parse_time * 1e3:>10.2f} "
+                f"{validate_time * 1e3:>12.2f} {validate_time * 1e6 / n_hunks:>17.1f} "
+                f"{n_exact * 100 / n_hunks:>8.0f} {apply_time * 1e3:>10.2f} "
+                f"{apply_time * 1e6 / (n_lines * n_files):>14.3f} "
+                f"{both_time * 1e3:>10.2f}"
+            )
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,71 @@
+import contextlib
+import io
+
+import pytest
+
+from langchain.schema import AIMessage
+
+from espada.core.default.constants import WHOLE_FILE_MAX_TOKENS
+from espada.core.default.disk_memory import DiskMemory
+from espada.core.default.edit_policy import (
+    DELTA_CONTEXT,
+    FULL_CONTEXT,
+    choose_whole_files,
+    diff_retry_rate,
+    get_retry_context,
+    record_diff_response,
+    whole_file_max_tokens,
+)
+from espada.core.default.paths import DIFF_LOG_FILE
+from espada.core.default.steps import salvage_correct_hunks
+from espada.core.files_dict import FilesDict
+
+
+def test_diff_retry_rate_from_recorded_responses(tmp_path):
+    memory = DiskMemory(tmp_path)
+    assert diff_retry_rate(memory) is None
+
+    record_diff_response(memory, retried=True)
+    record_diff_response(memory, retried=False)
+    record_diff_response(memory, retried=False)
+    record_diff_response(memory, retried=True)
+    assert diff_retry_rate(memory) == 0.5
+
+
+def test_diff_retry_rate_survives_archived_logs(tmp_path):
+    memory = DiskMemory(tmp_path)
+    files = FilesDict({"a.py": "one\ntwo"})
+    failing_diff = "```diff\n--- a.py\n+++ a.py\n@@ -1,2 +1,2 @@\n three\n-four\n+4\n```"
+    with contextlib.redirect_stdout(io.StringIO()):
+        salvage_correct_hunks([AIMessage(content=failing_diff)], files, memory)
+    assert memory.get(f"logs/{DIFF_LOG_FILE}")
+
+    # the CLI archives the logs of the previous run before improving again
+    memory.archive_logs()
+    assert diff_retry_rate(memory) == 1.0
+
+
+def test_failing_diffs_raise_the_size_of_whole_files():
+    assert whole_file_max_tokens(None) == WHOLE_FILE_MAX_TOKENS
+    assert whole_file_max_tokens(0.0) == WHOLE_FILE_MAX_TOKENS
+    assert whole_file_max_tokens(0.5) > WHOLE_FILE_MAX_TOKENS
+
+
+def test_choose_whole_files_by_size():
+    files = FilesDict(
+        {
+            "small.py": "x" * WHOLE_FILE_MAX_TOKENS,
+            "large.py": "x" * (WHOLE_FILE_MAX_TOKENS + 1),
+        }
+    )
+    assert choose_whole_files(files, len) == ["small.py"]
+    assert choose_whole_files(files, len, retry_rate=1.0) == ["small.py", "large.py"]
+
+
+def test_retry_context_from_environment(monkeypatch):
+    assert get_retry_context() == FULL_CONTEXT
+    monkeypatch.setenv("ESPADA_RETRY_CONTEXT", "delta")
+    assert get_retry_context() == DELTA_CONTEXT
+    monkeypatch.setenv("ESPADA_RETRY_CONTEXT", "partial")
+    with pytest.raises(ValueError):
+        get_retry_context()
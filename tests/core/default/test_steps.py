@@ -1,11 +1,12 @@
 # Generated by CodiumAI
+import json
 import tempfile
 
 from unittest.mock import MagicMock
 
 import pytest
 
-from langchain.schema import SystemMessage
+from langchain.schema import AIMessage, SystemMessage
 
 from espada.core.ai import AI
 from espada.core.default.disk_memory import DiskMemory
@@ -160,6 +161,28 @@ class TestGenCode:
             code["nonexistent_file.py"]
 
 
+    def test_generates_code_from_tool_call(self):
+        class MockAI:
+            structured_output = True
+
+            def start(self, sys_prompt, user_prompt, step_name, tools):
+                self.sys_prompt, self.tools = sys_prompt, tools
+                return [
+                    SystemMessage(
+                        content='{"files": [{"path": "main.py", "content": "print(1)\\n"}]}'
+                    )
+                ]
+
+        ai = MockAI()
+        memory = DiskMemory(tempfile.mkdtemp())
+        preprompts_holder = PrepromptsHolder(PREPROMPTS_PATH)
+        code = gen_code(ai, Prompt("Print one."), memory, preprompts_holder)
+
+        assert code == {"main.py": "print(1)"}
+        assert [tool["name"] for tool in ai.tools] == ["write_files"]
+        assert "write_files tool" in ai.sys_prompt
+
+
 class TestStepUtilities:
     def test_called_from_function(self):
         # Arrange
@@ -312,6 +335,162 @@ Some introductory text.
         )
         assert improved_code == expected_code
 
+    def test_improve_existing_code_with_search_replace(self, tmp_path, monkeypatch):
+        monkeypatch.setenv("ESPADA_EDIT_FORMAT", "search_replace")
+        ai_response = """
+main.py
+```python
+<<<<<<< SEARCH
+print('Hello, World!')
+=======
+print('Goodbye, World!')
+>>>>>>> REPLACE
+```
+"""
+        ai_mock = MagicMock(spec=AI)
+        ai_mock.next.return_value = [SystemMessage(content=ai_response)]
+        code = FilesDict(
+            {"main.py": "print('Hello, World!')", "README.md": "A sample repository."}
+        )
+
+        preprompts_holder = PrepromptsHolder(PREPROMPTS_PATH)
+        improved_code = improve_fn(
+            ai_mock, Prompt("Say goodbye"), code, DiskMemory(tmp_path), preprompts_holder
+        )
+
+        assert improved_code == {
+            "main.py": "print('Goodbye, World!')",
+            "README.md": "A sample repository.",
+        }
+        system_message, files_message = ai_mock.next.call_args[0][0][:2]
+        assert "SEARCH/REPLACE" in system_message.content
+        # the files are uploaded without line numbers
+        assert "File: main.py\nprint('Hello, World!')\n" in files_message.content
+
+    def test_improve_asks_for_small_files_in_full(self, tmp_path):
+        ai_response = """
+main.py
+```python
+print('Goodbye, World!')
+```
+"""
+        ai_mock = MagicMock(spec=AI)
+        ai_mock.token_usage_log = MagicMock()
+        ai_mock.token_usage_log.tokenizer.num_tokens = len
+        ai_mock.next.return_value = [SystemMessage(content=ai_response)]
+        code = FilesDict(
+            {"main.py": "print('Hello, World!')", "big.py": "x = 1\n" * 1000}
+        )
+
+        preprompts_holder = PrepromptsHolder(PREPROMPTS_PATH)
+        improved_code = improve_fn(
+            ai_mock, Prompt("Say goodbye"), code, DiskMemory(tmp_path), preprompts_holder
+        )
+
+        assert improved_code == {**code, "main.py": "print('Goodbye, World!')"}
+        messages = ai_mock.next.call_args[0][0]
+        assert preprompts_holder.get_preprompts()["file_format_whole"] in (
+            messages[0].content
+        )
+        assert messages[2].content == "Whole files:\nmain.py"
+
+    def test_improve_existing_code_with_tool_call(self, tmp_path):
+        ai_response = json.dumps(
+            {
+                "diffs": [
+                    {
+                        "path": "main.py",
+                        "hunks": [
+                            "@@ -1,1 +1,1 @@\n-print('Hello, World!')\n+print('Goodbye, World!')"
+                        ],
+                    }
+                ],
+                "files": [{"path": "notes.txt", "content": "Said goodbye."}],
+            }
+        )
+        ai_mock = MagicMock(spec=AI)
+        ai_mock.structured_output = True
+        ai_mock.next.return_value = [SystemMessage(content=ai_response)]
+        code = FilesDict({"main.py": "print('Hello, World!')"})
+
+        preprompts_holder = PrepromptsHolder(PREPROMPTS_PATH)
+        improved_code = improve_fn(
+            ai_mock, Prompt("Say goodbye"), code, DiskMemory(tmp_path), preprompts_holder
+        )
+
+        assert improved_code == {
+            "main.py": "print('Goodbye, World!')",
+            "notes.txt": "Said goodbye.",
+        }
+        assert ai_mock.next.call_args[1]["tools"][0]["name"] == "edit_files"
+        assert "edit_files tool" in ai_mock.next.call_args[0][0][0].content
+
+    def test_delta_retry_sends_only_the_failed_hunks(self, tmp_path, monkeypatch):
+        monkeypatch.setenv("ESPADA_RETRY_CONTEXT", "delta")
+        code = FilesDict(
+            {
+                "main.py": "\n".join(f"value_{i} = {i}" for i in range(1, 101)),
+                "other.py": "print('unrelated')",
+            }
+        )
+        first_response = """
+```diff
+--- main.py
++++ main.py
+@@ -2,1 +2,2 @@
+ value_2 = 2
++value_2b = 2.5
+@@ -60,2 +61,2 @@
+-this line is not in the file at all
++value_60 = 600
+ and neither is this one
+```
+"""
+        second_response = """
+```diff
+--- main.py
++++ main.py
+@@ -61,1 +61,1 @@
+-value_60 = 60
++value_60 = 600
+```
+"""
+        sent = []
+
+        def next_response(messages, *args, **kwargs):
+            sent.append(list(messages))
+            return messages + [
+                AIMessage(content=[first_response, second_response][len(sent) - 1])
+            ]
+
+        ai_mock = MagicMock(spec=AI)
+        ai_mock.next.side_effect = next_response
+
+        improved_code = improve_fn(
+            ai_mock,
+            Prompt("Change value_60"),
+            code,
+            DiskMemory(tmp_path),
+            PrepromptsHolder(PREPROMPTS_PATH),
+        )
+
+        assert improved_code["main.py"].split("\n")[2:4] == [
+            "value_2b = 2.5",
+            "value_3 = 3",
+        ]
+        assert "value_60 = 600" in improved_code["main.py"]
+        system, excerpts, request, failed_hunks, errors = sent[1]
+        assert system is sent[0][0]
+        assert request is sent[0][-1]
+        # the retry shows the failing file around the failed hunk only, line numbers
+        # shifted by the applied hunk
+        assert "\n61 value_60 = 60\n" in excerpts.content
+        assert "value_1 = 1" not in excerpts.content
+        assert "other.py" not in excerpts.content
+        assert "not in the file at all" in failed_hunks.content
+        assert "value_2b" not in failed_hunks.content
+        assert "were not on the requested format" in errors.content
+
     def test_lint_python(self):
         linting = Linting()
         content = "print('Hello, world! ')"
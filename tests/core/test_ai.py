@@ -1,13 +1,43 @@
+import asyncio
+
 from langchain.chat_models.base import BaseChatModel
+from langchain.schema import AIMessage, HumanMessage, SystemMessage
 from langchain_community.chat_models.fake import FakeListChatModel
+from langchain_core.runnables import RunnableLambda
 
-from espada.core.ai import AI
+from espada.core.ai import AI, ClipboardAI, mark_cacheable
+from espada.core.llm_cache import LLMCache
 
 
 def mock_create_chat_model(self) -> BaseChatModel:
     return FakeListChatModel(responses=["response1", "response2", "response3"])
 
 
+class FakeToolCallingModel(FakeListChatModel):
+    def bind_tools(self, tools, tool_choice=None, **kwargs):
+        def call_tool(messages):
+            return AIMessage(
+                content="",
+                tool_calls=[
+                    {
+                        "name": tool_choice,
+                        "args": {"files": [{"path": "a.py", "content": "x = 1"}]},
+                        "id": "call_1",
+                    }
+                ],
+            )
+
+        return RunnableLambda(call_tool)
+
+
+class FakeStreamingModel(FakeListChatModel):
+    def _call(self, messages, stop=None, run_manager=None, **kwargs):
+        response = super()._call(messages, stop, run_manager, **kwargs)
+        for token in response.split():
+            run_manager.on_llm_new_token(token)
+        return response
+
+
 def test_start(monkeypatch):
     monkeypatch.setattr(AI, "_create_chat_model", mock_create_chat_model)
 
@@ -51,3 +81,193 @@ def test_token_logging(monkeypatch):
     # assert
     assert usageCostAfterStart > 0
     assert usageCostAfterNext > usageCostAfterStart
+
+
+def test_astart(monkeypatch):
+    monkeypatch.setattr(AI, "_create_chat_model", mock_create_chat_model)
+
+    ai = AI("gpt-4")
+
+    # act
+    response_messages = asyncio.run(
+        ai.astart("system prompt", "user prompt", step_name="step name")
+    )
+
+    # assert
+    assert response_messages[-1].content == "response1"
+    assert len(ai.token_usage_log.log()) == 1
+
+
+def test_anext(monkeypatch):
+    # arrange
+    monkeypatch.setattr(AI, "_create_chat_model", mock_create_chat_model)
+
+    ai = AI("gpt-4")
+    response_messages = ai.start("system prompt", "user prompt", step_name="step name")
+
+    # act
+    response_messages = asyncio.run(
+        ai.anext(response_messages, "next user prompt", step_name="step name")
+    )
+
+    # assert
+    assert response_messages[-1].content == "response2"
+
+
+def test_concurrent_sessions(monkeypatch):
+    # arrange
+    monkeypatch.setattr(AI, "_create_chat_model", mock_create_chat_model)
+
+    ai = AI("gpt-4")
+
+    async def run_sessions():
+        return await asyncio.gather(
+            *(
+                ai.astart("system prompt", f"user prompt {i}", step_name=f"step {i}")
+                for i in range(3)
+            )
+        )
+
+    # act
+    sessions = asyncio.run(run_sessions())
+
+    # assert
+    assert sorted(messages[-1].content for messages in sessions) == [
+        "response1",
+        "response2",
+        "response3",
+    ]
+    log = ai.token_usage_log.log()
+    assert len(log) == 3
+    assert log[-1].total_tokens == sum(entry.in_step_total_tokens for entry in log)
+
+
+def test_cache_control_marks_stable_prefix():
+    messages = [
+        mark_cacheable(SystemMessage(content="system prompt")),
+        mark_cacheable(HumanMessage(content="uploaded files")),
+        HumanMessage(content=[{"type": "text", "text": "Request: prompt"}]),
+    ]
+
+    prepared = AI._add_cache_control(messages)
+
+    assert prepared[0].content == [
+        {"type": "text", "text": "system prompt", "cache_control": {"type": "ephemeral"}}
+    ]
+    assert prepared[1].content[-1]["cache_control"] == {"type": "ephemeral"}
+    assert prepared[2] is messages[2]
+    # the caller's messages are left untouched
+    assert messages[0].content == "system prompt"
+
+
+def test_cached_prompt_tokens_from_provider_usage():
+    anthropic_response = AIMessage(
+        content="answer",
+        response_metadata={
+            "usage": {"input_tokens": 10, "cache_read_input_tokens": 1500}
+        },
+    )
+    openai_response = AIMessage(
+        content="answer",
+        response_metadata={
+            "token_usage": {"prompt_tokens_details": {"cached_tokens": 1024}}
+        },
+    )
+
+    assert AI._cached_prompt_tokens(anthropic_response) == 1500
+    assert AI._cached_prompt_tokens(openai_response) == 1024
+    assert AI._cached_prompt_tokens(AIMessage(content="answer")) == 0
+
+
+def test_tool_call_becomes_json_content(monkeypatch):
+    monkeypatch.setattr(
+        AI,
+        "_create_chat_model",
+        lambda self: FakeToolCallingModel(responses=["chat response"]),
+    )
+    ai = AI("gpt-4", structured_output=True)
+    tools = [{"name": "write_files", "description": "", "parameters": {}}]
+
+    messages = ai.start("system prompt", "user prompt", step_name="step", tools=tools)
+
+    assert ai.structured_output
+    assert messages[-1].content == (
+        '{"files": [{"path": "a.py", "content": "x = 1"}]}'
+    )
+    # without tools the model answers in the chat
+    messages = ai.next(messages, "next prompt", step_name="step")
+    assert messages[-1].content == "chat response"
+    assert len(ai.token_usage_log.log()) == 2
+
+
+
+def test_provider_token_usage():
+    openai_response = AIMessage(
+        content="answer",
+        usage_metadata={"input_tokens": 1500, "output_tokens": 20, "total_tokens": 1520},
+    )
+    anthropic_response = AIMessage(
+        content="answer",
+        response_metadata={
+            "usage": {"input_tokens": 10, "cache_read_input_tokens": 1470}
+        },
+        usage_metadata={"input_tokens": 10, "output_tokens": 20, "total_tokens": 30},
+    )
+
+    assert AI._provider_token_usage(openai_response) == {
+        "prompt_tokens": 1500,
+        "completion_tokens": 20,
+    }
+    assert AI._provider_token_usage(anthropic_response)["prompt_tokens"] == 1480
+    # e.g. a cached response, its tokens are counted locally
+    assert AI._provider_token_usage(AIMessage(content="answer")) == {}
+
+
+def test_step_latencies_are_logged(monkeypatch):
+    monkeypatch.setattr(
+        AI,
+        "_create_chat_model",
+        lambda self: FakeStreamingModel(responses=["streamed response"]),
+    )
+    ai = AI("gpt-4")
+    ai.start("system prompt", "user prompt", step_name="streamed")
+
+    ai.llm = mock_create_chat_model(ai)
+    ai.start("system prompt", "user prompt", step_name="not streamed")
+
+    streamed, not_streamed = ai.token_usage_log.log()
+    assert 0 <= streamed.time_to_first_token <= streamed.wall_time
+    assert not_streamed.time_to_first_token is None
+    assert not_streamed.wall_time >= 0
+
+
+def test_cached_responses_are_not_billed(monkeypatch, tmp_path):
+    monkeypatch.setattr(AI, "_create_chat_model", mock_create_chat_model)
+    ai = AI("gpt-4", cache=LLMCache(tmp_path / "cache.db"))
+
+    ai.start("system prompt", "user prompt", step_name="billed")
+    cost = ai.token_usage_log.usage_cost()
+    wall_time = ai.token_usage_log.wall_time()
+    response = ai.start("system prompt", "user prompt", step_name="cached")
+
+    assert response[-1].content == "response1"
+    billed, cached = ai.token_usage_log.log()
+    assert not billed.cached_response and billed.in_step_cost > 0
+    assert cached.cached_response and cached.in_step_cost == 0.0
+    assert cached.wall_time is None and cached.time_to_first_token is None
+    assert ai.token_usage_log.usage_cost() == cost
+    assert ai.token_usage_log.wall_time() == wall_time
+
+
+def test_clipboard_anext_forwards_tools(monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        ClipboardAI,
+        "next",
+        lambda self, messages, prompt=None, **kwargs: calls.append(kwargs) or messages,
+    )
+    tools = [{"name": "write_files"}]
+
+    asyncio.run(ClipboardAI().anext([], step_name="step name", tools=tools))
+
+    assert calls == [{"step_name": "step name", "callbacks": None, "tools": tools}]
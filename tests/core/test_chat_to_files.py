@@ -1,14 +1,37 @@
 import os
 import io
 import contextlib
+import random
 
 from typing import Dict, Tuple
 
 import pytest
 
-from espada.core.chat_to_files import parse_diffs
-from espada.core.diff import is_similar
-from espada.core.files_dict import file_to_lines_dict
+from espada.core import diff as diff_module
+from espada.core.chat_to_files import (
+    DiffStreamParser,
+    apply_diffs,
+    apply_edits,
+    parse_diffs,
+    parse_edits,
+    validate_and_apply_diffs,
+)
+from espada.core.diff import (
+    ADD,
+    EXACT_MATCH,
+    FUZZY_MATCH,
+    REMOVE,
+    RETAIN,
+    ForwardWindow,
+    Hunk,
+    HunkLines,
+    LineIndex,
+    LineStore,
+    block_histogram,
+    count_ratio,
+    is_similar,
+)
+from espada.core.files_dict import FilesDict, file_to_lines_dict
 
 THIS_FILE_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -197,6 +220,205 @@ def test_edge_cases():
     assert is_similar("a", "a")
 
 
+@pytest.fixture(params=["numpy", "scalar"])
+def similarity_backend(request, monkeypatch):
+    if request.param == "scalar":
+        monkeypatch.setattr(diff_module, "np", None)
+    elif diff_module.np is None:
+        pytest.skip("numpy is not installed")
+    return request.param
+
+
+def test_line_index_matches_pairwise_similarity(similarity_backend):
+    rng = random.Random(0)
+    alphabet = "abcdef (),_="
+    lines_dict = {
+        line_number: "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 30)))
+        for line_number in range(1, 300)
+    }
+    line_index = LineIndex(lines_dict)
+    cut_lines_dict = {key: val for key, val in lines_dict.items() if key >= 100}
+    for line in list(lines_dict.values())[:50]:
+        probe = line[:-1] + rng.choice(alphabet)
+        for threshold in (0.5, 0.9):
+            assert line_index.similar_lines(probe, cut_lines_dict, threshold) == [
+                key
+                for key, val in cut_lines_dict.items()
+                if is_similar(probe, val, threshold)
+            ]
+        assert line_index.ratios(probe, list(cut_lines_dict)) == [
+            count_ratio(probe, val) for val in cut_lines_dict.values()
+        ]
+
+    # views of a line store are looked up as row ranges
+    line_store = LineStore.from_dict(lines_dict)
+    store_index = LineIndex(line_store)
+    for line in list(lines_dict.values())[:50]:
+        assert store_index.similar_lines(
+            line, line_store.from_line(100)
+        ) == line_index.similar_lines(line, cut_lines_dict)
+
+
+def test_hunk_lines_edits_match_list():
+    rng = random.Random(3)
+    expected = [(RETAIN, f"line {i}") for i in range(20)]
+    hunk_lines = HunkLines(expected)
+    for step in range(500):
+        index = rng.randint(0, len(expected))
+        operation = rng.choice(["insert", "pop", "relabel", "append"])
+        if operation == "insert":
+            line = (rng.choice([ADD, REMOVE, RETAIN]), f"new {step}")
+            expected.insert(index, line)
+            hunk_lines.insert(index, line)
+        elif operation == "append":
+            expected.append((ADD, f"appended {step}"))
+            hunk_lines.append((ADD, f"appended {step}"))
+        elif expected and index < len(expected):
+            if operation == "pop":
+                assert hunk_lines.pop(index) == expected.pop(index)
+            else:
+                expected[index] = (REMOVE, expected[index][1])
+                hunk_lines[index] = (REMOVE, hunk_lines.content(index))
+        assert len(hunk_lines) == len(expected)
+        probe = rng.randrange(len(expected))
+        assert hunk_lines[probe] == expected[probe]
+        assert hunk_lines.label(probe) == expected[probe][0]
+    assert hunk_lines == expected
+    assert hunk_lines[3:9] == expected[3:9]
+    assert hunk_lines.count_label(ADD) == sum(label == ADD for label, _ in expected)
+
+
+def test_line_store_views():
+    line_store = LineStore.from_dict(file_to_lines_dict("a\nb\nc\nd"))
+    view = line_store.from_line(3)
+    assert dict(view) == {3: "c", 4: "d"}
+    assert list(view.values()) == ["c", "d"]
+    assert 2 not in view and view.get(2) is None
+    assert view.last_line == 4 and len(view) == 2
+    # a view never extends back before its start
+    assert view.from_line(1).start == 3
+    assert dict(line_store.from_line(5)) == {}
+    with pytest.raises(ValueError):
+        LineStore.from_dict({1: "a", 3: "c"})
+
+
+def test_line_index_block_ratios_match_count_ratio(similarity_backend):
+    rng = random.Random(1)
+    alphabet = "abcDEF (),_=#é"
+    lines_dict = {
+        line_number: "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 20)))
+        for line_number in range(1, 100)
+    }
+    line_index = LineIndex(lines_dict)
+    for first_line in range(1, 90, 7):
+        for n_lines in (0, 1, 10):
+            window = "\n".join(
+                lines_dict[ind] for ind in range(first_line, first_line + n_lines)
+            )
+            blocks = [window, window[::-1], window[1:] + "\nxyz", ""]
+            assert line_index.block_ratios(
+                [block_histogram(block) for block in blocks], first_line, n_lines
+            ) == [count_ratio(block, window) for block in blocks]
+
+
+def test_line_index_vocabulary_is_bounded(monkeypatch):
+    if diff_module.np is None:
+        pytest.skip("numpy is not installed")
+    rng = random.Random(4)
+    # e.g. a file of translations, with thousands of distinct characters
+    alphabet = "abc ()" + "".join(chr(code) for code in range(0x4E00, 0x5E00))
+    lines_dict = {
+        line_number: "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 40)))
+        for line_number in range(1, 2000)
+    }
+    monkeypatch.setattr(LineIndex, "DENSE_COLUMNS", 16)
+    line_index = LineIndex(lines_dict)
+    assert line_index._histograms.shape == (len(lines_dict), 16)
+
+    for line in list(lines_dict.values())[:20]:
+        probe = line[:-1] + rng.choice(alphabet)
+        assert line_index.similar_lines(probe, similarity_threshold=0.5) == [
+            key for key, val in lines_dict.items() if is_similar(probe, val, 0.5)
+        ]
+        assert line_index.ratios(probe, list(lines_dict)) == [
+            count_ratio(probe, val) for val in lines_dict.values()
+        ]
+    for first_line in range(1, 1990, 199):
+        window = "\n".join(lines_dict[ind] for ind in range(first_line, first_line + 10))
+        blocks = [window, window[::-1], window[1:] + "\nxyz"]
+        assert line_index.block_ratios(
+            [block_histogram(block) for block in blocks], first_line, 10
+        ) == [count_ratio(block, window) for block in blocks]
+
+
+def test_forward_window_matches_forward_blocks():
+    rng = random.Random(2)
+    lines = [
+        (rng.choice([ADD, REMOVE, RETAIN]), f"line {rng.randint(0, 9)} {i}")
+        for i in range(60)
+    ]
+    hunk = Hunk(1, 0, 1, 0, lines)
+    window = ForwardWindow(hunk.lines, 0, hunk.forward_block_len)
+    for hunk_ind, (line_type, line) in enumerate(hunk.lines):
+        if line_type != ADD:
+            missing_line = f"missing {hunk_ind}"
+            assert window.blocks(missing_line) == [
+                block_histogram(hunk.make_forward_block(hunk_ind, 10)),
+                block_histogram(
+                    "\n".join([missing_line, hunk.make_forward_block(hunk_ind, 9)])
+                ),
+                block_histogram(hunk.make_forward_block(hunk_ind + 1, 10)),
+            ]
+        window.advance()
+
+
+def test_ambiguous_start_line_resolved_by_context():
+    code = "def a():\n    x = 1\n    return x\n\ndef b():\n    x = 1\n    return x + 1"
+    diff = parse_diffs(
+        "```diff\n--- f.py\n+++ f.py\n@@ -1,2 +1,2 @@\n     x = 1\n-    return x + 1\n+    return x + 2\n```"
+    )["f.py"]
+    diff.validate_and_correct(file_to_lines_dict(code))
+    # "x = 1" is on lines 2 and 6, but only line 6 is followed by the rest of the hunk
+    assert diff.hunks[0].start_line_pre_edit == 6
+    assert apply_diffs({"f.py": diff}, FilesDict({"f.py": code}))["f.py"].endswith(
+        "    return x + 2"
+    )
+
+
+def test_exact_hunks_skip_fuzzy_correction():
+    diff = parse_diffs(example_diff)["example.txt"]
+    assert diff.validate_and_correct(file_to_lines_dict(file_example)) == []
+    # the context of the second hunk is indented one space less than the file
+    assert diff.hunk_paths == {EXACT_MATCH: 1, FUZZY_MATCH: 1}
+    assert diff.diff_to_string() == "\n".join(example_diff.strip().split("\n")[4:-1])
+
+    diff = parse_diffs(example_line_dist_diff)["example.txt"]
+    diff.validate_and_correct(file_to_lines_dict(file_example))
+    assert diff.hunk_paths == {FUZZY_MATCH: 2}
+
+
+def test_exact_hunk_stays_at_its_start_line():
+    code = "x = 1\nreturn x\n\nx = 1\nreturn x"
+    chat = "```diff\n--- f.py\n+++ f.py\n@@ -4,2 +4,2 @@\n x = 1\n-return x\n+return -x\n```"
+    diff = parse_diffs(chat)["f.py"]
+    diff.validate_and_correct(file_to_lines_dict(code))
+    assert diff.hunks[0].start_line_pre_edit == 4
+    assert apply_diffs({"f.py": diff}, FilesDict({"f.py": code}))["f.py"] == (
+        "x = 1\nreturn x\n\nx = 1\nreturn -x"
+    )
+
+
+def test_exact_hunk_adds_lines_before_the_first_line():
+    code = "line1\nline2"
+    diff = parse_diffs(
+        "```diff\n--- a.py\n+++ a.py\n@@ -1,1 +1,2 @@\n+import os\n line1\n```"
+    )["a.py"]
+    assert diff.validate_and_correct(file_to_lines_dict(code)) == []
+    assert apply_diffs({"a.py": diff}, FilesDict({"a.py": code}))["a.py"] == (
+        "import os\nline1\nline2"
+    )
+
+
 def insert_string_in_lined_string(string, to_insert, line_number):
     split_string = string.split("\n")
     split_string.insert(line_number - 1, to_insert)
@@ -362,5 +584,221 @@ def test_long_file_diff():
     parse_chats_with_regex("wheaties_example_chat", "wheaties_example_code")
 
 
+def stream_diffs(chat: str, chunk_size: int, **kwargs) -> Dict:
+    parser = DiffStreamParser(**kwargs)
+    for start in range(0, len(chat), chunk_size):
+        parser.feed(chat[start : start + chunk_size])
+    return parser.close()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 10000])
+@pytest.mark.parametrize(
+    "chat",
+    [
+        example_diff,
+        example_multiple_diffs,
+        example_line_dist_diff,
+        example_diff + add_example,
+        single_diff,
+        multi_diff,
+    ],
+)
+def test_stream_parser_matches_parse_diffs(chat, chunk_size):
+    with contextlib.redirect_stderr(io.StringIO()):
+        expected = parse_diffs(chat)
+        streamed = stream_diffs(chat, chunk_size)
+    assert list(streamed) == list(expected)
+    for filename, diff in expected.items():
+        assert streamed[filename].diff_to_string() == diff.diff_to_string()
+
+
+def test_stream_parser_reports_hunks_as_they_close():
+    events = []
+    parser = DiffStreamParser(
+        on_hunk=lambda diff, hunk: events.append(("hunk", hunk.start_line_pre_edit)),
+        on_diff=lambda diff: events.append(("diff", diff.filename_post)),
+    )
+    first_hunk_end = example_diff.index("@@ -35")
+    parser.feed(example_diff[:first_hunk_end])
+    assert events == []
+    # the next hunk header closes the first hunk
+    parser.feed(example_diff[first_hunk_end:])
+    assert events == [("hunk", 12), ("hunk", 35), ("diff", "example.txt")]
+
+
+def test_stream_parser_discards_unterminated_block():
+    diffs = stream_diffs(example_diff.rstrip().rstrip("`"), 5)
+    assert diffs == {}
+
+
+def test_parse_large_multi_file_response():
+    hunk = "@@ -1,3 +1,3 @@\n line\n-old\n+new\n line\n"
+    chat = "".join(
+        f"Change {i}\n```diff\n--- file{i}.py\n+++ file{i}.py\n" + hunk * 50 + "```\n"
+        for i in range(25)
+    )
+    diffs = parse_diffs(chat)
+    assert len(diffs) == 25
+    assert all(len(diff.hunks) == 50 for diff in diffs.values())
+
+
+def test_parse_unterminated_diff_does_not_time_out():
+    # used to make the backtracking regex time out and return no diffs at all
+    chat = example_diff + "```diff\n--- a.py\n+++ a.py\n" + "@@ -1,1 +1,1 @@\n+x\n" * 5000
+    diffs = parse_diffs(chat, diff_timeout=0)
+    assert list(diffs) == ["example.txt"]
+
+
+def test_apply_diffs_keeps_lines_containing_the_old_removal_marker():
+    files = FilesDict({"a.py": "keep = '<REMOVE_LINE>'\nold\nend"})
+    diffs = parse_diffs(
+        "```diff\n--- a.py\n+++ a.py\n@@ -1,3 +1,3 @@\n keep = '<REMOVE_LINE>'\n-old\n+new\n end\n```"
+    )
+    assert apply_diffs(diffs, files)["a.py"] == "keep = '<REMOVE_LINE>'\nnew\nend"
+
+
+def test_apply_diffs_adds_lines_before_the_first_line():
+    files = FilesDict({"a.py": "line1\nline2"})
+    diffs = parse_diffs(
+        "```diff\n--- a.py\n+++ a.py\n@@ -1,1 +1,2 @@\n+import os\n line1\n```"
+    )
+    assert apply_diffs(diffs, files)["a.py"] == "import os\nline1\nline2"
+
+
+@pytest.mark.parametrize("validate", [True, False])
+def test_parallel_validate_and_apply_matches_sequential(validate):
+    distorted_example = insert_string_in_lined_string(
+        file_example, "#\n#comment\n#\n#", 14
+    )
+    files = FilesDict({"new_file.txt": "stale"})
+    chat = add_example
+    for i in range(4):
+        files[f"example{i}.txt"] = file_example if i % 2 else distorted_example
+        chat += example_line_dist_diff.replace("example.txt", f"example{i}.txt")
+        files[f"broken{i}.txt"] = "alpha\nbeta"
+        chat += f"```diff\n--- broken{i}.txt\n+++ broken{i}.txt\n@@ -1,2 +1,2 @@\n gamma {i}\n-delta\n+beta\n```\n"
+
+    outputs = []
+    for workers in (0, 3):
+        diffs = parse_diffs(chat)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            result = validate_and_apply_diffs(diffs, files, validate, workers)
+        outputs.append((result, output.getvalue(), list(diffs.items())))
+
+    (files_seq, problems_seq), output_seq, diffs_seq = outputs[0]
+    (files_par, problems_par), output_par, diffs_par = outputs[1]
+    assert list(files_par.items()) == list(files_seq.items())
+    assert problems_par == problems_seq
+    assert output_par == output_seq
+    assert [key for key, _ in diffs_par] == [key for key, _ in diffs_seq]
+    assert [d.diff_to_string() for _, d in diffs_par] == [
+        d.diff_to_string() for _, d in diffs_seq
+    ]
+    if validate:
+        assert problems_seq and "Invalid Hunk" in output_seq
+    # the file and its index are not kept, nor sent back by the workers
+    for _, d in diffs_seq + diffs_par:
+        assert d._lines_dict is None and d._cut_lines is None and d._line_index is None
+
+
+def test_parallel_apply_falls_back_when_a_diff_reads_an_edited_file():
+    files = FilesDict({"a.py": "one\ntwo", "b.py": "three"})
+    diffs = parse_diffs(
+        "```diff\n--- a.py\n+++ b.py\n@@ -1,2 +1,2 @@\n one\n-two\n+2\n```\n"
+        "```diff\n--- b.py\n+++ c.py\n@@ -1,2 +1,2 @@\n one\n-2\n+II\n```"
+    )
+    files, _ = validate_and_apply_diffs(diffs, files, validate=False, workers=2)
+    assert files == {"a.py": "one\ntwo", "b.py": "one\n2", "c.py": "one\nII"}
+
+
+search_replace_example = """
+Here are the changes:
+
+example.txt
+```
+<<<<<<< SEARCH
+    sample text 1
+    sample text 2
+    original text A
+=======
+    sample text 1
+    sample text 2
+    added extra line here
+    updated original text A with changes
+>>>>>>> REPLACE
+<<<<<<< SEARCH
+        checking status:
+            perform operation X
+=======
+        checking status:
+            perform operation X only if specific condition holds
+                new operation related to condition
+>>>>>>> REPLACE
+```
+
+new_file.txt
+```
+<<<<<<< SEARCH
+=======
+Hello, world!
+>>>>>>> REPLACE
+```
+"""
+
+
+def test_search_replace_edits_files():
+    files = FilesDict({"example.txt": file_example})
+    edits = parse_edits(search_replace_example)
+    assert {name: len(blocks) for name, blocks in edits.items()} == {
+        "example.txt": 2,
+        "new_file.txt": 1,
+    }
+    edited, problems = apply_edits(edits, files)
+    assert problems == []
+    assert edited["new_file.txt"] == "Hello, world!"
+    lines = edited["example.txt"].split("\n")
+    start = lines.index("    added extra line here")
+    assert lines[start - 2 : start + 2] == [
+        "    sample text 1",
+        "    sample text 2",
+        "    added extra line here",
+        "    updated original text A with changes",
+    ]
+    # the second block is indented one space less than the file, so is its replacement
+    start = lines.index("         checking status:")
+    assert lines[start : start + 4] == [
+        "         checking status:",
+        "             perform operation X only if specific condition holds",
+        "                 new operation related to condition",
+        "         evaluating next step:",
+    ]
+
+
+def test_search_replace_anchors_similar_lines_after_previous_edit():
+    code = "a = 1\nprint(value_of_a)\n\nb = 2\nprint(value_of_a)"
+    chat = (
+        "f.py\n```\n<<<<<<< SEARCH\nb = 2\n=======\nb = 3\n>>>>>>> REPLACE\n"
+        "<<<<<<< SEARCH\nprint(value_of_a);\n=======\nprint(b)\n>>>>>>> REPLACE\n```"
+    )
+    edited, problems = apply_edits(parse_edits(chat), FilesDict({"f.py": code}))
+    assert problems == []
+    assert edited["f.py"] == "a = 1\nprint(value_of_a)\n\nb = 3\nprint(b)"
+
+
+def test_search_replace_reports_blocks_not_found():
+    chat = (
+        "f.py\n```\n<<<<<<< SEARCH\nmissing()\n=======\nfound()\n>>>>>>> REPLACE\n"
+        "<<<<<<< SEARCH\nx = 1\n=======\nx = 2\n>>>>>>> REPLACE\n```\n"
+        "g.py\n```\n<<<<<<< SEARCH\nx = 1\n=======\n>>>>>>> REPLACE\n```\n"
+        "h.py\n```\n<<<<<<< SEARCH\nx = 1\n=======\nunterminated\n```"
+    )
+    edited, problems = apply_edits(parse_edits(chat), FilesDict({"f.py": "x = 1"}))
+    assert edited == {"f.py": "x = 2"}
+    assert len(problems) == 2
+    assert "was not found" in problems[0] and "missing()" in problems[0]
+    assert "g.py does not exist" in problems[1]
+
+
 if __name__ == "__main__":
     pytest.main()
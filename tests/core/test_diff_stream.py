@@ -0,0 +1,171 @@
+import contextlib
+import io
+import os
+
+import pytest
+
+from langchain.chat_models.base import BaseChatModel
+from langchain_community.chat_models.fake import FakeListChatModel
+from langchain_core.language_models.chat_models import generate_from_stream
+
+from espada.core.ai import AI
+from espada.core.chat_to_files import apply_diffs, parse_diffs
+from espada.core.default.disk_memory import DiskMemory
+from espada.core.default.steps import _improve_loop
+from espada.core.diff_stream import DiffStreamAborted, StreamingDiffValidator
+from espada.core.files_dict import FilesDict, file_to_lines_dict
+from espada.core.rate_limiter import RateLimit, TokenBucketRateLimiter
+
+TEST_CASES_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "improve_function_test_cases"
+)
+
+valid_patch = """
+```diff
+--- main.py
++++ main.py
+@@ -1,1 +1,1 @@
+-print('Hello, World!')
++print('Goodbye, World!')
+```
+"""
+
+invalid_patch = """
+```diff
+--- main.py
++++ main.py
+@@ -1,1 +1,1 @@
+-print('This line is not in the file')
++print('Goodbye, World!')
+@@ -5,1 +5,1 @@
+-never reached
++never reached
+```
+"""
+
+
+class StreamingFakeListChatModel(FakeListChatModel):
+    # Streams the responses token by token, like the OpenAI model with streaming=True
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        def chunks():
+            for chunk in self._stream(messages, stop=stop, **kwargs):
+                if run_manager is not None:
+                    run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                yield chunk
+
+        return generate_from_stream(chunks())
+
+
+def get_file_content(file_name: str) -> str:
+    with open(os.path.join(TEST_CASES_DIR, file_name), "r") as f:
+        return f.read()
+
+
+def stream(validator: StreamingDiffValidator, chat: str, chunk_size=4) -> None:
+    for start in range(0, len(chat), chunk_size):
+        validator.on_llm_new_token(chat[start : start + chunk_size])
+
+
+@pytest.mark.parametrize(
+    "file_name, code, chat",
+    [
+        ("taskmaster.py", "task_master_code", "task_master_chat"),
+        ("VMClonetest.ps1", "wheaties_example_code", "wheaties_example_chat"),
+        ("main.py", "apps_benchmark_6_code", "apps_benchmark_6_chat"),
+    ],
+)
+def test_streamed_validation_matches_batch_validation(file_name, code, chat):
+    files = FilesDict({file_name: get_file_content(code)})
+    chat = get_file_content(chat)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        diffs = parse_diffs(chat)
+        problems = []
+        for diff in diffs.values():
+            if not diff.is_new_file():
+                problems.extend(
+                    diff.validate_and_correct(
+                        file_to_lines_dict(files[diff.filename_pre])
+                    )
+                )
+
+        validator = StreamingDiffValidator(files, abort_on_invalid_first_hunk=False)
+        stream(validator, chat)
+        streamed_diffs, streamed_problems = validator.result(chat)
+
+    assert streamed_problems == problems
+    assert apply_diffs(streamed_diffs, files) == apply_diffs(diffs, files)
+
+
+def test_invalid_first_hunk_aborts_stream():
+    validator = StreamingDiffValidator(FilesDict({"main.py": "print('Hello, World!')"}))
+
+    with pytest.raises(DiffStreamAborted), contextlib.redirect_stdout(io.StringIO()):
+        stream(validator, invalid_patch)
+
+    # the stream is interrupted as soon as the second hunk header closes the first hunk
+    assert "never reached" not in validator.text
+    diffs, problems = validator.result(invalid_patch)
+    assert diffs == {}
+    assert "none of its diffs were applied" in problems[-1]
+
+
+def test_response_not_streamed_falls_back():
+    validator = StreamingDiffValidator(FilesDict({"main.py": "print('Hello, World!')"}))
+
+    # e.g. a response served from the cache never reaches the callbacks
+    assert validator.result(valid_patch) is None
+
+
+def test_validation_errors_do_not_interrupt_the_stream():
+    validator = StreamingDiffValidator(FilesDict({"main.py": "print('Hello, World!')"}))
+
+    def fail(diff, hunk):
+        raise RuntimeError("bug in the validation")
+
+    validator.parser.on_hunk = fail
+    with contextlib.redirect_stdout(io.StringIO()):
+        stream(validator, valid_patch)
+
+    # the batch validation takes over
+    assert validator.text == valid_patch
+    assert validator.result(valid_patch) is None
+
+
+def test_aborted_stream_settles_the_rate_limit(monkeypatch, tmp_path):
+    def mock_create_chat_model(self) -> BaseChatModel:
+        return StreamingFakeListChatModel(responses=[invalid_patch])
+
+    monkeypatch.setattr(AI, "_create_chat_model", mock_create_chat_model)
+    limiter = TokenBucketRateLimiter(
+        "gpt-4", RateLimit(tokens_per_minute=1000), tmp_path / "limits.db"
+    )
+    settled = []
+    monkeypatch.setattr(limiter, "settle", settled.append)
+    ai = AI("gpt-4", cache=None, rate_limiter=limiter)
+    validator = StreamingDiffValidator(FilesDict({"main.py": "print('Hello, World!')"}))
+
+    with pytest.raises(DiffStreamAborted), contextlib.redirect_stdout(io.StringIO()):
+        ai.next([], "prompt", step_name="step", callbacks=[validator])
+
+    assert settled == [ai.token_usage_log.tokenizer.num_tokens(validator.text)]
+
+
+def test_improve_loop_retries_after_aborted_stream(monkeypatch, tmp_path):
+    def mock_create_chat_model(self) -> BaseChatModel:
+        return StreamingFakeListChatModel(responses=[invalid_patch, valid_patch])
+
+    monkeypatch.setattr(AI, "_create_chat_model", mock_create_chat_model)
+    ai = AI("gpt-4", cache=None, rate_limiter=None)
+    files = FilesDict({"main.py": "print('Hello, World!')"})
+
+    messages = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        files = _improve_loop(ai, files, DiskMemory(tmp_path), messages)
+
+    assert files == FilesDict({"main.py": "print('Goodbye, World!')"})
+    # the first response was cut off after its invalid first hunk
+    assert "never reached" not in messages[0].content
+    assert "Provide all diffs again" in messages[1].content
+    assert "Only rewrite the problematic diffs" not in messages[1].content
+    assert len(ai.token_usage_log.log()) == 2
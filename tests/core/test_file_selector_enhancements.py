@@ -63,3 +63,20 @@ def test_file_selector_enhancement_sort(tmp_path):
         os.path.normpath("a/aatest.py"),
         os.path.normpath("x/xxtest.py"),
     ], "FileSelector.get_current_files is unsorted!"
+
+
+def test_file_selector_reads_selected_files_lazily(tmp_path):
+    project_path = set_file_selector_tmpproject(tmp_path)
+    (project_path / "x/image.png").write_bytes(b"\x89PNG\r\n\x1a\n\xff")
+    fileSelector = FileSelector(project_path=project_path)
+    file_list = {"a/aatest.py": True, "x/image.png": True, "x/missing.py": True}
+    fileSelector.metadata_db[fileSelector.FILE_LIST_NAME] = toml.dumps(
+        {"files": file_list}
+    )
+
+    files_dict, _ = fileSelector.ask_for_files(skip_file_selection=True)
+
+    # files that are missing or not UTF-8 are skipped, the others are not read yet
+    assert list(files_dict) == ["a/aatest.py"]
+    assert files_dict.loaded_size() == 0
+    assert files_dict["a/aatest.py"] == 'print("Hello")'
@@ -0,0 +1,178 @@
+import gc
+import io
+import pickle
+import weakref
+
+import pytest
+
+from espada.core.chat_to_files import apply_diffs
+from espada.core.default.file_store import FileStore
+from espada.core.files_dict import FilesDict, LazyFilesDict, _RenderCache, render_file
+
+files_dict = FilesDict({"main.py": "import sys\n\nprint(1)", "empty.txt": ""})
+
+
+def test_to_chat_numbers_lines():
+    assert files_dict.to_chat() == (
+        "```\n"
+        "File: main.py\n1 import sys\n2 \n3 print(1)\n\n"
+        "File: empty.txt\n1 \n\n"
+        "```"
+    )
+    assert files_dict.to_chat(line_numbers=False) == (
+        "```\nFile: main.py\nimport sys\n\nprint(1)\n\nFile: empty.txt\n\n\n```"
+    )
+
+
+def test_write_chat_matches_to_chat():
+    stream = io.StringIO()
+
+    files_dict.write_chat(stream)
+
+    assert stream.getvalue() == files_dict.to_chat()
+
+
+def test_unchanged_files_are_rendered_once():
+    content = "x = 1\n" * 100
+
+    chunk = render_file("cached.py", content)
+
+    assert render_file("cached.py", content) is chunk
+    assert render_file("cached.py", content + "y = 2") is not chunk
+    assert render_file("renamed.py", content).startswith("File: renamed.py\n")
+
+
+def test_render_cache_is_bounded():
+    # every entry takes 6 characters, the name of its key and its chunk
+    cache = _RenderCache(max_chars=12)
+    cache.put(("a", b"", True), "12345")
+    cache.put(("b", b"", True), "12345")
+    cache.get(("a", b"", True))
+    cache.put(("c", b"", True), "12345")
+
+    # the least recently used chunk is evicted first
+    assert cache.get(("b", b"", True)) is None
+    assert cache.get(("a", b"", True)) == "12345"
+    cache.put(("d", b"", True), "too long for the cache")
+    assert cache.get(("d", b"", True)) is None
+
+
+def test_render_cache_keys_hold_no_content(monkeypatch):
+    content = "x = 1\n" * 1000
+    cache = _RenderCache(max_chars=1024 * 1024)
+    monkeypatch.setattr("espada.core.files_dict._render_cache", cache)
+
+    render_file("big.py", content)
+
+    ((name, digest, line_numbers),) = cache._chunks
+    assert (name, len(digest), line_numbers) == ("big.py", 16, True)
+    assert cache._chars == len("big.py") + 16 + len(cache._chunks[name, digest, True])
+
+
+def test_equal_contents_are_shared():
+    first = FilesDict({"a.py": "".join(["print(", "1)"])})
+    second = FilesDict({"a.py": "".join(["print(", "1", ")"])})
+
+    assert first["a.py"] is second["a.py"]
+    assert first == second
+
+
+def test_contents_are_freed_with_the_last_dictionary():
+    content = "".join(["print(", "'only here')"])
+    files = FilesDict({"a.py": content})
+    copy = files.copy()
+    stored = weakref.ref(files["a.py"])
+    del files
+    assert stored() is copy["a.py"]
+
+    del copy
+    gc.collect()
+    assert stored() is None
+
+
+def test_contents_pickle_as_str():
+    content = pickle.loads(pickle.dumps(files_dict["main.py"]))
+
+    assert content.__class__ is str
+    assert content == "import sys\n\nprint(1)"
+
+
+def test_copy_is_a_snapshot():
+    snapshot = files_dict.copy()
+    snapshot["main.py"] = "print(2)"
+
+    assert isinstance(snapshot, FilesDict)
+    assert snapshot["empty.txt"] is files_dict["empty.txt"]
+    assert files_dict["main.py"] == "import sys\n\nprint(1)"
+    assert files_dict.changed_files(snapshot) == ["main.py"]
+
+
+def test_constructor_checks_values():
+    with pytest.raises(TypeError):
+        FilesDict({"a.py": 1})
+
+
+def test_lazy_files_are_read_on_first_access(tmp_path):
+    (tmp_path / "a.py").write_text("print(1)")
+    (tmp_path / "b.py").write_bytes(b"x = 1\r\ny = 2")
+    files = LazyFilesDict.from_paths(tmp_path, ["a.py", "b.py"])
+
+    assert files.loaded_size() == 0
+    assert files.unloaded_size() == 20
+    assert files.to_chat() == "```\nFile: a.py\n1 print(1)\n\nFile: b.py\n1 x = 1\n2 y = 2\n\n```"
+    # rendering does not keep the contents
+    assert files.loaded_size() == 0
+    assert files["b.py"] == "x = 1\ny = 2"
+    assert files.loaded_size() == 11
+    assert dict(files) == {"a.py": "print(1)", "b.py": "x = 1\ny = 2"}
+
+
+def test_rendering_lazy_files_keeps_nothing(tmp_path, monkeypatch):
+    cache = _RenderCache(max_chars=1024 * 1024)
+    monkeypatch.setattr("espada.core.files_dict._render_cache", cache)
+    (tmp_path / "big.py").write_text("x = 1\n" * 10000)
+    files = LazyFilesDict.from_paths(tmp_path, ["big.py"])
+
+    files.to_chat()
+    files.write_chat(io.StringIO())
+
+    # neither the dictionary nor the render cache holds the file afterwards
+    assert files.loaded_size() == 0
+    assert cache._chars == 0
+    # once read into the dictionary, the file is worth caching
+    files["big.py"]
+    files.to_chat()
+    assert cache._chars > 60000
+
+
+def test_lazy_copies_share_unread_files(tmp_path):
+    (tmp_path / "a.py").write_text("print(1)")
+    (tmp_path / "b.py").write_text("print(2)")
+    files = LazyFilesDict.from_paths(tmp_path, ["a.py", "b.py"])
+
+    edited = apply_diffs({}, files)
+    edited["b.py"] = "print(3)"
+
+    assert isinstance(edited, LazyFilesDict)
+    assert edited.source_path("a.py") == tmp_path / "a.py"
+    assert files.changed_files(edited) == ["b.py"]
+    assert files != edited
+    assert files.source_path("a.py") == tmp_path / "a.py"
+
+
+def test_file_store_pulls_lazily_and_copies_unread_files(tmp_path):
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "main.py").write_text("print(1)")
+    (tmp_path / "image.bin").write_bytes(b"\xff\xfe")
+
+    files = FileStore(tmp_path / "src").pull()
+    files["new.py"] = "print(2)"
+    FileStore(tmp_path / "out").push(files)
+    FileStore(tmp_path / "src").push(files)
+
+    assert files.loaded_size() == len("print(2)")
+    assert (tmp_path / "out" / "main.py").read_text() == "print(1)"
+    assert (tmp_path / "src" / "new.py").read_text() == "print(2)"
+    assert LazyFilesDict.from_paths(tmp_path, ["image.bin"], "binary file") == {
+        "image.bin": "binary file"
+    }
@@ -0,0 +1,70 @@
+import base64
+import io
+
+import pytest
+
+from PIL import Image
+
+from espada.core import image_info as image_info_module
+from espada.core.default.disk_memory import DiskMemory
+from espada.core.image_info import header_size, image_info
+from espada.core.token_usage import Tokenizer
+
+
+def _image_bytes(size, image_format, **save_kwargs):
+    buffered = io.BytesIO()
+    Image.new("RGB", size, "white").save(buffered, format=image_format, **save_kwargs)
+    return buffered.getvalue()
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    image_info_module._cache.clear()
+    yield
+    image_info_module._cache.clear()
+
+
+@pytest.mark.parametrize("image_format", ["PNG", "JPEG"])
+def test_header_size_matches_pil(image_format):
+    data = _image_bytes((1023, 517), image_format)
+    assert header_size(data) == (1023, 517)
+
+
+def test_jpeg_size_behind_a_large_segment():
+    # a comment segment pushes the frame header past the first decoded prefix
+    data = _image_bytes((640, 480), "JPEG", comment=b"x" * 20000)
+    image_base64 = base64.b64encode(data).decode("utf-8")
+    assert image_info(image_base64).size == (640, 480)
+
+
+def test_data_urls_are_accounted_without_full_decode(monkeypatch):
+    data = _image_bytes((2048, 4096), "PNG")
+    url = "data:image/png;base64," + base64.b64encode(data).decode("utf-8")
+    decoded = []
+    real_b64decode = base64.b64decode
+    monkeypatch.setattr(
+        image_info_module.base64,
+        "b64decode",
+        lambda s: decoded.append(len(s)) or real_b64decode(s),
+    )
+
+    tokenizer = Tokenizer("gpt-4")
+    assert tokenizer.num_tokens_for_base64_image(url) == 1105
+    assert tokenizer.num_tokens_for_base64_image(url) == 1105
+    assert decoded == [image_info_module.HEADER_PREFIX_CHARS]
+
+
+def test_unknown_formats_fall_back_to_pil():
+    data = _image_bytes((30, 20), "GIF")
+    assert header_size(data) is None
+    assert image_info(base64.b64encode(data).decode("utf-8")).size == (30, 20)
+
+
+def test_disk_memory_registers_loaded_images(tmp_path, monkeypatch):
+    (tmp_path / "mock.jpg").write_bytes(_image_bytes((800, 600), "JPEG"))
+    url = DiskMemory(tmp_path)["mock.jpg"]
+    monkeypatch.setattr(
+        image_info_module, "_decoded_size", lambda _: pytest.fail("image decoded")
+    )
+    assert image_info(url).size == (800, 600)
+    assert Tokenizer("gpt-4").num_tokens_for_base64_image(url) == 765
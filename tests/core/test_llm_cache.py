@@ -0,0 +1,133 @@
+import sqlite3
+import time
+
+from langchain.schema import AIMessage, HumanMessage, SystemMessage
+from langchain_community.chat_models.fake import FakeListChatModel
+
+from espada.core.ai import AI
+from espada.core.llm_cache import LLMCache
+
+messages = [
+    SystemMessage(content="system prompt"),
+    HumanMessage(content="user prompt"),
+]
+
+
+def test_key_depends_on_model_temperature_and_messages():
+    key = LLMCache.make_key("gpt-4", 0.1, messages)
+
+    assert key == LLMCache.make_key("gpt-4", 0.1, list(messages))
+    assert key != LLMCache.make_key("gpt-4o", 0.1, messages)
+    assert key != LLMCache.make_key("gpt-4", 0.2, messages)
+    assert key != LLMCache.make_key(
+        "gpt-4", 0.1, messages + [AIMessage(content="answer")]
+    )
+
+
+def test_key_depends_on_tools():
+    tools = [{"name": "write_files", "description": "", "parameters": {}}]
+    key = LLMCache.make_key("gpt-4", 0.1, messages)
+
+    assert key == LLMCache.make_key("gpt-4", 0.1, messages, None)
+    assert key != LLMCache.make_key("gpt-4", 0.1, messages, tools)
+
+
+def test_memory_and_disk_hits(tmp_path):
+    cache = LLMCache(tmp_path / "cache.db")
+    cache.put("key", "value")
+
+    assert cache.get("key") == "value"
+    assert cache.stats.memory_hits == 1
+
+    # a fresh instance, e.g. another benchmark worker, only has the disk tier
+    other = LLMCache(tmp_path / "cache.db")
+    assert other.get("key") == "value"
+    assert other.get("missing") is None
+    assert other.stats.disk_hits == 1
+    assert other.stats.misses == 1
+    assert other.stats.hit_rate == 0.5
+
+
+def test_database_uses_wal(tmp_path):
+    LLMCache(tmp_path / "cache.db")
+
+    conn = sqlite3.connect(tmp_path / "cache.db")
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+
+def test_lru_tier_is_bounded(tmp_path):
+    cache = LLMCache(tmp_path / "cache.db", max_entries=2)
+    for key in ["a", "b", "c"]:
+        cache.put(key, key)
+
+    assert list(cache._memory) == ["b", "c"]
+    assert cache.get("a") == "a"
+    assert cache.stats.disk_hits == 1
+
+
+def test_ttl_eviction(tmp_path):
+    cache = LLMCache(tmp_path / "cache.db", ttl=0.05)
+    cache.put("key", "value")
+    time.sleep(0.1)
+
+    assert cache.get("key") is None
+    assert cache.stats.misses == 1
+
+
+def test_max_bytes_eviction(tmp_path):
+    cache = LLMCache(tmp_path / "cache.db", max_entries=0, max_bytes=10)
+    cache.put("old", "x" * 6)
+    cache.put("new", "y" * 6)
+
+    assert cache.get("old") is None
+    assert cache.get("new") == "y" * 6
+
+
+def test_ai_uses_cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(
+        AI,
+        "_create_chat_model",
+        lambda self: FakeListChatModel(responses=["response1", "response2"]),
+    )
+    ai = AI("gpt-4", cache=LLMCache(tmp_path / "cache.db"))
+
+    first = ai.start("system prompt", "user prompt", step_name="step name")
+    second = ai.start("system prompt", "user prompt", step_name="step name")
+
+    assert first[-1].content == "response1"
+    assert second[-1].content == "response1"
+    assert ai.cache.stats.hits == 1
+    assert len(ai.token_usage_log.log()) == 2
+
+
+def test_total_size_is_kept_without_summing(tmp_path):
+    cache = LLMCache(tmp_path / "cache.db", max_bytes=10)
+    statements = []
+    cache._connection().set_trace_callback(statements.append)
+    cache.put("a", "x" * 4)
+    cache.put("a", "x" * 2)  # replaces the 4 bytes
+    cache.put("b", "y" * 6)
+    cache.put("c", "z" * 3)  # evicts "a"
+
+    assert not any("SUM(" in statement for statement in statements)
+    assert LLMCache._total_size(cache._connection()) == 9
+
+    cache.clear()
+    assert LLMCache._total_size(cache._connection()) == 0
+
+
+def test_total_size_of_existing_database(tmp_path):
+    conn = sqlite3.connect(tmp_path / "cache.db")
+    conn.execute(
+        "CREATE TABLE responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+        "size INTEGER NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+    )
+    now = time.time()
+    conn.execute("INSERT INTO responses VALUES ('a', 'xxxx', 4, ?, ?)", (now, now))
+    conn.commit()
+    conn.close()
+
+    cache = LLMCache(tmp_path / "cache.db")
+    assert LLMCache._total_size(cache._connection()) == 4
+    cache.put("b", "yy")
+    assert LLMCache._total_size(cache._connection()) == 6
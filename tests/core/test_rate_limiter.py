@@ -0,0 +1,70 @@
+import pytest
+
+import espada.core.rate_limiter as rate_limiter
+
+from espada.core.rate_limiter import (
+    RateLimit,
+    TokenBucketRateLimiter,
+    get_rate_limiter,
+    parse_rate_limits,
+    set_rate_limit,
+)
+
+
+def test_parse_rate_limits():
+    limits = parse_rate_limits("gpt-4o=500:30000, claude-3-opus=50:")
+
+    assert limits["gpt-4o"] == RateLimit(500, 30000)
+    assert limits["claude-3-opus"] == RateLimit(50, None)
+    with pytest.raises(ValueError):
+        parse_rate_limits("500:30000")
+
+
+def test_request_bucket(tmp_path):
+    limiter = TokenBucketRateLimiter(
+        "gpt-4", RateLimit(requests_per_minute=2), tmp_path / "limits.db"
+    )
+
+    assert limiter._try_acquire(10, now=0) == 0
+    assert limiter._try_acquire(10, now=0) == 0
+    # the bucket is empty, and refills one request every 30 seconds
+    assert limiter._try_acquire(10, now=0) == pytest.approx(30)
+    assert limiter._try_acquire(10, now=30) == 0
+
+
+def test_token_bucket_and_settle(tmp_path):
+    limiter = TokenBucketRateLimiter(
+        "gpt-4", RateLimit(tokens_per_minute=600), tmp_path / "limits.db"
+    )
+
+    assert limiter._try_acquire(500, now=0) == 0
+    # 100 tokens are left, 100 more take 10 seconds to refill
+    assert limiter._try_acquire(200, now=0) == pytest.approx(10)
+    # requests larger than the whole bucket wait for a full bucket
+    assert limiter._try_acquire(10_000, now=0) == pytest.approx(50)
+
+
+def test_buckets_are_shared_between_limiters(tmp_path):
+    # e.g. two benchmark workers using the same model
+    path = tmp_path / "limits.db"
+    first = TokenBucketRateLimiter("gpt-4", RateLimit(requests_per_minute=1), path)
+    second = TokenBucketRateLimiter("gpt-4", RateLimit(requests_per_minute=1), path)
+    other_model = TokenBucketRateLimiter("gpt-4o", RateLimit(requests_per_minute=1), path)
+
+    assert first._try_acquire(1, now=0) == 0
+    assert second._try_acquire(1, now=0) > 0
+    assert other_model._try_acquire(1, now=0) == 0
+
+
+def test_get_rate_limiter(monkeypatch, tmp_path):
+    monkeypatch.setattr(rate_limiter, "DEFAULT_CACHE_DIR", tmp_path)
+    monkeypatch.setenv("ESPADA_RATE_LIMITS", "gpt-4o=500:30000")
+
+    assert get_rate_limiter("gpt-4") is None
+    assert get_rate_limiter("gpt-4o").limit == RateLimit(500, 30000)
+
+    set_rate_limit("gpt-4o", RateLimit(requests_per_minute=1))
+    try:
+        assert get_rate_limiter("gpt-4o").limit == RateLimit(requests_per_minute=1)
+    finally:
+        set_rate_limit("gpt-4o", None)
@@ -100,6 +100,38 @@ def test_zbf_yml_missing():
     print(updated_files["src/main/resources/application-local.yml"])
 
 
+def test_whole_file_rewrites_and_diffs_in_one_response():
+    files = FilesDict({"small.py": "print('old')", "big.py": "a = 1\nb = 2\nc = 3"})
+    response = """small.py
+```python
+print('new')
+```
+
+big.py
+```diff
+--- big.py
++++ big.py
+@@ -1,3 +1,3 @@
+ a = 1
+-b = 2
++b = 4
+ c = 3
+```
+"""
+    updated_files, errors = salvage_correct_hunks(
+        [AIMessage(content=response)], files, memory, whole_files=["small.py", "big.py"]
+    )
+    assert errors == []
+    # the diff of big.py is applied, not taken for its new content
+    assert updated_files == {"small.py": "print('new')", "big.py": "a = 1\nb = 4\nc = 3"}
+
+    # without being asked for in full, a file is only changed by diffs
+    updated_files, _ = salvage_correct_hunks(
+        [AIMessage(content=response)], files, memory
+    )
+    assert updated_files["small.py"] == "print('old')"
+
+
 def test_clean_up_folder(clean_up_folder):
     # The folder should be deleted after the test is run
     assert True
@@ -0,0 +1,72 @@
+import json
+
+from espada.core.structured_output import (
+    FILES_TOOL,
+    edits_from_response,
+    entrypoint_from_response,
+    files_from_response,
+    tool_kwargs,
+)
+
+
+class StructuredAI:
+    structured_output = True
+
+
+def test_files_from_tool_call():
+    response = json.dumps(
+        {
+            "files": [
+                {"path": "src/main.py", "content": 'print("```")\n'},
+                {"path": "`README.md`", "content": "# Title"},
+                {"path": "", "content": "no path"},
+            ]
+        }
+    )
+
+    files_dict = files_from_response(response)
+
+    # code fences in the content do not confuse the parser
+    assert dict(files_dict) == {"src/main.py": 'print("```")', "README.md": "# Title"}
+
+
+def test_files_from_chat():
+    response = "src/main.py\n```python\nprint(1)\n```"
+
+    assert dict(files_from_response(response)) == {"src/main.py": "print(1)"}
+
+
+def test_entrypoint_from_tool_call():
+    assert entrypoint_from_response('{"script": "pip install -r requirements.txt"}') == (
+        "pip install -r requirements.txt"
+    )
+    assert entrypoint_from_response("```sh\npython main.py\n```") is None
+
+
+def test_edits_from_tool_call():
+    response = json.dumps(
+        {
+            "diffs": [
+                {
+                    "path": "main.py",
+                    "hunks": [
+                        "@@ -1,2 +1,2 @@\n import sys\n-print(1)\n+print(2)",
+                        "@@ -5,1 +5,2 @@\n x = 1\n+y = 2\n",
+                    ],
+                }
+            ],
+            "files": [{"path": "new.py", "content": "z = 3"}],
+        }
+    )
+
+    diffs, files_dict = edits_from_response(response)
+
+    assert list(diffs) == ["main.py"]
+    assert len(diffs["main.py"].hunks) == 2
+    assert dict(files_dict) == {"new.py": "z = 3"}
+    assert edits_from_response("```diff\n--- a.py\n+++ a.py\n```") is None
+
+
+def test_tool_kwargs():
+    assert tool_kwargs(StructuredAI(), FILES_TOOL) == {"tools": [FILES_TOOL]}
+    assert tool_kwargs(object(), FILES_TOOL) == {}
@@ -1,11 +1,14 @@
 import base64
 import csv
 import io
+import json
 import os
 
 from io import StringIO
 from pathlib import Path
 
+import pytest
+
 from langchain.schema import HumanMessage, SystemMessage
 from PIL import Image
 
@@ -31,7 +34,7 @@ def test_format_log():
 
     assert len(csv_rows) == 3
 
-    assert all(len(row) == 7 for row in csv_rows)
+    assert all(len(row) == 9 for row in csv_rows)
 
 
 def test_usage_cost():
@@ -52,6 +55,30 @@ def test_usage_cost():
     assert usage_cost > 0
 
 
+def test_cached_prompt_tokens():
+    # arrange
+    token_usage_log = TokenUsageLog("gpt-4")
+    request_messages = [
+        SystemMessage(content="my system message"),
+        HumanMessage(content="my user prompt"),
+    ]
+    response = "response from model"
+
+    # act
+    token_usage_log.update_log(request_messages, response, "step 1")
+    token_usage_log.update_log(
+        request_messages, response, "step 2", cached_prompt_tokens=5
+    )
+
+    # assert
+    assert token_usage_log.log()[-1].in_step_cached_prompt_tokens == 5
+    assert token_usage_log.cached_prompt_tokens() == 5
+    assert (
+        token_usage_log.uncached_prompt_tokens()
+        == token_usage_log.log()[-1].total_prompt_tokens - 5
+    )
+
+
 def test_image_tokenizer():
     # Arrange
     token_usage_log = Tokenizer("gpt-4")
@@ -108,3 +135,125 @@ def test_list_type_message_with_image():
     assert (
         token_usage_log.log()[-1].in_step_total_tokens == expected_total_tokens
     ), f"Expected {expected_total_tokens} tokens, got {token_usage_log.log()[-1].in_step_total_tokens}"
+
+
+def test_only_new_texts_are_tokenized():
+    tokenizer = Tokenizer("gpt-4")
+    encode = tokenizer._tiktoken_tokenizer.encode
+    encoded = []
+
+    class CountingEncoding:
+        def encode(self, txt):
+            encoded.append(txt)
+            return encode(txt)
+
+    tokenizer._tiktoken_tokenizer = CountingEncoding()
+    conversation = [
+        SystemMessage(content="my system message"),
+        HumanMessage(content="my user prompt"),
+    ]
+
+    first_count = tokenizer.num_tokens_from_messages(conversation)
+    conversation.append(HumanMessage(content="".join(["my next ", "prompt"])))
+    second_count = tokenizer.num_tokens_from_messages(conversation)
+
+    assert encoded == ["my system message", "my user prompt", "my next prompt"]
+    # 4 + 2 tokens frame every message
+    assert second_count == first_count + 6 + tokenizer.num_tokens("my next prompt")
+
+
+def test_provider_usage_is_authoritative():
+    token_usage_log = TokenUsageLog("gpt-4")
+    token_usage_log._tokenizer = None  # the local tokenizer must not be needed
+
+    token_usage_log.update_log(
+        [HumanMessage(content="my user prompt")],
+        "response from model",
+        "step 1",
+        prompt_tokens=1200,
+        completion_tokens=300,
+    )
+
+    entry = token_usage_log.log()[-1]
+    assert (entry.in_step_prompt_tokens, entry.in_step_completion_tokens) == (1200, 300)
+    assert token_usage_log.total_tokens() == 1500
+
+
+def test_usage_cost_is_summed_per_step():
+    token_usage_log = TokenUsageLog("gpt-4o")
+    messages = [HumanMessage(content="my user prompt")]
+
+    token_usage_log.update_log(
+        messages, "answer", "step 1", prompt_tokens=1000, completion_tokens=100
+    )
+    token_usage_log.update_log(
+        messages,
+        "answer",
+        "step 2",
+        cached_prompt_tokens=800,
+        prompt_tokens=1000,
+        completion_tokens=100,
+    )
+
+    # $2.50 per million prompt tokens, $1.25 cached and $10 per million completion tokens
+    first_cost = (1000 * 2.50 + 100 * 10.00) / 1_000_000
+    second_cost = (200 * 2.50 + 800 * 1.25 + 100 * 10.00) / 1_000_000
+    assert token_usage_log.log()[0].in_step_cost == pytest.approx(first_cost)
+    assert token_usage_log.log()[1].in_step_cost == pytest.approx(second_cost)
+    assert token_usage_log.usage_cost() == pytest.approx(first_cost + second_cost)
+    assert token_usage_log.log()[1].total_cost == pytest.approx(first_cost + second_cost)
+
+
+def test_usage_cost_of_other_providers(monkeypatch):
+    monkeypatch.delenv("LOCAL_MODEL", raising=False)
+    messages = [HumanMessage(content="my user prompt")]
+    claude_log = TokenUsageLog("claude-3-5-sonnet-20240620")
+    unknown_log = TokenUsageLog("my-finetuned-model")
+
+    for token_usage_log in (claude_log, unknown_log):
+        token_usage_log.update_log(
+            messages, "answer", "step 1", prompt_tokens=1000, completion_tokens=100
+        )
+
+    assert claude_log.usage_cost() == pytest.approx((1000 * 3.00 + 100 * 15.00) / 1e6)
+    assert unknown_log.usage_cost() is None
+    assert unknown_log.log()[0].in_step_cost is None
+
+    monkeypatch.setenv("LOCAL_MODEL", "true")
+    assert TokenUsageLog("my-finetuned-model").usage_cost() == 0.0
+
+
+def test_export(tmp_path):
+    token_usage_log = TokenUsageLog("gpt-4")
+    messages = [HumanMessage(content="my user prompt")]
+    token_usage_log.update_log(
+        messages, "answer", "step 1", time_to_first_token=0.5, wall_time=2.0
+    )
+    token_usage_log.update_log(messages, "answer", "step 2", wall_time=1.0)
+
+    token_usage_log.export(tmp_path / "usage.jsonl")
+    token_usage_log.export(tmp_path / "usage.csv")
+
+    entries = [
+        json.loads(line)
+        for line in (tmp_path / "usage.jsonl").read_text().splitlines()
+    ]
+    rows = list(csv.DictReader(StringIO((tmp_path / "usage.csv").read_text())))
+    assert [entry["step_name"] for entry in entries] == ["step 1", "step 2"]
+    assert entries[0]["time_to_first_token"] == 0.5
+    assert entries[1]["time_to_first_token"] is None
+    assert entries[1]["total_cost"] == pytest.approx(token_usage_log.usage_cost())
+    assert [row["wall_time"] for row in rows] == ["2.0", "1.0"]
+    assert token_usage_log.wall_time() == 3.0
+
+
+def test_token_counts_do_not_keep_texts():
+    tokenizer = Tokenizer("gpt-4")
+    text = "a large file " * 1000
+
+    tokenizer.num_tokens(text)
+
+    assert all(
+        isinstance(key, bytes) and len(key) == 16 for key in tokenizer._token_counts
+    )
+    assert text not in tokenizer._token_counts
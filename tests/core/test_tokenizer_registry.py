@@ -0,0 +1,119 @@
+import hashlib
+import threading
+
+import pytest
+
+from espada.core import tokenizer_registry
+from espada.core.token_usage import Tokenizer, TokenUsageLog
+from espada.core.tokenizer_registry import (
+    TIKTOKEN_URL,
+    encoding_name_for_model,
+    get_encoding,
+    seed_tiktoken_cache,
+    warm_up,
+)
+
+
+class SlowEncoding:
+    def __init__(self, name):
+        self.name = name
+
+    def encode(self, txt):
+        return txt.split()
+
+
+@pytest.fixture
+def loads(monkeypatch):
+    # Counts the loads, each of them taking long enough for other threads to ask too
+    loaded = []
+    release = threading.Event()
+
+    def load_encoding(name):
+        loaded.append(name)
+        release.wait(1)
+        return SlowEncoding(name)
+
+    monkeypatch.setattr(tokenizer_registry, "_encodings", {})
+    monkeypatch.setattr(tokenizer_registry, "_load_encoding", load_encoding)
+    yield loaded, release
+    release.set()
+
+
+def test_encoding_names():
+    assert encoding_name_for_model("gpt-4o") == "o200k_base"
+    assert encoding_name_for_model("gpt-4-turbo") == "cl100k_base"
+    assert encoding_name_for_model("claude-3-5-sonnet-20240620") == "cl100k_base"
+    assert encoding_name_for_model("gpt-4-my-deployment") == "cl100k_base"
+
+
+def test_encodings_are_loaded_once(loads):
+    loaded, release = loads
+    encodings = []
+    threads = [
+        threading.Thread(target=lambda: encodings.append(get_encoding("cl100k_base")))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert loaded == ["cl100k_base"]
+    assert len(encodings) == 4 and all(e is encodings[0] for e in encodings)
+
+
+def test_failed_loads_are_retried(monkeypatch):
+    attempts = []
+
+    def load_encoding(name):
+        attempts.append(name)
+        if len(attempts) == 1:
+            raise ConnectionError("offline")
+        return SlowEncoding(name)
+
+    monkeypatch.setattr(tokenizer_registry, "_encodings", {})
+    monkeypatch.setattr(tokenizer_registry, "_load_encoding", load_encoding)
+
+    with pytest.raises(ConnectionError):
+        get_encoding("cl100k_base")
+    assert get_encoding("cl100k_base").name == "cl100k_base"
+
+
+def test_construction_does_not_load_the_encoding(loads):
+    loaded, release = loads
+    release.set()
+
+    token_usage_log = TokenUsageLog("gpt-4o")
+    assert loaded == []
+
+    assert token_usage_log.tokenizer.num_tokens("two tokens") == 2
+    assert Tokenizer("gpt-4o").num_tokens("three more tokens") == 3
+    assert loaded == ["o200k_base"]
+
+
+def test_warm_up_loads_in_the_background(loads):
+    loaded, release = loads
+
+    thread = warm_up(["gpt-4o", "gpt-4"])
+    release.set()
+    thread.join(1)
+
+    assert loaded == ["o200k_base", "cl100k_base"]
+
+
+def test_bundled_encodings_seed_the_tiktoken_cache(tmp_path, monkeypatch):
+    bundle_dir = tmp_path / "bundle"
+    bundle_dir.mkdir()
+    (bundle_dir / "cl100k_base.tiktoken").write_bytes(b"IQ== 0\n")
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setenv("TIKTOKEN_CACHE_DIR", str(cache_dir))
+    monkeypatch.setenv("ESPADA_TIKTOKEN_DIR", str(bundle_dir))
+
+    assert seed_tiktoken_cache("cl100k_base")
+    assert not seed_tiktoken_cache("o200k_base")
+
+    url = TIKTOKEN_URL.format(name="cl100k_base")
+    cache_path = cache_dir / hashlib.sha1(url.encode()).hexdigest()
+    assert cache_path.read_bytes() == b"IQ== 0\n"
+    assert [path.name for path in cache_dir.iterdir()] == [cache_path.name]